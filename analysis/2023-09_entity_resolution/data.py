@@ -1,6 +1,24 @@
+import os
 import spatialite
 import pandas as pd
 
+# one connection per dataset, opened with the extension loaded and these pragmas set, then reused
+PRAGMAS = {
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024,  # negative is in KiB, so 64MB
+    "temp_store": "MEMORY",
+}
+_connections = {}
+
+def get_connection(dataset_path):
+    path = os.path.abspath(dataset_path)
+    if path not in _connections:
+        con = spatialite.connect(path)
+        for pragma, value in PRAGMAS.items():
+            con.execute(f"PRAGMA {pragma} = {value}")
+        _connections[path] = con
+    return _connections[path]
+
 def get_organisation_summary(dataset_path):
 
     sql = """
@@ -10,10 +28,10 @@ def get_organisation_summary(dataset_path):
         ORDER BY organisation_entity ASC;
     
     """ 
-    with spatialite.connect(dataset_path) as con:
-        cursor = con.execute(sql)
-        cols = [column[0] for column in cursor.description]
-        results = pd.DataFrame.from_records(data=cursor.fetchall(), columns=cols)
+    con = get_connection(dataset_path)
+    cursor = con.execute(sql)
+    cols = [column[0] for column in cursor.description]
+    results = pd.DataFrame.from_records(data=cursor.fetchall(), columns=cols)
     
     return results
 
@@ -52,10 +70,10 @@ def get_duplicates_between_orgs(dataset_path,org1,org2):
             AND ST_Intersects(GeomFromText(a.geometry), GeomFromText(b.geometry))
             WHERE 100 *(ST_Area(ST_Intersection(GeomFromText(a.geometry), GeomFromText(b.geometry)))/ MIN(ST_Area(GeomFromText(a.geometry)), ST_Area(GeomFromText(b.geometry)))) > 95;
         """
-    with spatialite.connect(dataset_path) as con:
-        cursor = con.execute(sql)
-        cols = [column[0] for column in cursor.description]
-        results = pd.DataFrame.from_records(data=cursor.fetchall(), columns=cols)
+    con = get_connection(dataset_path)
+    cursor = con.execute(sql)
+    cols = [column[0] for column in cursor.description]
+    results = pd.DataFrame.from_records(data=cursor.fetchall(), columns=cols)
     
     return results
 
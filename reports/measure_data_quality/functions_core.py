@@ -1,10 +1,18 @@
 import urllib
 import os
+import sys
 import sqlite3
 import pandas as pd
 import geopandas as gpd
 import shapely.wkt
 
+# The shared Datasette client is the datasette_client package in the monitoring tool's scripts folder
+sys.path.append(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..", "pbi_reports_datafiles", "monitoring_data_collection_tool_github_actions", "scripts"
+))
+from datasette_client import read_csv as read_datasette_csv, DATASETTE_URL
+
 
 global FILES_URL
 
@@ -30,7 +38,7 @@ def download_dataset(dataset, output_dir_path, overwrite=False):
 
 def get_pdp_dataset(dataset, geometry_field = "geometry", crs_out=4326, underscore_cols=True):
 
-    df = pd.read_csv(f"https://files.planning.data.gov.uk/dataset/{dataset}.csv", dtype = "str")
+    df = read_datasette_csv(f"https://files.planning.data.gov.uk/dataset/{dataset}.csv", dtype = "str")
     df.columns = [x.replace("-", "_") for x in df.columns]
 
     df_valid_geom = df[df[geometry_field].notnull()].copy()
@@ -58,10 +66,9 @@ def query_sqlite(db_path, query_string):
 
 
 def datasette_query(db, sql_string):
-    params = urllib.parse.urlencode({
+    params = {
         "sql": sql_string,
         "_size": "max"
-        })
-    url = f"https://datasette.planning.data.gov.uk/{db}.csv?{params}"
-    df = pd.read_csv(url)
+        }
+    df = read_datasette_csv(f"{DATASETTE_URL}/{db}.csv", params=params)
     return df
\ No newline at end of file
@@ -0,0 +1,200 @@
+"""
+In-process execution of the monitoring scripts (run.py --in-process).
+
+Scripts that define `main(output_dir)` are imported and called in the
+runner's own process. pandas, requests and the helper modules are then imported
+once per run rather than once per script. Tables loaded with
+`_snapshot.load_table()` are shared through a RunContext (scripts/_context.py).
+Scripts without that entry point still run as subprocesses.
+
+Isolation matches the subprocess mode as far as one process allows:
+- each script is loaded as a new module, so scripts never share module globals
+- any exception fails only that script, and its traceback is logged in place
+  of a subprocess's stderr. SystemExit counts as its exit code would: 0 or
+  None (plain sys.exit()) is a success, anything else a failure
+- each script's own printed output is captured separately, even when several
+  run at once. It is dropped, as with subprocesses, and only stderr is logged
+  on failure. Output from threads a script starts goes to the console.
+- shared tables are handed out as copies
+- a script past its timeout is reported as TIMEOUT and abandoned. It cannot be
+  killed, but it runs in a daemon thread so it does not hold up the end of the run.
+
+Per-script metrics (see scripts/_metrics.py) can only be told apart when
+scripts run one at a time, so they are recorded when the runner uses one job.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import itertools
+import threading
+import traceback
+import importlib.util
+
+_module_ids = itertools.count()
+_streams_lock = threading.Lock()
+
+
+class _ThreadOutput(io.TextIOBase):
+    """
+    Text stream that writes to the calling thread's buffer when it has one, else to the original stream.
+
+    Parameters:
+        stream (io.TextIOBase): The stream being replaced (sys.stdout or sys.stderr).
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+
+    def capture(self, buffer):
+        """
+        Sends the calling thread's output to `buffer` (None to stop capturing).
+        """
+        self._local.buffer = buffer
+
+    def write(self, text):
+        buffer = getattr(self._local, "buffer", None)
+        return (buffer if buffer is not None else self.stream).write(text)
+
+    def flush(self):
+        buffer = getattr(self._local, "buffer", None)
+        (buffer if buffer is not None else self.stream).flush()
+
+    @property
+    def encoding(self):
+        return getattr(self.stream, "encoding", "utf-8")
+
+
+def _install_streams():
+    """
+    Replaces sys.stdout and sys.stderr with per-thread capturing streams, once.
+
+    Returns:
+        tuple: (stdout, stderr) capturing streams.
+    """
+    with _streams_lock:
+        if not isinstance(sys.stdout, _ThreadOutput):
+            sys.stdout = _ThreadOutput(sys.stdout)
+        if not isinstance(sys.stderr, _ThreadOutput):
+            sys.stderr = _ThreadOutput(sys.stderr)
+    return sys.stdout, sys.stderr
+
+
+def enable(scripts_dir):
+    """
+    Prepares this process to run scripts in-process and returns the shared context.
+
+    Parameters:
+        scripts_dir (str): Directory of the scripts (added to sys.path for their helper imports).
+
+    Returns:
+        RunContext: The context shared by the scripts' `load_table()` calls.
+    """
+    scripts_dir = os.path.abspath(scripts_dir)
+    if scripts_dir not in sys.path:
+        sys.path.insert(0, scripts_dir)
+    _install_streams()
+
+    from _context import RunContext, activate
+    context = RunContext()
+    activate(context)
+    return context
+
+
+def disable(context):
+    """
+    Deactivates the context and releases the tables it holds.
+
+    Parameters:
+        context (RunContext): The context from `enable()`.
+    """
+    from _context import activate
+    activate(None)
+    context.clear()
+
+
+def load_script(script_path):
+    """
+    Imports a script as a new module, without running its `__main__` block.
+
+    Parameters:
+        script_path (str): Path to the script.
+
+    Returns:
+        module: The loaded module.
+    """
+    name = f"_script_{os.path.splitext(os.path.basename(script_path))[0]}_{next(_module_ids)}"
+    spec = importlib.util.spec_from_file_location(name, script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_in_process(script_path, output_dir, timeout=None, log=print, metrics_file=None, measure=False):
+    """
+    Runs a script's `main(output_dir)` in this process and logs the result. `enable()`
+    must have been called first.
+
+    Parameters:
+        script_path (str): The path to the script.
+        output_dir (str): Directory passed to the script.
+        timeout (int, optional): Seconds to wait before the script is abandoned.
+        log (callable): Logging function for the result.
+        metrics_file (str, optional): File to write the script's metrics to.
+        measure (bool): Record metrics; only meaningful when no other script is running.
+
+    Returns:
+        tuple: (status, elapsed_seconds) where status is one of
+               "SUCCESS", "FAIL" or "TIMEOUT".
+    """
+    import _metrics
+
+    stdout, stderr = sys.stdout, sys.stderr
+    outcome = {}
+
+    def target():
+        errors = io.StringIO()
+        stdout.capture(io.StringIO())
+        stderr.capture(errors)
+        try:
+            load_script(script_path).main(output_dir)
+            outcome["status"] = "SUCCESS"
+        except SystemExit as e:
+            # as a subprocess's exit status: sys.exit() and sys.exit(0) succeed
+            if e.code in (0, None):
+                outcome["status"] = "SUCCESS"
+            else:
+                outcome["status"] = "FAIL"
+                errors.write(traceback.format_exc())
+        except BaseException:
+            outcome["status"] = "FAIL"
+            errors.write(traceback.format_exc())
+        finally:
+            stdout.capture(None)
+            stderr.capture(None)
+            outcome["errors"] = errors.getvalue()
+
+    before = _metrics.snapshot() if measure else None
+    start = time.monotonic()
+    thread = threading.Thread(target=target, name=os.path.basename(script_path), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    elapsed = time.monotonic() - start
+
+    if thread.is_alive():
+        log(f"TIMEOUT: {script_path} (abandoned after {timeout}s)")
+        return "TIMEOUT", elapsed
+
+    if outcome["status"] == "SUCCESS":
+        log(f"SUCCESS: {script_path}")
+    else:
+        log(f"FAIL: {script_path}")
+        log(f"Error:\n{outcome['errors'].strip()}")
+
+    if measure and metrics_file:
+        with open(metrics_file, "w", encoding="utf-8") as f:
+            json.dump(_metrics.difference(_metrics.snapshot(), before), f)
+    return outcome["status"], elapsed
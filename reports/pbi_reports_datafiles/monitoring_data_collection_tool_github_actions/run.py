@@ -1,16 +1,32 @@
 import subprocess
 import os
+import ast
+import time
 import datetime
 import sys
-from office365.sharepoint.client_context import ClientContext
-from office365.runtime.auth.user_credential import UserCredential
+import argparse
+import atexit
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from uploader import SharePointTarget, LocalTarget, upload_outputs
+from run_report import read_script_metrics, build_report, find_regressions, load_previous_reports, save_report
 
 # Paths
 PYTHON_EXECUTABLE = sys.executable
 ROOT_DIR = "."
 SCRIPTS_DIR = os.path.join(ROOT_DIR, "scripts")
 LOG_FILE = os.path.join(ROOT_DIR, "documentation/logs", "workflow_log.txt")
+LOG_LOCK = threading.Lock()
 CREDENTIALS_FILE = os.path.join(ROOT_DIR, "sharepoint_credentials.txt")
+UPLOAD_MANIFEST = os.path.join(ROOT_DIR, "documentation/logs", "upload_manifest.json")
+RUN_REPORT_DIR = os.path.join(ROOT_DIR, "documentation/logs", "run_reports")
+
+# Scheduling defaults (overridable with --jobs / --timeout)
+DEFAULT_JOBS = 4
+DEFAULT_TIMEOUT = 1800  # seconds, per script
+DEFAULT_UPLOAD_WORKERS = 4
+DEFAULT_COMPARE_RUNS = 10
 
 # Output directory setup
 DOC_OUTPUT_PATH = os.path.join(ROOT_DIR, "documentation", "output_dir.txt")
@@ -27,26 +43,42 @@ except Exception as e:
     print(f"Warning: Failed to read output_dir.txt. Using default. Error: {e}")
     OUTPUT_DIR = DEFAULT_OUTPUT_DIR
 
+_log_handle = None
+
+
+def _close_log():
+    global _log_handle
+    with LOG_LOCK:
+        if _log_handle is not None:
+            _log_handle.close()
+            _log_handle = None
+
 
 def log(message):
     """
     Logs a timestamped message to both the console and a log file.
 
     This function prints the message to standard output and appends it to the
-    log file defined by the global LOG_FILE path. If the log file directory
-    does not exist, it is created automatically.
+    log file defined by the global LOG_FILE path. The file is opened once, on
+    the first message (creating its directory if needed), and kept open for
+    the rest of the run; it is line-buffered so every message reaches the file
+    even if the run is killed.
 
     Parameters:
         message (str): The message to be logged.
     """
+    global _log_handle
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     full_msg = f"[{timestamp}] {message}"
-    print(full_msg)
-    os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
-    with open(LOG_FILE, "a", encoding="utf-8") as f:
-        f.write(full_msg + "\n")
-
-def run_script(script_path, output_dir):
+    with LOG_LOCK:
+        print(full_msg)
+        if _log_handle is None:
+            os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+            _log_handle = open(LOG_FILE, "a", encoding="utf-8", buffering=1)
+            atexit.register(_close_log)
+        _log_handle.write(full_msg + "\n")
+
+def run_script(script_path, output_dir, timeout=None, metrics_file=None):
     """
     Executes a Python script with an output directory argument and logs the result.
 
@@ -57,20 +89,240 @@ def run_script(script_path, output_dir):
     Parameters:
         script_path (str): The path to the Python script to run.
         output_dir (str): The directory path to pass as the '--output-dir' argument.
+        timeout (int, optional): Seconds to wait before the script is killed.
+        metrics_file (str, optional): File the script writes its performance metrics
+                                      to on exit (see scripts/_metrics.py).
+
+    Returns:
+        tuple: (status, elapsed_seconds) where status is one of
+               "SUCCESS", "FAIL", "TIMEOUT" or "ERROR".
     """
+    env = dict(os.environ)
+    if metrics_file:
+        env["MONITORING_METRICS_FILE"] = os.path.abspath(metrics_file)
+    start = time.monotonic()
     try:
         subprocess.run(
             [PYTHON_EXECUTABLE, script_path, "--output-dir", output_dir],
             capture_output=True,
             text=True,
-            check=True
+            check=True,
+            timeout=timeout,
+            env=env
         )
+        status = "SUCCESS"
         log(f"SUCCESS: {script_path}")
+    except subprocess.TimeoutExpired:
+        status = "TIMEOUT"
+        log(f"TIMEOUT: {script_path} (killed after {timeout}s)")
     except subprocess.CalledProcessError as e:
+        status = "FAIL"
         log(f"FAIL: {script_path}")
         log(f"Error:\n{e.stderr.strip()}")
     except Exception as e:
+        status = "ERROR"
         log(f"ERROR: {script_path} - {str(e)}")
+    return status, time.monotonic() - start
+
+def read_script_config(script_path):
+    """
+    Reads the scheduling declarations from the top level of a script without importing it.
+
+    Scripts can declare the following module-level constants:
+        READS (list of str): Upstream tables the script reads, as "database/table".
+        WRITES (list of str): Tables the script produces for other scripts to read.
+        TIMEOUT (int): Seconds the script may run before being killed.
+
+    Only literal values are read (via `ast.literal_eval`), so the runner does not need
+    to import pandas or any other dependency of the script.
+
+    A script that defines `main(output_dir)` can also be run in-process
+    (see `inprocess.py`).
+
+    Parameters:
+        script_path (str): The path to the Python script.
+
+    Returns:
+        dict: Contains "reads", "writes", "timeout" (None if not declared) and
+              "in_process" (True if the script has the in-process entry point).
+    """
+    config = {"reads": [], "writes": [], "timeout": None, "in_process": False}
+    with open(script_path, "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read(), filename=script_path)
+
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name == "main":
+            config["in_process"] = [arg.arg for arg in node.args.args] == ["output_dir"]
+            continue
+        if not isinstance(node, ast.Assign) or len(node.targets) != 1:
+            continue
+        target = node.targets[0]
+        if not isinstance(target, ast.Name) or target.id not in ("READS", "WRITES", "TIMEOUT"):
+            continue
+        try:
+            config[target.id.lower()] = ast.literal_eval(node.value)
+        except ValueError:
+            log(f"Ignoring non-literal {target.id} in {script_path}")
+    return config
+
+def build_dependencies(configs):
+    """
+    Works out which scripts each script has to wait for.
+
+    A script depends on every other script that WRITES a table it READS. Tables
+    that no script writes are upstream (Datasette) tables and are always available.
+
+    Parameters:
+        configs (dict): Script name -> config dict from `read_script_config()`.
+
+    Returns:
+        dict: Script name -> set of script names it depends on.
+    """
+    producers = {}
+    for name, config in configs.items():
+        for table in config["writes"]:
+            producers.setdefault(table, set()).add(name)
+
+    return {
+        name: {
+            producer
+            for table in config["reads"]
+            for producer in producers.get(table, ())
+            if producer != name
+        }
+        for name, config in configs.items()
+    }
+
+def run_scripts(py_files, output_dir, jobs=DEFAULT_JOBS, timeout=DEFAULT_TIMEOUT, metrics_dir=None, context=None):
+    """
+    Runs the scripts concurrently, respecting the dependencies declared in each script.
+
+    Each script is run in its own subprocess (see `run_script()`), or, when a
+    `context` is given and the script has a `main(output_dir)` entry point,
+    in this process (see `inprocess.run_in_process()`). A thread pool of size `jobs`
+    waits on them, so at most `jobs` scripts run at once. A script is started as
+    soon as every script it depends on has finished. Dependants are still run if an
+    upstream script fails, as every script can fetch its data directly.
+
+    Parameters:
+        py_files (list of str): Script file names in the scripts directory.
+        output_dir (str): The directory path to pass as the '--output-dir' argument.
+        jobs (int): Maximum number of scripts to run at once.
+        timeout (int): Default per-script timeout in seconds, used when a script
+                       does not declare its own TIMEOUT.
+        metrics_dir (str, optional): Directory each script writes <script name>.json
+                                     metrics to.
+        context (RunContext, optional): Shared context from `inprocess.enable()`; scripts
+                                        are only run in-process when it is given.
+
+    Returns:
+        dict: Script name -> (status, elapsed_seconds).
+    """
+    configs = {
+        py_file: read_script_config(os.path.join(SCRIPTS_DIR, py_file))
+        for py_file in py_files
+    }
+    dependencies = build_dependencies(configs)
+
+    results = {}
+    pending = list(py_files)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            ready = [name for name in pending if dependencies[name] <= results.keys()]
+            for name in ready:
+                pending.remove(name)
+                script_path = os.path.join(SCRIPTS_DIR, name)
+                script_timeout = configs[name]["timeout"] or timeout
+                metrics_file = os.path.join(metrics_dir, f"{name}.json") if metrics_dir else None
+                if context is not None and configs[name]["in_process"]:
+                    from inprocess import run_in_process
+                    log(f"Running in-process: {name}")
+                    future = executor.submit(
+                        run_in_process,
+                        script_path,
+                        output_dir,
+                        script_timeout,
+                        log=log,
+                        metrics_file=metrics_file,
+                        measure=jobs == 1,
+                    )
+                else:
+                    log(f"Running: {name}")
+                    future = executor.submit(run_script, script_path, output_dir, script_timeout, metrics_file)
+                running[future] = name
+
+            if not running:
+                # Nothing can start and nothing is running: the remaining scripts wait on each other
+                for name in pending:
+                    log(f"SKIPPED: {name} - circular dependency on {sorted(dependencies[name])}")
+                    results[name] = ("SKIPPED", 0.0)
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+
+    return results
+
+def log_timing_summary(results, total_elapsed, metrics=None):
+    """
+    Logs a table of script status and run time, slowest first.
+
+    Parameters:
+        results (dict): Script name -> (status, elapsed_seconds) from `run_scripts()`.
+        total_elapsed (float): Wall-clock seconds for the whole run.
+        metrics (dict, optional): Script name -> metrics (see `run_report.read_script_metrics()`),
+                                  adding HTTP requests, MB downloaded and peak memory.
+    """
+    metrics = metrics or {}
+    width = max((len(name) for name in results), default=0)
+    log("Timing summary:")
+    for name, (status, elapsed) in sorted(results.items(), key=lambda item: -item[1][1]):
+        line = f"  {name.ljust(width)}  {status:<8} {elapsed:8.1f}s"
+        script_metrics = metrics.get(name)
+        if script_metrics:
+            fetch = script_metrics.get("phases", {}).get("fetch", {}).get("seconds", 0.0)
+            line += (
+                f"  fetch {fetch:7.1f}s"
+                f"  {script_metrics.get('http_requests', 0):5d} requests"
+                f"  {script_metrics.get('bytes_downloaded', 0) / 1024 / 1024:8.1f} MB"
+            )
+            if script_metrics.get("peak_rss_bytes"):
+                line += f"  peak {script_metrics['peak_rss_bytes'] / 1024 / 1024:7.0f} MB"
+        log(line)
+    sequential = sum(elapsed for _, elapsed in results.values())
+    log(f"  Wall time {total_elapsed:.1f}s (sum of script times {sequential:.1f}s)")
+
+def write_run_report(results, metrics, started_at, total_elapsed, compare_runs=DEFAULT_COMPARE_RUNS):
+    """
+    Writes the JSON run report and logs any regressions against earlier runs.
+
+    Each script's run time, HTTP requests, bytes downloaded, peak memory and phase
+    times are compared with the median of the previous `compare_runs` reports
+    (see `run_report.find_regressions()`).
+
+    Parameters:
+        results (dict): Script name -> (status, elapsed_seconds) from `run_scripts()`.
+        metrics (dict): Script name -> metrics written by the script.
+        started_at (datetime.datetime): When the scripts were started.
+        total_elapsed (float): Wall-clock seconds for the whole run.
+        compare_runs (int): Number of previous reports to compare with.
+
+    Returns:
+        str: Path of the report.
+    """
+    report = build_report(results, metrics, started_at, total_elapsed)
+    report["regressions"] = find_regressions(report, load_previous_reports(RUN_REPORT_DIR, compare_runs))
+    path = save_report(report, RUN_REPORT_DIR)
+    for regression in report["regressions"]:
+        log(
+            f"REGRESSION: {regression['script']} {regression['metric']} {regression['value']:.6g} "
+            f"(median of previous runs {regression['baseline']:.6g})"
+        )
+    log(f"Run report: {path} ({len(report['regressions'])} regressions)")
+    return path
 
 def ensure_folder(parts, root_folder, ctx):
     """
@@ -150,21 +402,25 @@ def get_existing_folder(ctx, base_url, parts):
             raise Exception(f"Failed to access folder: {current_path}. Error: {e}")
     return folder
 
-def upload_all_outputs_to_sharepoint(output_dir):
+def upload_all_outputs_to_sharepoint(output_dir, local_dir=None, workers=DEFAULT_UPLOAD_WORKERS):
     """
-    Uploads all CSV files from the specified output directory to SharePoint.
+    Uploads the CSV files from the specified output directory to SharePoint, skipping unchanged files.
 
     This function performs the following actions:
-    1. Authenticates with SharePoint using credentials from a local file.
-    2. Uploads all `.csv` files from `output_dir` to the base SharePoint folder:
-       `/20. Data Management/Reporting/Data files`.
-    3. Creates a dated archive folder inside `.../Data files/old files/` using the current date.
-    4. Uploads a copy of each `.csv` file to this dated archive folder for record-keeping.
-
+    1. Authenticates with SharePoint using credentials from environment variables
+       (or, with `local_dir`, uses a local directory in place of SharePoint).
+    2. Creates a dated archive folder inside `.../Data files/old files/` using the current date.
+    3. Uploads each `.csv` file whose content has changed since the last upload (see
+       UPLOAD_MANIFEST) to the base SharePoint folder: `/20. Data Management/Reporting/Data files`.
+    4. Copies each file from the base folder into the dated archive folder for record-keeping.
+
+    Files are handled in parallel; see `uploader.upload_outputs()`.
     If the "old files" or dated archive folders already exist, they are reused.
 
     Parameters:
         output_dir (str): Local directory path containing the CSV files to upload.
+        local_dir (str, optional): Local directory standing in for SharePoint (for testing).
+        workers (int): Number of files uploaded at once.
 
     Raises:
         Exception: If the base SharePoint folder cannot be accessed.
@@ -173,60 +429,91 @@ def upload_all_outputs_to_sharepoint(output_dir):
     parent_url = "/sites/DigitalPlanning/Shared Documents/20. Data Management/Reporting/Data files"
     old_files_folder_name = "old files"
 
-    username = os.getenv("SHAREPOINT_USERNAME")
-    password = os.getenv("SHAREPOINT_PASSWORD")
-    if not username or not password:
-        raise Exception("Missing SharePoint credentials in environment variables")
+    if local_dir:
+        target = LocalTarget(local_dir)
+        manifest_path = os.path.join(local_dir, "upload_manifest.json")
+    else:
+        username = os.getenv("SHAREPOINT_USERNAME")
+        password = os.getenv("SHAREPOINT_PASSWORD")
+        if not username or not password:
+            raise Exception("Missing SharePoint credentials in environment variables")
 
-    site_url = "https://mhclg.sharepoint.com/sites/DigitalPlanning"
-    ctx = ClientContext(site_url).with_credentials(UserCredential(username, password))
+        site_url = "https://mhclg.sharepoint.com/sites/DigitalPlanning"
+        target = SharePointTarget(site_url, username, password)
+        manifest_path = UPLOAD_MANIFEST
 
-    # Load base folder (parent)
+    # Check base folder (parent)
     try:
-        base_folder = ctx.web.get_folder_by_server_relative_url(parent_url)
-        ctx.load(base_folder)
-        ctx.execute_query()
+        target.check_folder(parent_url)
     except Exception as e:
         raise Exception(f"Cannot access base folder.\nURL: {parent_url}\nError: {e}")
 
     # Ensure "old files" folder exists
     old_files_url = f"{parent_url}/{old_files_folder_name}"
-    try:
-        ctx.web.folders.add(old_files_url).execute_query()
+    if target.ensure_folder(old_files_url):
         log(f"Created 'old files' folder: {old_files_url}")
-    except Exception:
+    else:
         log(f"'old files' folder already exists.")
 
     # Create today's dated folder inside "old files"
     dated_folder_url = f"{old_files_url}/{today_str}"
-    try:
-        ctx.web.folders.add(dated_folder_url).execute_query()
+    if target.ensure_folder(dated_folder_url):
         log(f"Created dated archive folder: {dated_folder_url}")
-    except Exception:
+    else:
         log(f"Dated archive folder already exists: {dated_folder_url}")
 
-    # Load both folders
-    base_upload_folder = ctx.web.get_folder_by_server_relative_url(parent_url)
-    archive_folder = ctx.web.get_folder_by_server_relative_url(dated_folder_url)
-    ctx.load(base_upload_folder)
-    ctx.load(archive_folder)
-    ctx.execute_query()
-
-    # Upload each CSV to both base and archive folders
-    for file in os.listdir(output_dir):
-        if file.endswith(".csv"):
-            file_path = os.path.join(output_dir, file)
-            log(f"Uploading '{file}' to base folder and archive folder...")
-            try:
-                with open(file_path, "rb") as f:
-                    content = f.read()
-                base_upload_folder.upload_file(file, content).execute_query()
-                archive_folder.upload_file(file, content).execute_query()
-                log(f"Uploaded: {file}")
-            except Exception as e:
-                log(f"Failed to upload '{file}': {e}")
-
-    log(f"All files uploaded to base and archived in 'old files/{today_str}'.")
+    # Upload changed CSVs to the base folder and copy each into the archive folder
+    results = upload_outputs(target, output_dir, parent_url, dated_folder_url, manifest_path, log=log, workers=workers)
+    counts = {status: list(results.values()).count(status) for status in ("uploaded", "unchanged", "failed")}
+    log(
+        f"Uploaded {counts['uploaded']} changed files ({counts['unchanged']} unchanged, {counts['failed']} failed); "
+        f"archived in 'old files/{today_str}'."
+    )
+
+def parse_args():
+    """
+    Parses command-line arguments for the runner.
+
+    Returns:
+        argparse.Namespace: Contains the number of parallel jobs, the default per-script timeout
+                            and the upload options.
+    """
+    parser = argparse.ArgumentParser(description="Run the monitoring scripts and upload outputs to SharePoint")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=DEFAULT_JOBS,
+        help=f"Maximum number of scripts to run at once (default: {DEFAULT_JOBS})"
+    )
+    parser.add_argument(
+        "--timeout",
+        type=int,
+        default=DEFAULT_TIMEOUT,
+        help=f"Seconds a script may run before it is killed, unless it declares TIMEOUT (default: {DEFAULT_TIMEOUT})"
+    )
+    parser.add_argument(
+        "--upload-workers",
+        type=int,
+        default=DEFAULT_UPLOAD_WORKERS,
+        help=f"Number of files uploaded to SharePoint at once (default: {DEFAULT_UPLOAD_WORKERS})"
+    )
+    parser.add_argument(
+        "--sharepoint-dir",
+        type=str,
+        help="Upload to this local directory instead of SharePoint (for testing)"
+    )
+    parser.add_argument(
+        "--compare-runs",
+        type=int,
+        default=DEFAULT_COMPARE_RUNS,
+        help=f"Number of previous run reports to check this run against for regressions (default: {DEFAULT_COMPARE_RUNS})"
+    )
+    parser.add_argument(
+        "--in-process",
+        action="store_true",
+        help="Run scripts that define main(output_dir) in this process, sharing loaded tables"
+    )
+    return parser.parse_args()
 
 def main():
     """
@@ -237,13 +524,19 @@ def main():
     2. Verifies the existence of the `scripts` directory.
     3. Creates the output directory if it does not exist.
     4. Identifies all Python scripts (excluding those starting with "_") in the `scripts` directory.
-    5. Executes each script using `run_script()`, passing the output directory as an argument.
-    6. Once all scripts are executed, uploads all generated CSV files to SharePoint using
+    5. Executes the scripts in parallel using `run_scripts()`, passing the output directory as
+       an argument. Scripts that read a table another script writes wait for it to finish.
+       With --in-process, scripts are run in this process and share loaded tables.
+    6. Logs a timing summary for every script and writes a JSON run report of each script's
+       performance metrics, flagging regressions against previous runs.
+    7. Loads the outputs into the local warehouse (see `warehouse.py`), partitioned by run date.
+    8. Once all scripts are executed, uploads all generated CSV files to SharePoint using
        `upload_all_outputs_to_sharepoint()`.
-    7. Logs completion status and any errors during script execution or upload.
+    9. Logs completion status and any errors during script execution or upload.
 
     This function is intended to be the main entry point of the workflow.
     """
+    args = parse_args()
     log("Starting workflow...")
 
     if not os.path.exists(SCRIPTS_DIR):
@@ -261,13 +554,41 @@ def main():
         log("No Python scripts found in scripts directory.")
         return
 
-    for py_file in py_files:
-        full_path = os.path.join(SCRIPTS_DIR, py_file)
-        log(f"Running: {py_file}")
-        run_script(full_path, OUTPUT_DIR)
+    context = None
+    if args.in_process:
+        import inprocess
+        context = inprocess.enable(SCRIPTS_DIR)
+
+    started_at = datetime.datetime.now()
+    start = time.monotonic()
+    try:
+        with tempfile.TemporaryDirectory() as metrics_dir:
+            results = run_scripts(
+                py_files, OUTPUT_DIR, jobs=max(1, args.jobs), timeout=args.timeout,
+                metrics_dir=metrics_dir, context=context
+            )
+            metrics = {name: read_script_metrics(os.path.join(metrics_dir, f"{name}.json")) for name in results}
+    finally:
+        if context is not None:
+            inprocess.disable(context)
+    total_elapsed = time.monotonic() - start
+    log_timing_summary(results, total_elapsed, metrics)
+
+    try:
+        write_run_report(results, metrics, started_at, total_elapsed, compare_runs=args.compare_runs)
+    except Exception as e:
+        log(f"Failed to write the run report: {e}")
+
+    # Keep a copy of this run's outputs in the local warehouse for trend queries
+    try:
+        from warehouse import load_run_outputs, WAREHOUSE_PATH
+        loaded = load_run_outputs(OUTPUT_DIR)
+        log(f"Loaded {len(loaded)} outputs into the warehouse: {WAREHOUSE_PATH}")
+    except Exception as e:
+        log(f"Failed to load outputs into the warehouse: {e}")
 
     log("All scripts complete. Uploading to SharePoint...")
-    upload_all_outputs_to_sharepoint(OUTPUT_DIR)
+    upload_all_outputs_to_sharepoint(OUTPUT_DIR, local_dir=args.sharepoint_dir, workers=max(1, args.upload_workers))
     log("Workflow complete.")
 
 
@@ -0,0 +1,204 @@
+"""
+JSON report of each run's per-script performance, compared with earlier runs.
+
+Every script writes its metrics (see scripts/_metrics.py) to a file named by
+run.py. The report combines them with each script's status and run time:
+
+    {
+        "started_at": "2025-06-01T06:00:00",
+        "wall_seconds": 812.4,
+        "scripts": {
+            "runaway_resources.py": {
+                "status": "SUCCESS",
+                "elapsed_seconds": 41.2,
+                "http_requests": 3,
+                "bytes_downloaded": 1843200,
+                "cache_hits": 1,
+                "peak_rss_bytes": 402653184,
+                "phases": {"fetch": {"seconds": 30.1, "count": 4, "rows": 51234}, ...}
+            },
+            ...
+        },
+        "regressions": [...]
+    }
+
+A metric is flagged as a regression when it exceeds the median of the previous
+runs by both the ratio and the minimum increase in REGRESSION_THRESHOLDS, so
+small scripts do not get flagged for noise.
+"""
+
+import os
+import json
+import datetime
+import statistics
+
+# Metric -> (ratio to the baseline, minimum absolute increase)
+REGRESSION_THRESHOLDS = {
+    "elapsed_seconds": (1.5, 30),
+    "peak_rss_bytes": (1.5, 100 * 1024 * 1024),
+    "bytes_downloaded": (2.0, 50 * 1024 * 1024),
+    "http_requests": (2.0, 50),
+    "phase_seconds": (1.5, 30),
+}
+
+# Previous runs a script needs before it is compared
+MIN_HISTORY = 3
+
+# Reports kept in the report directory
+KEEP_REPORTS = 90
+
+
+def read_script_metrics(path):
+    """
+    Reads the metrics a script wrote on exit.
+
+    Parameters:
+        path (str): Metrics file passed to the script.
+
+    Returns:
+        dict: The metrics, or an empty dict if the script wrote none (e.g. it was killed).
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def build_report(results, metrics, started_at, wall_seconds):
+    """
+    Builds the run report.
+
+    Parameters:
+        results (dict): Script name -> (status, elapsed_seconds) from `run.run_scripts()`.
+        metrics (dict): Script name -> metrics from `read_script_metrics()`.
+        started_at (datetime.datetime): When the scripts were started.
+        wall_seconds (float): Wall-clock seconds for the whole run.
+
+    Returns:
+        dict: The report, without regressions.
+    """
+    scripts = {}
+    for name, (status, elapsed) in results.items():
+        script_metrics = metrics.get(name, {})
+        scripts[name] = {
+            "status": status,
+            "elapsed_seconds": round(elapsed, 3),
+            "http_requests": script_metrics.get("http_requests"),
+            "bytes_downloaded": script_metrics.get("bytes_downloaded"),
+            "cache_hits": script_metrics.get("cache_hits"),
+            "peak_rss_bytes": script_metrics.get("peak_rss_bytes"),
+            "phases": {
+                phase: {**values, "seconds": round(values["seconds"], 3)}
+                for phase, values in script_metrics.get("phases", {}).items()
+            },
+        }
+    return {
+        "started_at": started_at.isoformat(timespec="seconds"),
+        "wall_seconds": round(wall_seconds, 3),
+        "scripts": scripts,
+    }
+
+
+def _comparable_values(script):
+    """
+    Flattens a script's entry into metric name -> (threshold key, value).
+    """
+    values = {
+        metric: (metric, script.get(metric))
+        for metric in ("elapsed_seconds", "peak_rss_bytes", "bytes_downloaded", "http_requests")
+    }
+    for phase, phase_values in script.get("phases", {}).items():
+        values[f"{phase}_seconds"] = ("phase_seconds", phase_values.get("seconds"))
+    return values
+
+
+def find_regressions(report, previous):
+    """
+    Compares each successful script with the median of its successful previous runs.
+
+    Parameters:
+        report (dict): This run's report from `build_report()`.
+        previous (list of dict): Earlier reports, e.g. from `load_previous_reports()`.
+
+    Returns:
+        list of dict: One entry per regressed metric, with the script, metric,
+                      value, baseline (median) and ratio.
+    """
+    regressions = []
+    for name, script in report["scripts"].items():
+        if script["status"] != "SUCCESS":
+            continue
+        history = [
+            earlier["scripts"][name] for earlier in previous
+            if earlier.get("scripts", {}).get(name, {}).get("status") == "SUCCESS"
+        ]
+        if len(history) < MIN_HISTORY:
+            continue
+        for metric, (threshold_key, value) in _comparable_values(script).items():
+            past = [
+                _comparable_values(earlier).get(metric, (None, None))[1] for earlier in history
+            ]
+            past = [v for v in past if v is not None]
+            if value is None or len(past) < MIN_HISTORY:
+                continue
+            baseline = statistics.median(past)
+            ratio, min_increase = REGRESSION_THRESHOLDS[threshold_key]
+            if value > baseline * ratio and value - baseline > min_increase:
+                regressions.append({
+                    "script": name,
+                    "metric": metric,
+                    "value": value,
+                    "baseline": baseline,
+                    "ratio": round(value / baseline, 2) if baseline else None,
+                })
+    return regressions
+
+
+def load_previous_reports(directory, count):
+    """
+    Loads the most recent reports, oldest first.
+
+    Parameters:
+        directory (str): Report directory.
+        count (int): Number of reports to load.
+
+    Returns:
+        list of dict: The reports (unreadable files are skipped).
+    """
+    if count <= 0 or not os.path.isdir(directory):
+        return []
+    files = sorted(f for f in os.listdir(directory) if f.startswith("run_") and f.endswith(".json"))
+    reports = []
+    for file in files[-count:]:
+        try:
+            with open(os.path.join(directory, file), "r", encoding="utf-8") as f:
+                reports.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return reports
+
+
+def save_report(report, directory, keep=KEEP_REPORTS):
+    """
+    Writes the report as run_<timestamp>.json and removes reports beyond the newest `keep`.
+
+    Parameters:
+        report (dict): The report.
+        directory (str): Report directory.
+        keep (int): Number of reports to keep.
+
+    Returns:
+        str: Path of the written report.
+    """
+    os.makedirs(directory, exist_ok=True)
+    started_at = datetime.datetime.fromisoformat(report["started_at"])
+    path = os.path.join(directory, f"run_{started_at.strftime('%Y-%m-%dT%H-%M-%S')}.json")
+    with open(path + ".part", "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    os.replace(path + ".part", path)
+
+    files = sorted(f for f in os.listdir(directory) if f.startswith("run_") and f.endswith(".json"))
+    for file in files[:-keep]:
+        os.remove(os.path.join(directory, file))
+    return path
@@ -0,0 +1,80 @@
+"""
+Shared state for scripts run in one process by `run.py --in-process`.
+
+Scripts run in-process import the same helper modules, so they already share
+the pooled Datasette session and the on-disk cache. The RunContext keeps tables
+loaded with `_snapshot.load_table()` in memory: the first script to load a table
+(with a given set of columns and filters) reads it, and later scripts get a copy,
+so one script's changes to its frame never reach another script.
+
+Scripts do not use the context themselves: `load_table()` finds the active one
+with `current_context()`. When a script is run on its own there is no context
+and every table is read as usual.
+"""
+
+import threading
+
+_current = None
+
+
+class RunContext:
+    """
+    State shared by the scripts of one in-process run.
+
+    Attributes:
+        tables (dict): Key -> DataFrame of the tables loaded so far.
+    """
+
+    def __init__(self):
+        self.tables = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def shared_table(self, key, load):
+        """
+        Returns a copy of a shared table, loading it the first time it is asked for.
+
+        Scripts asking for the same key at the same time wait for one load.
+
+        Args:
+            key (tuple): Identifies the table, including any columns and filters.
+            load (callable): Returns the DataFrame when it is not loaded yet.
+
+        Returns:
+            pd.DataFrame: A copy the caller may modify.
+        """
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self.tables:
+                self.tables[key] = load()
+            return self.tables[key].copy()
+
+    def clear(self):
+        """
+        Drops the loaded tables, e.g. once every script has finished.
+        """
+        with self._lock:
+            self.tables.clear()
+            self._key_locks.clear()
+
+
+def activate(context):
+    """
+    Makes a context the one used by the helper modules (None to deactivate).
+
+    Args:
+        context (RunContext | None): The context for this process.
+    """
+    global _current
+    _current = context
+
+
+def current_context():
+    """
+    Returns the active context, or None when scripts run on their own.
+
+    Returns:
+        RunContext | None: The active context.
+    """
+    return _current
@@ -0,0 +1,377 @@
+"""
+Shared Datasette client for the monitoring scripts.
+
+All queries made by a process go through the pooled, keep-alive session from the
+`datasette_client` package, so repeated queries reuse a handful of connections
+instead of paying a new TLS handshake each time. Files starting with "_" are not
+run by run.py.
+
+The pool size can be set with the DATASETTE_POOL_SIZE environment variable or
+with `configure_datasette_http()`. Responses are kept in the on-disk cache from
+`_http_cache`, so a table read by several scripts in a run is downloaded once.
+Every fetch is recorded as a "fetch" span in `_metrics` for the run report.
+"""
+
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from datasette_client import (
+    DATASETTE_URL,
+    REQUEST_TIMEOUT,
+    configure_datasette_http,
+    get_datasette_http,
+)
+from _http_cache import get_default_cache
+from _metrics import span, record_http
+
+# Maximum rows Datasette returns for one SQL query
+PAGE_SIZE = 1000
+
+
+def _cached_body_path(url, params):
+    """
+    Returns the path of the cached body for a GET request, or None if caching is disabled.
+    """
+    cache = get_default_cache()
+    if cache is None:
+        return None
+    return cache.fetch(get_datasette_http(), url, params, timeout=REQUEST_TIMEOUT)
+
+
+def get_datasette_json(db, sql, params=None, url=DATASETTE_URL, use_cache=True):
+    """
+    Executes SQL against a Datasette database and returns the decoded JSON response.
+
+    Args:
+        db (str): The database name (e.g. 'digital-land').
+        sql (str): SQL query string.
+        params (dict, optional): Additional query parameters (e.g. {"_shape": "array"}).
+        url (str): Base Datasette URL.
+        use_cache (bool): Serve from / store in the on-disk cache.
+
+    Returns:
+        dict | list: The JSON body, shaped according to the `_shape` parameter.
+
+    Raises:
+        requests.HTTPError: If the final response is not successful.
+    """
+    query_params = {"sql": sql}
+    if params:
+        query_params.update(params)
+    with span("fetch") as record:
+        path = _cached_body_path(f"{url}/{db}.json", query_params) if use_cache else None
+        if path:
+            with open(path, "r", encoding="utf-8") as f:
+                body = json.load(f)
+        else:
+            response = get_datasette_http().get(f"{url}/{db}.json", params=query_params, timeout=REQUEST_TIMEOUT)
+            record_http(bytes_downloaded=len(response.content))
+            response.raise_for_status()
+            body = response.json()
+        record["rows"] = len(body) if isinstance(body, list) else len(body.get("rows", []))
+    return body
+
+
+def get_datasette_query(db, sql, filter=None, url=DATASETTE_URL):
+    """
+    Executes SQL against a Datasette database and returns the result as a DataFrame.
+
+    Args:
+        db (str): The database name (e.g. 'digital-land').
+        sql (str): SQL query string.
+        filter (dict, optional): Additional query parameters.
+        url (str): Base Datasette URL.
+
+    Returns:
+        pd.DataFrame: The result set, or an empty DataFrame on error.
+    """
+    params = {"_shape": "array", "_size": "max"}
+    if filter:
+        params.update(filter)
+    try:
+        return pd.DataFrame.from_dict(get_datasette_json(db, sql, params, url=url))
+    except Exception as e:
+        logging.warning(f"Datasette query failed: {e}")
+        return pd.DataFrame()
+
+
+def table_csv_url(db, table, url=DATASETTE_URL):
+    """
+    Returns the streaming CSV export URL for a whole Datasette table.
+
+    Args:
+        db (str): The database name (e.g. 'digital-land').
+        table (str): The table name (e.g. 'endpoint').
+        url (str): Base Datasette URL.
+
+    Returns:
+        str: URL of the full table as CSV.
+    """
+    return f"{url}/{db}/{table}.csv?_stream=on"
+
+
+def read_datasette_csv(url, params=None, use_cache=True, **kwargs):
+    """
+    Streams a CSV from Datasette (or any URL) through the shared session into a DataFrame.
+
+    A drop-in for `pd.read_csv(url)` that reuses pooled connections and retries,
+    and reads from the on-disk cache when the same URL was fetched recently.
+
+    Args:
+        url (str): CSV URL, e.g. from `table_csv_url()`.
+        params (dict, optional): Query parameters to add to the URL.
+        use_cache (bool): Serve from / store in the on-disk cache.
+        **kwargs: Passed through to `pd.read_csv`.
+
+    Returns:
+        pd.DataFrame: The parsed CSV.
+
+    Raises:
+        requests.HTTPError: If the final response is not successful.
+    """
+    with span("fetch") as record:
+        path = _cached_body_path(url, params) if use_cache else None
+        if path:
+            df = pd.read_csv(path, **kwargs)
+        else:
+            with get_datasette_http().get(url, params=params, stream=True, timeout=REQUEST_TIMEOUT) as response:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                df = pd.read_csv(response.raw, **kwargs)
+                record_http(bytes_downloaded=response.raw.tell())
+        record["rows"] = len(df)
+    return df
+
+
+def _sql_literal(value):
+    """
+    Formats a key value returned by Datasette as an SQL literal.
+
+    Args:
+        value: An int, float, str or None from a JSON result row.
+
+    Returns:
+        str: The value as it should appear in SQL.
+    """
+    if value is None:
+        return "NULL"
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return repr(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _keyset_sql(sql, key, page_size, after=None, upto=None):
+    """
+    Wraps a query so it returns one page of rows ordered by the key column.
+
+    Args:
+        sql (str): The SELECT to page through.
+        key (str): Key column name in the result of `sql`.
+        page_size (int): Maximum rows in the page.
+        after (optional): Only return rows with a key greater than this.
+        upto (optional): Only return rows with a key less than or equal to this.
+
+    Returns:
+        str: SQL for the page.
+    """
+    conditions = []
+    if after is not None:
+        conditions.append(f"{key} > {_sql_literal(after)}")
+    if upto is not None:
+        conditions.append(f"{key} <= {_sql_literal(upto)}")
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    return f"SELECT * FROM ({sql}) {where} ORDER BY {key} LIMIT {page_size}"
+
+
+def _page_boundaries(db, sql, key, page_size, url):
+    """
+    Finds the key of every `page_size`-th row, so pages can be fetched independently.
+
+    Datasette caps this result like any other, so for very large results the
+    boundaries only cover the first `PAGE_SIZE` pages; the rest is paged sequentially.
+
+    Returns:
+        list: The last key of each full page, in key order.
+    """
+    boundary_sql = f"""
+        SELECT {key} FROM (
+            SELECT {key}, ROW_NUMBER() OVER (ORDER BY {key}) AS _page_row
+            FROM ({sql})
+        )
+        WHERE _page_row % {page_size} = 0
+        ORDER BY {key}
+    """
+    rows = get_datasette_json(db, boundary_sql, {"_shape": "array", "_size": "max"}, url=url)
+    return [row[key] for row in rows]
+
+
+def get_datasette_query_paged(db, sql, key="rowid", page_size=PAGE_SIZE, workers=4, drop_key=False, url=DATASETTE_URL):
+    """
+    Executes SQL against a Datasette database, paging with a key instead of LIMIT/OFFSET.
+
+    Each page asks for rows with a key greater than the last key already seen, so
+    the server seeks straight to the page rather than rescanning every earlier row.
+    The key must be a single column, unique per result row and selected by `sql`,
+    that Datasette can seek on (such as a table's rowid). `sql` must not have its
+    own ORDER BY or LIMIT. For joins, use `get_datasette_join_paged` instead.
+
+    When `workers` > 1 the page boundaries are looked up first and the pages are
+    fetched concurrently. If that lookup fails, pages are fetched one at a time.
+
+    Args:
+        db (str): The database name (e.g. 'performance').
+        sql (str): SELECT statement that includes the key column.
+        key (str): Unique key column name in the result.
+        page_size (int): Rows per request; must not exceed Datasette's row limit.
+        workers (int): Number of pages fetched at once.
+        drop_key (bool): Remove the key column from the returned DataFrame.
+        url (str): Base Datasette URL.
+
+    Returns:
+        pd.DataFrame: All rows, ordered by key.
+
+    Raises:
+        requests.HTTPError: If a page cannot be fetched, so results are never silently truncated.
+    """
+    params = {"_shape": "array", "_size": "max"}
+
+    def fetch(after, upto):
+        return get_datasette_json(db, _keyset_sql(sql, key, page_size, after, upto), params, url=url)
+
+    rows = []
+    after = None
+    if workers > 1:
+        try:
+            boundaries = _page_boundaries(db, sql, key, page_size, url)
+        except Exception as e:
+            logging.warning(f"Could not find page boundaries, paging sequentially: {e}")
+            boundaries = []
+        if boundaries:
+            ranges = list(zip([None] + boundaries[:-1], boundaries))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for page in executor.map(lambda r: fetch(*r), ranges):
+                    rows.extend(page)
+            after = boundaries[-1]
+
+    # Remaining rows after the last known boundary
+    while True:
+        page = fetch(after, None)
+        rows.extend(page)
+        if len(page) < page_size:
+            break
+        after = page[-1][key]
+
+    df = pd.DataFrame.from_dict(rows)
+    if drop_key:
+        df = df.drop(columns=[key], errors="ignore")
+    return df
+
+
+def _rowid_where(where, after=None, upto=None):
+    """
+    Builds the WHERE clause selecting a table's rows in a rowid range.
+
+    Args:
+        where (str, optional): Extra condition on the table's own columns.
+        after (int, optional): Only rows with a rowid greater than this.
+        upto (int, optional): Only rows with a rowid less than or equal to this.
+
+    Returns:
+        str: The clause, or an empty string if there is no condition.
+    """
+    conditions = []
+    if after is not None:
+        conditions.append(f"rowid > {int(after)}")
+    if upto is not None:
+        conditions.append(f"rowid <= {int(upto)}")
+    if where:
+        conditions.append(f"({where})")
+    return "WHERE " + " AND ".join(conditions) if conditions else ""
+
+
+def _rowid_ranges(db, table, where, page_size, url):
+    """
+    Splits a table's rows into rowid ranges of `page_size` rows each.
+
+    Only the table itself is read, in rowid order, so this is cheap however
+    expensive the query joined to it is. Datasette caps each answer at its row
+    limit, so the boundaries are looked up again after the last one until the
+    whole table is covered.
+
+    Returns:
+        list of tuple: (after, upto) rowid ranges in rowid order; the first starts at None.
+    """
+    ranges = []
+    after = None
+    while True:
+        boundary_sql = f"""
+            SELECT _page_upto FROM (
+                SELECT rowid AS _page_upto,
+                       ROW_NUMBER() OVER (ORDER BY rowid) AS _page_row,
+                       COUNT(*) OVER () AS _page_rows
+                FROM {table}
+                {_rowid_where(where, after)}
+            )
+            WHERE _page_row % {page_size} = 0 OR _page_row = _page_rows
+            ORDER BY _page_upto
+        """
+        body = get_datasette_json(db, boundary_sql, {"_shape": "objects", "_size": "max"}, url=url)
+        boundaries = [row["_page_upto"] for row in body["rows"]]
+        for upto in boundaries:
+            ranges.append((after, upto))
+            after = upto
+        if not body.get("truncated") or not boundaries:
+            return ranges
+
+
+def get_datasette_join_paged(db, sql, table, where=None, page_size=PAGE_SIZE, workers=4, url=DATASETTE_URL):
+    """
+    Executes a join against a Datasette database, paging on the rowid of its driving table.
+
+    `sql` names the driving table as `{page}` (e.g. "FROM {page} e LEFT JOIN source s
+    ON ..."). Each page replaces it with the table's rows in one rowid range, so the
+    server seeks to those rows and joins only them, and never sorts the joined result.
+    The ranges come from the driving table alone. `where` filters the driving table
+    before it is split into pages; conditions on joined tables belong in `sql`.
+
+    A page whose joined rows exceed Datasette's row limit is split in half by rowid
+    and fetched again.
+
+    Args:
+        db (str): The database name (e.g. 'performance').
+        sql (str): SELECT statement reading the driving table as `{page}`, with no
+            ORDER BY or LIMIT of its own.
+        table (str): Name of the driving table.
+        where (str, optional): Condition on the driving table's own columns.
+        page_size (int): Driving table rows per request.
+        workers (int): Number of pages fetched at once.
+        url (str): Base Datasette URL.
+
+    Returns:
+        pd.DataFrame: All rows, page by page in rowid order of the driving table.
+
+    Raises:
+        requests.HTTPError: If a page cannot be fetched.
+        RuntimeError: If a single driving table row joins to more rows than Datasette returns,
+            so results are never silently truncated.
+    """
+    params = {"_shape": "objects", "_size": "max"}
+
+    def fetch(after, upto):
+        page_sql = sql.replace("{page}", f"(SELECT * FROM {table} {_rowid_where(where, after, upto)})")
+        body = get_datasette_json(db, page_sql, params, url=url)
+        if not body.get("truncated"):
+            return body["rows"]
+        low = 0 if after is None else after
+        if upto - low <= 1:
+            raise RuntimeError(f"{table} row {upto} joins to more rows than Datasette returns")
+        middle = (low + upto) // 2
+        return fetch(after, middle) + fetch(middle, upto)
+
+    ranges = _rowid_ranges(db, table, where, page_size, url)
+    rows = []
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for page in executor.map(lambda r: fetch(*r), ranges):
+            rows.extend(page)
+    return pd.DataFrame.from_dict(rows)
@@ -0,0 +1,185 @@
+"""
+Local index of entity metadata (without geometry) for the spatial datasets.
+
+Full entity tables carry a WKT geometry per row, which makes them by far the
+largest downloads. The index keeps just name, organisation_entity, entry_date
+and end_date per (dataset, entity) in an SQLite file under the incremental
+store directory:
+
+- the first refresh of a dataset streams its entity table without geometry
+- later refreshes only fetch entities with an entry_date on or after the newest
+  one already indexed
+- a full refresh is made once the last one is older than ENTITY_INDEX_MAX_AGE,
+  so entities that were removed upstream drop out
+
+Geometries are fetched from Datasette only for the entities that need them.
+
+Settings (environment variables):
+    ENTITY_INDEX_MAX_AGE    seconds between full refreshes (default: 604800)
+"""
+
+import os
+import time
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from _datasette import get_datasette_json, read_datasette_csv, table_csv_url, DATASETTE_URL
+from _incremental import STORE_DIR
+
+ENTITY_INDEX_MAX_AGE = int(os.getenv("ENTITY_INDEX_MAX_AGE", str(7 * 24 * 60 * 60)))
+
+# Columns kept per entity ("entity" is the key)
+INDEX_COLUMNS = ["name", "organisation_entity", "entry_date", "end_date"]
+
+# Entities per lookup / geometry request (below SQLite's and Datasette's limits)
+BATCH_SIZE = 500
+
+
+def _batches(values, size=BATCH_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def fetch_geometries(dataset, entities, workers=4, url=DATASETTE_URL):
+    """
+    Fetches the geometry of the given entities only.
+
+    Args:
+        dataset (str): Dataset (and Datasette database) name, e.g. 'tree'.
+        entities (iterable of int): Entity numbers.
+        workers (int): Number of requests made at once.
+        url (str): Base Datasette URL.
+
+    Returns:
+        dict: entity -> WKT geometry (None where the entity has none).
+
+    Raises:
+        requests.HTTPError: If a batch cannot be fetched.
+    """
+    def fetch(batch):
+        sql = f"SELECT entity, geometry FROM entity WHERE entity IN ({', '.join(str(int(e)) for e in batch)})"
+        return get_datasette_json(dataset, sql, {"_shape": "array", "_size": "max"}, url=url)
+
+    geometries = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for rows in executor.map(fetch, _batches(sorted(set(entities)))):
+            geometries.update((row["entity"], row["geometry"]) for row in rows)
+    return geometries
+
+
+class EntityIndex:
+    """
+    SQLite index of entity metadata keyed by (dataset, entity).
+
+    Args:
+        path (str): Location of the index database.
+    """
+
+    def __init__(self, path=os.path.join(STORE_DIR, "entity_index.sqlite")):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entity (
+                    dataset TEXT,
+                    entity INTEGER,
+                    name TEXT,
+                    organisation_entity REAL,
+                    entry_date TEXT,
+                    end_date TEXT,
+                    PRIMARY KEY (dataset, entity)
+                )
+                """
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS refresh (dataset TEXT PRIMARY KEY, full_refresh_at REAL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def refresh(self, dataset, full=False):
+        """
+        Brings the index up to date for one dataset.
+
+        Args:
+            dataset (str): Dataset (and Datasette database) name, e.g. 'tree'.
+            full (bool): Refetch every entity even if the last full refresh is recent.
+
+        Returns:
+            int: Number of entities fetched.
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT full_refresh_at FROM refresh WHERE dataset = ?", (dataset,)).fetchone()
+            watermark = conn.execute(
+                "SELECT MAX(entry_date) FROM entity WHERE dataset = ?", (dataset,)
+            ).fetchone()[0]
+        if full or row is None or time.time() - row[0] > ENTITY_INDEX_MAX_AGE:
+            watermark = None
+
+        # Table export without geometry (the key column is always included)
+        csv_url = table_csv_url(dataset, "entity") + "".join(f"&_col={column}" for column in INDEX_COLUMNS)
+        params = {"entry_date__gte": watermark} if watermark else None
+        df = read_datasette_csv(csv_url, params=params, dtype={"name": str, "entry_date": str, "end_date": str})
+        df = df[["entity"] + INDEX_COLUMNS]
+        df = df.astype(object).where(df.notna(), None)
+
+        with self._connect() as conn:
+            if watermark is None:
+                conn.execute("DELETE FROM entity WHERE dataset = ?", (dataset,))
+                conn.execute("INSERT OR REPLACE INTO refresh VALUES (?, ?)", (dataset, time.time()))
+            conn.executemany(
+                "INSERT OR REPLACE INTO entity VALUES (?, ?, ?, ?, ?, ?)",
+                ((dataset, *values) for values in df.itertuples(index=False, name=None)),
+            )
+        print(f"[INFO] Entity index {dataset}: {len(df)} entities {'since ' + watermark if watermark else 'indexed'}")
+        return len(df)
+
+    def lookup(self, dataset, entities):
+        """
+        Returns the indexed metadata for the given entities of one dataset.
+
+        Args:
+            dataset (str): Dataset name.
+            entities (iterable of int): Entity numbers; ones not in the index are left out.
+
+        Returns:
+            pd.DataFrame: entity, dataset and INDEX_COLUMNS.
+        """
+        columns = ["entity", "dataset"] + INDEX_COLUMNS
+        frames = []
+        with self._connect() as conn:
+            for batch in _batches(sorted(set(int(e) for e in entities))):
+                sql = f"""
+                    SELECT {', '.join(columns)} FROM entity
+                    WHERE dataset = ? AND entity IN ({', '.join('?' * len(batch))})
+                """
+                frames.append(pd.read_sql_query(sql, conn, params=[dataset, *batch]))
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(frames, ignore_index=True)
+
+    def entities(self, keys, geometry=True):
+        """
+        Returns metadata (and optionally geometry) for a set of (dataset, entity) keys.
+
+        Args:
+            keys (pd.DataFrame): 'dataset' and 'entity' columns; duplicates and missing entities are ignored.
+            geometry (bool): Also fetch each entity's geometry from Datasette.
+
+        Returns:
+            pd.DataFrame: One row per indexed entity, with a 'geometry' column if requested.
+        """
+        keys = keys.dropna().drop_duplicates()
+        frames = []
+        for dataset, group in keys.groupby("dataset"):
+            df = self.lookup(dataset, group["entity"])
+            if geometry:
+                geometries = fetch_geometries(dataset, df["entity"])
+                df["geometry"] = df["entity"].map(geometries)
+            frames.append(df)
+        columns = ["entity", "dataset"] + INDEX_COLUMNS + (["geometry"] if geometry else [])
+        df = pd.concat(frames, ignore_index=True)[columns] if frames else pd.DataFrame(columns=columns)
+        return df.astype({"entity": "int64", "organisation_entity": float})
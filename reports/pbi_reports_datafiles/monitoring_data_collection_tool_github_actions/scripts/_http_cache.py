@@ -0,0 +1,289 @@
+"""
+On-disk HTTP cache shared by every script in a run, through the Datasette client in `_datasette`.
+
+Responses are keyed by URL plus query parameters and stored content-addressed
+(by SHA-256 of the body) under `objects/`, so identical bodies are kept once.
+An SQLite index records ETag/Last-Modified, fetch and access times:
+
+- entries younger than the TTL are served without a request
+- older entries are revalidated with If-None-Match / If-Modified-Since
+- the least recently used bodies are evicted once the cache exceeds its size cap
+
+A lock file per key means scripts running in parallel wait for one download
+of a table rather than each fetching it.
+
+Settings (environment variables):
+    DATASETTE_CACHE         "off" disables the cache
+    DATASETTE_CACHE_DIR     cache directory (default: ../cache next to scripts/)
+    DATASETTE_CACHE_TTL     seconds before an entry is revalidated (default: 3600)
+    DATASETTE_CACHE_MAX_MB  size cap in megabytes (default: 2048)
+"""
+
+import os
+import time
+import hashlib
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from _metrics import record_http
+
+CACHE_ENABLED = os.getenv("DATASETTE_CACHE", "on").lower() != "off"
+CACHE_DIR = os.getenv(
+    "DATASETTE_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cache"),
+)
+DEFAULT_TTL = int(os.getenv("DATASETTE_CACHE_TTL", "3600"))
+DEFAULT_MAX_BYTES = int(os.getenv("DATASETTE_CACHE_MAX_MB", "2048")) * 1024 * 1024
+
+# A lock older than this is assumed to belong to a process that died mid-download
+LOCK_STALE_SECONDS = 1800
+CHUNK_SIZE = 1024 * 1024
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def cache_key(url, params=None):
+    """
+    Builds the cache key for a request from its URL and query parameters.
+
+    Parameters from the URL and from `params` are merged and sorted, so the same
+    request made either way maps to the same entry.
+
+    Args:
+        url (str): Request URL, possibly with a query string.
+        params (dict, optional): Additional query parameters.
+
+    Returns:
+        tuple: (key, normalised_url)
+    """
+    parts = urlsplit(url)
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    if params:
+        query.extend((k, str(v)) for k, v in params.items())
+    normalised = urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(sorted(query)), ""))
+    return hashlib.sha256(normalised.encode("utf-8")).hexdigest(), normalised
+
+
+class HttpCache:
+    """
+    Content-addressed on-disk cache for GET requests.
+
+    Args:
+        directory (str): Where the index, bodies and locks are kept.
+        ttl (int): Seconds an entry is served without revalidation.
+        max_bytes (int): Size cap for stored bodies; least recently used are evicted first.
+    """
+
+    def __init__(self, directory=CACHE_DIR, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(directory, "objects")
+        self.locks_dir = os.path.join(directory, "locks")
+        self.index_path = os.path.join(directory, "index.sqlite")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.locks_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entry (
+                    key TEXT PRIMARY KEY,
+                    url TEXT,
+                    object TEXT,
+                    size INTEGER,
+                    etag TEXT,
+                    last_modified TEXT,
+                    fetched_at REAL,
+                    accessed_at REAL
+                )
+                """
+            )
+
+    def _connect(self):
+        conn = sqlite3.connect(self.index_path, timeout=60)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    @contextmanager
+    def _lock(self, key):
+        """
+        Holds an exclusive lock on one key across processes, using an O_EXCL lock file.
+        """
+        path = os.path.join(self.locks_dir, f"{key}.lock")
+        while True:
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(path) > LOCK_STALE_SECONDS:
+                        os.remove(path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(0.2)
+        try:
+            yield
+        finally:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _get_entry(self, key):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT object, etag, last_modified, fetched_at FROM entry WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or not os.path.exists(self._object_path(row[0])):
+            return None
+        return {"object": row[0], "etag": row[1], "last_modified": row[2], "fetched_at": row[3]}
+
+    def _touch(self, key, revalidated=False):
+        now = time.time()
+        with self._connect() as conn:
+            if revalidated:
+                conn.execute("UPDATE entry SET fetched_at = ?, accessed_at = ? WHERE key = ?", (now, now, key))
+            else:
+                conn.execute("UPDATE entry SET accessed_at = ? WHERE key = ?", (now, key))
+
+    def _store(self, key, url, response):
+        """
+        Streams a response body to disk, files it under its content hash and records it in the index.
+        """
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.objects_dir, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            object_id = digest.hexdigest()
+            object_path = self._object_path(object_id)
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            os.replace(tmp_path, object_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entry VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    url,
+                    object_id,
+                    size,
+                    response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"),
+                    now,
+                    now,
+                ),
+            )
+        self._evict(keep=object_id)
+        record_http(bytes_downloaded=size)
+        return object_id
+
+    def _evict(self, keep=None):
+        """
+        Removes least recently used bodies until the cache is under its size cap.
+        """
+        with self._connect() as conn:
+            objects = conn.execute(
+                """
+                SELECT object, MAX(size), MAX(accessed_at) AS last_access
+                FROM entry GROUP BY object ORDER BY last_access
+                """
+            ).fetchall()
+            total = sum(size for _, size, _ in objects)
+            for object_id, size, _ in objects:
+                if total <= self.max_bytes:
+                    break
+                if object_id == keep:
+                    continue
+                conn.execute("DELETE FROM entry WHERE object = ?", (object_id,))
+                try:
+                    os.remove(self._object_path(object_id))
+                except OSError:
+                    # Missing, or still open by a reader on Windows; the index no longer points at it
+                    pass
+                total -= size
+
+    def fetch(self, session, url, params=None, timeout=None):
+        """
+        Returns the local path of the body for a GET request, downloading only when needed.
+
+        Args:
+            session (requests.Session): Session used for any request made.
+            url (str): Request URL.
+            params (dict, optional): Query parameters.
+            timeout: Passed to `session.get`.
+
+        Returns:
+            str: Path to the cached response body.
+
+        Raises:
+            requests.HTTPError: If the server responds with an error.
+        """
+        key, normalised_url = cache_key(url, params)
+        with self._lock(key):
+            entry = self._get_entry(key)
+            if entry and time.time() - entry["fetched_at"] < self.ttl:
+                self._touch(key)
+                record_http(requests=0, cache_hit=True)
+                return self._object_path(entry["object"])
+
+            headers = {}
+            if entry and entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry and entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+            with session.get(normalised_url, headers=headers, stream=True, timeout=timeout) as response:
+                if entry and response.status_code == 304:
+                    self._touch(key, revalidated=True)
+                    record_http(cache_hit=True)
+                    return self._object_path(entry["object"])
+                response.raise_for_status()
+                object_id = self._store(key, normalised_url, response)
+            return self._object_path(object_id)
+
+    def clear(self):
+        """
+        Removes every entry and stored body.
+        """
+        with self._connect() as conn:
+            objects = [row[0] for row in conn.execute("SELECT DISTINCT object FROM entry")]
+            conn.execute("DELETE FROM entry")
+        for object_id in objects:
+            try:
+                os.remove(self._object_path(object_id))
+            except OSError:
+                pass
+
+
+def get_default_cache():
+    """
+    Returns the process-wide cache configured from the environment, or None if disabled.
+
+    Returns:
+        HttpCache | None: The shared cache.
+    """
+    global _default_cache
+    if not CACHE_ENABLED:
+        return None
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = HttpCache()
+    return _default_cache
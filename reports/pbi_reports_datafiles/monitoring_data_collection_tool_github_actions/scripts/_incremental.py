@@ -0,0 +1,161 @@
+"""
+Partitioned store for exports that are rebuilt from a rolling window every day.
+
+Each export keeps its previous results as one CSV per partition (e.g. per day)
+under STORE_DIR/<name>/. The newest partition is the watermark: a run only
+fetches rows from the watermark onwards (the watermark partition itself is
+refetched, as its day may have been incomplete), replaces those partitions,
+and drops partitions that have fallen out of the window. The export is then
+the union of the partitions, newest first.
+
+Settings (environment variables):
+    INCREMENTAL_STORE_DIR   store directory (default: ../store next to scripts/)
+"""
+
+import os
+import shutil
+from urllib.parse import quote, unquote
+import pandas as pd
+from _datasette import get_datasette_json
+
+STORE_DIR = os.getenv(
+    "INCREMENTAL_STORE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "store"),
+)
+
+
+class PartitionedStore:
+    """
+    Rows of one export, stored as one CSV per value of a partition column.
+
+    Partition values are compared as strings, so ISO dates sort and compare the
+    same way they do in SQLite.
+
+    Args:
+        name (str): Export name, used as the directory name.
+        partition_column (str): Column whose value selects the partition.
+        directory (str): Parent directory for all stores.
+    """
+
+    def __init__(self, name, partition_column, directory=STORE_DIR):
+        self.name = name
+        self.partition_column = partition_column
+        self.path = os.path.join(directory, name)
+
+    def _partition_path(self, value):
+        # Quoted so values with ":" (timestamps) are valid file names on Windows
+        return os.path.join(self.path, quote(str(value), safe="") + ".csv")
+
+    def partitions(self):
+        """
+        Returns the stored partition values, oldest first.
+
+        Returns:
+            list of str: Partition values.
+        """
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(
+            unquote(file[:-len(".csv")]) for file in os.listdir(self.path) if file.endswith(".csv")
+        )
+
+    def watermark(self):
+        """
+        Returns the newest partition value, or None if the store is empty.
+        """
+        partitions = self.partitions()
+        return partitions[-1] if partitions else None
+
+    def replace_from(self, start, df):
+        """
+        Replaces every partition from `start` onwards with the partitions in `df`.
+
+        Args:
+            start (str | None): First partition value that was refetched; None replaces the whole store.
+            df (pd.DataFrame): All rows with a partition value >= `start`.
+        """
+        if start is None and os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path, exist_ok=True)
+        for value in self.partitions():
+            if value >= start:
+                os.remove(self._partition_path(value))
+        if df.empty:
+            return
+        for value, rows in df.groupby(self.partition_column, sort=False):
+            path = self._partition_path(value)
+            rows.to_csv(path + ".part", index=False)
+            os.replace(path + ".part", path)
+
+    def drop_before(self, cutoff):
+        """
+        Removes partitions older than the window.
+
+        Args:
+            cutoff (str): Oldest partition value to keep.
+
+        Returns:
+            int: Number of partitions removed.
+        """
+        expired = [value for value in self.partitions() if value < cutoff]
+        for value in expired:
+            os.remove(self._partition_path(value))
+        return len(expired)
+
+    def read(self):
+        """
+        Returns every stored row, newest partition first, with values as they were written.
+
+        Returns:
+            pd.DataFrame: The export (empty if the store is empty).
+        """
+        frames = [
+            pd.read_csv(self._partition_path(value), dtype=str, keep_default_na=False)
+            for value in reversed(self.partitions())
+        ]
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def window_start(db, modifier):
+    """
+    Returns the first date of a rolling window, as computed by Datasette's SQLite.
+
+    Asking the server keeps the cutoff identical to `DATE('now', modifier)` in the
+    export queries (including how month arithmetic handles the end of a month).
+
+    Args:
+        db (str): The database name (e.g. 'digital-land').
+        modifier (str): SQLite date modifier, e.g. '-6 months'.
+
+    Returns:
+        str: The date as YYYY-MM-DD.
+    """
+    sql = f"SELECT DATE('now', '{modifier}') AS cutoff"
+    return get_datasette_json(db, sql, {"_shape": "array"}, use_cache=False)[0]["cutoff"]
+
+
+def update_store(store, fetch_since, cutoff, full=False):
+    """
+    Brings a store up to date, fetching only rows from its watermark onwards.
+
+    Args:
+        store (PartitionedStore): The export's store.
+        fetch_since (callable): Takes a partition value (or None for the whole
+            window) and returns the rows from that partition onwards as a DataFrame.
+        cutoff (str): Oldest partition value in the window.
+        full (bool): Ignore the stored partitions and refetch the whole window.
+
+    Returns:
+        pd.DataFrame: The full export, newest partition first.
+    """
+    watermark = None if full else store.watermark()
+    if watermark is not None and watermark < cutoff:
+        # Everything stored has expired, so there is nothing to add to
+        watermark = None
+    print(f"[INFO] {store.name}: fetching rows from {watermark or 'the start of the window'}")
+
+    df = fetch_since(watermark)
+    store.replace_from(watermark, df)
+    dropped = store.drop_before(cutoff)
+    print(f"[INFO] {store.name}: {len(df)} rows fetched, {dropped} expired partitions dropped")
+    return store.read()
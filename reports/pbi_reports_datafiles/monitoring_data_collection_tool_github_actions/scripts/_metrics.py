@@ -0,0 +1,155 @@
+"""
+Performance metrics for one script run, reported back to run.py.
+
+The Datasette client and HTTP cache record every fetch (requests made, bytes
+downloaded, cache hits, rows returned and time spent), so scripts get these
+without changes. Scripts mark other phases with `span()`:
+
+    with span("write", rows=len(df)):
+        df.to_csv(path, index=False)
+
+Time not spent in a recorded phase is reported as "transform". Phases that run
+in several threads at once add up, so their seconds can exceed the wall time.
+
+When run.py sets MONITORING_METRICS_FILE, the metrics (with wall time and peak
+memory) are written there as JSON when the script exits. Scripts run in-process
+share this module, so run.py measures them with `difference()` instead.
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+
+METRICS_FILE = os.getenv("MONITORING_METRICS_FILE")
+
+_lock = threading.Lock()
+_started = time.monotonic()
+_counters = {"http_requests": 0, "bytes_downloaded": 0, "cache_hits": 0}
+_phases = {}
+
+
+@contextmanager
+def span(name, rows=0):
+    """
+    Times a phase of the script; repeated spans of the same phase add up.
+
+    The yielded dict can be updated with the row count once it is known:
+
+        with span("fetch") as record:
+            df = ...
+            record["rows"] = len(df)
+
+    Args:
+        name (str): Phase name, e.g. "fetch", "load" or "write".
+        rows (int): Rows processed in the phase.
+    """
+    record = {"rows": rows}
+    start = time.monotonic()
+    try:
+        yield record
+    finally:
+        elapsed = time.monotonic() - start
+        with _lock:
+            phase = _phases.setdefault(name, {"seconds": 0.0, "count": 0, "rows": 0})
+            phase["seconds"] += elapsed
+            phase["count"] += 1
+            phase["rows"] += record["rows"] or 0
+
+
+def record_http(requests=1, bytes_downloaded=0, cache_hit=False):
+    """
+    Counts HTTP traffic.
+
+    Args:
+        requests (int): Requests made (0 when served from the cache without revalidating).
+        bytes_downloaded (int): Body bytes received.
+        cache_hit (bool): Whether the body came from the on-disk cache.
+    """
+    with _lock:
+        _counters["http_requests"] += requests
+        _counters["bytes_downloaded"] += bytes_downloaded
+        _counters["cache_hits"] += int(cache_hit)
+
+
+def peak_rss_bytes():
+    """
+    Returns the peak resident memory of this process in bytes, or None if unavailable.
+    """
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        memory = psutil.Process().memory_info()
+        return getattr(memory, "peak_wset", memory.rss)
+    except ImportError:
+        return None
+
+
+def snapshot():
+    """
+    Returns the metrics recorded so far.
+
+    Returns:
+        dict: Counters, phases, wall time and peak memory.
+    """
+    wall = time.monotonic() - _started
+    with _lock:
+        data = dict(_counters)
+        phases = {name: dict(phase) for name, phase in _phases.items()}
+    if "transform" not in phases:
+        recorded = sum(phase["seconds"] for phase in phases.values())
+        phases["transform"] = {"seconds": max(0.0, wall - recorded), "count": 1, "rows": 0}
+    data["phases"] = phases
+    data["wall_seconds"] = wall
+    data["peak_rss_bytes"] = peak_rss_bytes()
+    return data
+
+
+def difference(after, before):
+    """
+    Returns the metrics recorded between two snapshots of this process.
+
+    Used by run.py to measure one script run in-process. Peak memory is left out,
+    as it is only known for the whole process.
+
+    Args:
+        after (dict): Later `snapshot()`.
+        before (dict): Earlier `snapshot()`.
+
+    Returns:
+        dict: Metrics in the same shape as `snapshot()`.
+    """
+    data = {
+        key: after[key] - before[key]
+        for key in ("http_requests", "bytes_downloaded", "cache_hits", "wall_seconds")
+    }
+    empty = {"seconds": 0.0, "count": 0, "rows": 0}
+    data["phases"] = {
+        name: {key: phase[key] - before["phases"].get(name, empty)[key] for key in empty}
+        for name, phase in after["phases"].items()
+        if phase != before["phases"].get(name)
+    }
+    data["peak_rss_bytes"] = None
+    return data
+
+
+def _write_metrics():
+    if not METRICS_FILE:
+        return
+    try:
+        with open(METRICS_FILE, "w", encoding="utf-8") as f:
+            json.dump(snapshot(), f)
+    except OSError:
+        pass
+
+
+atexit.register(_write_metrics)
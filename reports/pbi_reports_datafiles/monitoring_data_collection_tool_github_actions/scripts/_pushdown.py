@@ -0,0 +1,70 @@
+"""
+Runs aggregations and joins on Datasette so only the result rows are downloaded.
+
+A script passes the SQL for its result together with a function that computes
+the same result locally (usually from `_snapshot.load_table()`). The SQL is
+tried first; if Datasette rejects it (e.g. the query exceeds its time limit)
+or the request fails, the local function is used instead, so the script still
+produces its output.
+
+Settings (environment variables):
+    DATASETTE_PUSHDOWN  "off" always computes results locally
+"""
+
+import os
+import pandas as pd
+from _datasette import get_datasette_json, get_datasette_query_paged, get_datasette_join_paged, PAGE_SIZE
+
+PUSHDOWN_ENABLED = os.getenv("DATASETTE_PUSHDOWN", "on").lower() != "off"
+
+
+class ResultTruncated(Exception):
+    """
+    Raised when an unpaged pushdown query returns Datasette's maximum number of rows.
+    """
+
+
+def pushdown_query(db, sql, local, key=None, table=None, where=None, columns=None, name="query"):
+    """
+    Returns the result of `sql` run on Datasette, or of `local()` if that is not possible.
+
+    Args:
+        db (str): The database name (e.g. 'digital-land').
+        sql (str): SELECT producing the result. With `key` or `table`, it must not have
+            its own ORDER BY or LIMIT (see `get_datasette_query_paged` and
+            `get_datasette_join_paged`).
+        local (callable): Returns the same result as a DataFrame, computed locally.
+        key (str, optional): Unique key column selected by `sql`, used to page through
+            results larger than Datasette's row limit. Without a key or table, a full
+            page is treated as truncated.
+        table (str, optional): Driving table of a join, read by `sql` as `{page}`; the
+            result is paged on its rowid instead of a key.
+        where (str, optional): Condition on the driving table's own columns.
+        columns (list of str, optional): Result columns, in order. Other columns (such
+            as helper keys) are dropped, and the header is kept when the result is empty.
+        name (str): Description used in log messages.
+
+    Returns:
+        pd.DataFrame: The result.
+    """
+    if not PUSHDOWN_ENABLED:
+        return local()
+
+    try:
+        if table is not None:
+            df = get_datasette_join_paged(db, sql, table, where=where)
+        elif key is not None:
+            df = get_datasette_query_paged(db, sql, key=key)
+        else:
+            rows = get_datasette_json(db, sql, {"_shape": "array", "_size": "max"})
+            if len(rows) >= PAGE_SIZE:
+                raise ResultTruncated(f"{len(rows)} rows returned, the result may be incomplete")
+            df = pd.DataFrame.from_dict(rows)
+    except Exception as e:
+        print(f"[WARNING] {name}: Datasette query failed, computing locally instead ({e})")
+        return local()
+
+    print(f"[INFO] {name}: {len(df)} rows computed on Datasette")
+    if columns is not None:
+        df = df.reindex(columns=columns)
+    return df
@@ -0,0 +1,187 @@
+"""
+Parquet snapshots of the digital-land and performance tables used by the monitoring scripts.
+
+`snapshot_tables.py` downloads the tables listed in its WRITES once per run and
+writes them to SNAPSHOT_DIR as Parquet (strings are dictionary-encoded on disk).
+Scripts then call `load_table()` to read only the columns they need, with
+optional filters pushed down into the Parquet reader.
+
+If a snapshot is missing, older than SNAPSHOT_MAX_AGE, or pyarrow is not
+installed, `load_table()` falls back to the Datasette CSV export so every
+script still runs on its own.
+
+In an in-process run (see `_context.py`) each table is loaded once per set of
+columns and filters, and shared between the scripts.
+
+Settings (environment variables):
+    SNAPSHOT_DIR        snapshot directory (default: ../snapshot next to scripts/)
+    SNAPSHOT_MAX_AGE    seconds a snapshot is used for (default: 43200)
+"""
+
+import os
+import time
+import operator
+import pandas as pd
+from _datasette import read_datasette_csv, table_csv_url
+from _metrics import span
+from _context import current_context
+
+try:
+    import pyarrow  # noqa: F401
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+SNAPSHOT_DIR = os.getenv(
+    "SNAPSHOT_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "snapshot"),
+)
+SNAPSHOT_MAX_AGE = int(os.getenv("SNAPSHOT_MAX_AGE", str(12 * 60 * 60)))
+
+# Snapshot name -> (Datasette database, table); also used by `load_table()` without a snapshot
+SNAPSHOT_TABLES = {
+    "provision": ("digital-land", "provision"),
+    "organisation": ("digital-land", "organisation"),
+    "source": ("digital-land", "source"),
+    "endpoint": ("digital-land", "endpoint"),
+    "resource_endpoint": ("digital-land", "resource_endpoint"),
+    "resource_dataset": ("digital-land", "resource_dataset"),
+    "reporting_historic_endpoints": ("digital-land", "reporting_historic_endpoints"),
+    "endpoint_dataset_issue_type_summary": ("performance", "endpoint_dataset_issue_type_summary"),
+}
+
+# Operators accepted in `load_table()` filters, matching pyarrow's
+_OPERATORS = {
+    "==": operator.eq,
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+def snapshot_path(name):
+    """
+    Returns the Parquet path for a snapshot.
+
+    Args:
+        name (str): Key in SNAPSHOT_TABLES.
+
+    Returns:
+        str: Path to `<SNAPSHOT_DIR>/<name>.parquet`.
+    """
+    return os.path.join(SNAPSHOT_DIR, f"{name}.parquet")
+
+
+def is_fresh(name):
+    """
+    Checks whether a usable snapshot exists for the table.
+
+    Args:
+        name (str): Key in SNAPSHOT_TABLES.
+
+    Returns:
+        bool: True if pyarrow is installed and the snapshot is younger than SNAPSHOT_MAX_AGE.
+    """
+    path = snapshot_path(name)
+    return (
+        PARQUET_AVAILABLE
+        and os.path.exists(path)
+        and time.time() - os.path.getmtime(path) < SNAPSHOT_MAX_AGE
+    )
+
+
+def write_snapshot(name):
+    """
+    Downloads a table from Datasette and writes it as a Parquet snapshot.
+
+    The file is written under a temporary name and renamed, so readers never see
+    a partial snapshot.
+
+    Args:
+        name (str): Key in SNAPSHOT_TABLES.
+
+    Returns:
+        int: Number of rows written.
+    """
+    db, table = SNAPSHOT_TABLES[name]
+    df = read_datasette_csv(table_csv_url(db, table), low_memory=False)
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    tmp_path = snapshot_path(name) + ".part"
+    with span("write", rows=len(df)):
+        df.to_parquet(tmp_path, index=False, engine="pyarrow")
+    os.replace(tmp_path, snapshot_path(name))
+    return len(df)
+
+
+def _apply_filters(df, filters):
+    """
+    Applies pyarrow-style filters ([(column, op, value), ...], all ANDed) to a DataFrame.
+    """
+    mask = pd.Series(True, index=df.index)
+    for column, op, value in filters:
+        if op == "in":
+            mask &= df[column].isin(value)
+        elif op == "not in":
+            mask &= ~df[column].isin(value)
+        else:
+            mask &= _OPERATORS[op](df[column], value)
+    return df[mask].reset_index(drop=True)
+
+
+def load_table(name, columns=None, filters=None, categorical=None):
+    """
+    Loads a snapshot table, reading only the requested columns and rows.
+
+    Args:
+        name (str): Key in SNAPSHOT_TABLES.
+        columns (list of str, optional): Columns to load; all if None.
+        filters (list of tuple, optional): pyarrow-style filters, e.g. [("dataset", "==", "tree")].
+            Supported operators: ==, !=, <, <=, >, >=, in, not in.
+        categorical (list of str, optional): Columns to load as pandas categoricals
+            (from the Parquet dictionary), to reduce memory for repeated strings.
+
+    Returns:
+        pd.DataFrame: The table.
+    """
+    context = current_context()
+    if context is None:
+        return _read_table(name, columns, filters, categorical)
+    key = (
+        "snapshot" if is_fresh(name) else "datasette",
+        name,
+        tuple(columns) if columns is not None else None,
+        repr(filters),
+        tuple(categorical) if categorical else None,
+    )
+    return context.shared_table(key, lambda: _read_table(name, columns, filters, categorical))
+
+
+def _read_table(name, columns=None, filters=None, categorical=None):
+    """
+    Reads a table for `load_table()`, from its snapshot if fresh, otherwise from Datasette.
+    """
+    if is_fresh(name):
+        kwargs = {"read_dictionary": categorical} if categorical else {}
+        with span("load") as record:
+            df = pd.read_parquet(
+                snapshot_path(name), engine="pyarrow", columns=columns, filters=filters, **kwargs
+            )
+            record["rows"] = len(df)
+        return df
+
+    db, table = SNAPSHOT_TABLES[name]
+    read_columns = None
+    if columns is not None:
+        # Filter columns have to be read to apply the filters locally
+        read_columns = list(dict.fromkeys(list(columns) + [f[0] for f in filters or []]))
+    df = read_datasette_csv(table_csv_url(db, table), usecols=read_columns, low_memory=False)
+    if filters:
+        df = _apply_filters(df, filters)
+    if columns is not None:
+        df = df[list(columns)]
+    for column in categorical or []:
+        df[column] = df[column].astype("category")
+    return df
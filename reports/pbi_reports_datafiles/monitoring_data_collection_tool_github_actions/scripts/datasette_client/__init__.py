@@ -0,0 +1,120 @@
+"""
+Pooled, retrying HTTP client for Datasette, shared by the monitoring scripts and
+the notebook helpers in reports/ (e.g. measure_data_quality/functions_core.py).
+
+All requests made by a process go through one keep-alive requests session, so
+repeated queries reuse a handful of connections instead of paying a new TLS
+handshake each time. The retry statuses, backoff and timeouts are set here only.
+This is a package rather than a module so run.py does not run it as a script;
+the scripts add caching and metrics on top of it in `_datasette`.
+
+The pool size can be set with the DATASETTE_POOL_SIZE environment variable or
+with `configure_datasette_http()`.
+"""
+
+import os
+import threading
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+DATASETTE_URL = "https://datasette.planning.data.gov.uk"
+
+POOL_SIZE = int(os.getenv("DATASETTE_POOL_SIZE", "10"))
+
+# Datasette answers 400 when a query hits its time limit, so that is retried as well
+RETRY_STATUS_CODES = [400, 429, 500, 502, 503, 504]
+
+# (connect, read) timeouts in seconds; the read timeout is per chunk, not per download
+REQUEST_TIMEOUT = (10, 300)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _build_session(pool_size, retries):
+    """
+    Builds a requests.Session with a connection pool and retry strategy mounted.
+
+    Args:
+        pool_size (int): Number of keep-alive connections kept per host.
+        retries (int): Number of retries for connection errors and retryable status codes.
+
+    Returns:
+        requests.Session: Configured session.
+    """
+    retry_strategy = Retry(
+        total=retries,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=["GET", "HEAD"],
+        backoff_factor=0.5,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retry_strategy,
+    )
+    http = requests.Session()
+    http.mount("https://", adapter)
+    http.mount("http://", adapter)
+    return http
+
+
+def configure_datasette_http(pool_size=POOL_SIZE, retries=3):
+    """
+    Replaces the shared session, e.g. to change the pool size for a larger run.
+
+    Args:
+        pool_size (int): Number of keep-alive connections kept per host.
+        retries (int): Number of retries for connection errors and retryable status codes.
+
+    Returns:
+        requests.Session: The new shared session.
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = _build_session(pool_size, retries)
+        return _session
+
+
+def get_datasette_http():
+    """
+    Returns the process-wide requests.Session, creating it on first use.
+
+    Returns:
+        requests.Session: Pooled session with retries on 400, 429 and 5xx responses.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session(POOL_SIZE, 3)
+    return _session
+
+
+
+
+def read_csv(url, params=None, **kwargs):
+    """
+    Streams a CSV from Datasette (or any URL) through the shared session into a DataFrame.
+
+    Args:
+        url (str): CSV URL.
+        params (dict, optional): Query parameters to add to the URL.
+        **kwargs: Passed through to `pd.read_csv`.
+
+    Returns:
+        pd.DataFrame: The parsed CSV.
+
+    Raises:
+        requests.HTTPError: If the final response is not successful.
+    """
+    with get_datasette_http().get(url, params=params, stream=True, timeout=REQUEST_TIMEOUT) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return pd.read_csv(response.raw, **kwargs)
@@ -1,7 +1,23 @@
 import pandas as pd
 import ast
+import json
 import argparse
 import os
+from _datasette import read_datasette_csv
+from _snapshot import load_table
+from _entity_index import EntityIndex
+from _metrics import span
+
+# Upstream tables read by this script (used by run.py to schedule scripts)
+READS = [
+    "digital-land/expectation",
+    "snapshot/organisation",
+    "conservation-area/entity",
+    "article-4-direction-area/entity",
+    "listed-building-outline/entity",
+    "tree-preservation-zone/entity",
+    "tree/entity",
+]
 
 def parse_args():
     """
@@ -19,9 +35,26 @@ def parse_args():
     )
     return parser.parse_args()
 
+# Match records enriched and written per chunk, so memory does not grow with the number of matches
+CHUNK_SIZE = 50000
+
+# Datasets checked for duplicate geometries (each has its own Datasette database)
+ENTITY_DATASETS = [
+    "conservation-area",
+    "article-4-direction-area",
+    "listed-building-outline",
+    "tree-preservation-zone",
+    "tree",
+]
+
+MATCH_COLUMNS = ["dataset", "operation", "message", "entity_a", "entity_b"]
+
 def parse_details(val):
     """
-    Safely parses a stringified dictionary from the 'details' column using `ast.literal_eval`.
+    Parses a stringified dictionary from the 'details' column.
+
+    JSON is tried first as it is much faster; Python literals (single quotes,
+    True/None) fall back to `ast.literal_eval`.
 
     Parameters:
         val (str): A string containing a dictionary-like structure.
@@ -30,98 +63,95 @@ def parse_details(val):
         dict: Parsed dictionary, or empty dict if parsing fails.
     """
     try:
-        return ast.literal_eval(val)
+        parsed = json.loads(val)
     except Exception:
-        return {}
+        try:
+            parsed = ast.literal_eval(val)
+        except Exception:
+            return {}
+    return parsed if isinstance(parsed, dict) else {}
 
-def extract_stats(details_dict):
+def iter_matches(df_expectations, stats):
     """
-    Extracts summary statistics from a parsed 'details' dictionary.
+    Yields one record per complete or single match, parsing each 'details' value once.
+
+    The summary statistics for each expectation are appended to `stats` in the
+    same pass, so they are complete once the generator is exhausted.
 
     Parameters:
-        details_dict (dict): Parsed dictionary from the 'details' column.
+        df_expectations (pd.DataFrame): Expectation rows with dataset, operation, severity and details.
+        stats (list): Receives one dict per expectation (actual/expected values and match counts).
 
-    Returns:
-        pd.Series: Contains actual/expected values and match counts.
+    Yields:
+        dict: dataset, operation, message, entity_a and entity_b of one match.
     """
-    return pd.Series({
-        "actual": details_dict.get("actual"),
-        "expected": details_dict.get("expected"),
-        "complete_match_count": len(details_dict.get("complete_matches", [])) if isinstance(details_dict.get("complete_matches"), list) else 0,
-        "single_match_count": len(details_dict.get("single_matches", [])) if isinstance(details_dict.get("single_matches"), list) else 0,
-        "complete_matches": details_dict.get("complete_matches", []),
-        "single_matches": details_dict.get("single_matches", [])
-    })
-
-def main(output_dir):
+    rows = df_expectations[["dataset", "operation", "severity", "details"]].itertuples(index=False, name=None)
+    for dataset, operation, severity, details in rows:
+        details_dict = parse_details(details)
+        complete_matches = details_dict.get("complete_matches")
+        single_matches = details_dict.get("single_matches")
+        complete_matches = complete_matches if isinstance(complete_matches, list) else []
+        single_matches = single_matches if isinstance(single_matches, list) else []
+
+        stats.append({
+            "dataset": dataset,
+            "severity": severity,
+            "actual": details_dict.get("actual"),
+            "expected": details_dict.get("expected"),
+            "complete_match_count": len(complete_matches),
+            "single_match_count": len(single_matches),
+        })
+
+        for message, matches in (("complete_match", complete_matches), ("single_match", single_matches)):
+            for match in matches:
+                yield {
+                    "dataset": dataset,
+                    "operation": operation,
+                    "message": message,
+                    "entity_a": match.get("entity_a"),
+                    "entity_b": match.get("entity_b"),
+                }
+
+def iter_chunks(records, size=CHUNK_SIZE):
     """
-    Main function for processing duplicate geometry checks.
+    Groups a stream of records into DataFrames of at most `size` rows.
 
-    - Downloads expectations with 'duplicate_geometry_check' operation.
-    - Parses match results and enriches them with entity and organisation metadata.
-    - Outputs both detailed and summary CSVs to the specified output directory.
+    Parameters:
+        records (iterable of dict): Records with MATCH_COLUMNS.
+        size (int): Maximum rows per chunk.
+
+    Yields:
+        pd.DataFrame: The next chunk of records.
     """
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield pd.DataFrame(chunk, columns=MATCH_COLUMNS)
+            chunk = []
+    if chunk:
+        yield pd.DataFrame(chunk, columns=MATCH_COLUMNS)
+
+def enrich_matches(df_matches, entity_index, df_org):
+    """
+    Adds entity and organisation metadata for both sides of each match.
 
-    # Load expectation records where operation is 'duplicate_geometry_check'
-    url = "https://datasette.planning.data.gov.uk/digital-land/expectation.csv?_stream=on"
-    df = pd.read_csv(url)
-    df = df[df["operation"] == "duplicate_geometry_check"].copy()
-
-    # Parse the 'details' field into dictionaries
-    df["details_parsed"] = df["details"].apply(parse_details)
-
-    # Extract match records (complete and single) from details
-    records = []
-    for _, row in df.iterrows():
-        dataset = row["dataset"]
-        operation = row["operation"]
-        details = row["details_parsed"]
-
-        for match in details.get("complete_matches", []):
-            records.append({
-                "dataset": dataset,
-                "operation": operation,
-                "message": "complete_match",
-                "entity_a": match.get("entity_a"),
-                "organisation_entity_a": match.get("organisation_entity_a"),
-                "entity_b": match.get("entity_b"),
-                "organisation_entity_b": match.get("organisation_entity_b"),
-            })
-
-        for match in details.get("single_matches", []):
-            records.append({
-                "dataset": dataset,
-                "operation": operation,
-                "message": "single_match",
-                "entity_a": match.get("entity_a"),
-                "organisation_entity_a": match.get("organisation_entity_a"),
-                "entity_b": match.get("entity_b"),
-                "organisation_entity_b": match.get("organisation_entity_b"),
-            })
-
-    df_matches = pd.DataFrame(records)
-
-    # URLs for entity tables by dataset
-    url_map = {
-        "conservation-area": "https://datasette.planning.data.gov.uk/conservation-area/entity.csv?_stream=on",
-        "article-4-direction-area": "https://datasette.planning.data.gov.uk/article-4-direction-area/entity.csv?_stream=on",
-        "listed-building-outline": "https://datasette.planning.data.gov.uk/listed-building-outline/entity.csv?_stream=on",
-        "tree-preservation-zone": "https://datasette.planning.data.gov.uk/tree-preservation-zone/entity.csv?_stream=on",
-        "tree": "https://datasette.planning.data.gov.uk/tree/entity.csv?_stream=on",
-    }
-
-    # Columns to retain from entity tables
-    columns_to_keep = ["entity", "dataset", "end_date", "entry_date", "geometry", "name", "organisation_entity"]
-    entity_tables = {}
-
-    # Download and store each dataset's entity table
-    for dataset_name, entity_url in url_map.items():
-        df_entity = pd.read_csv(entity_url)
-        df_entity["dataset"] = dataset_name
-        entity_tables[dataset_name] = df_entity[columns_to_keep].copy()
-
-    # Combine all entity tables into one DataFrame
-    df_entities = pd.concat(entity_tables.values(), ignore_index=True)
+    Only the entities in this chunk are looked up, and only their geometries
+    are downloaded.
+
+    Parameters:
+        df_matches (pd.DataFrame): Match records with MATCH_COLUMNS.
+        entity_index (EntityIndex): Refreshed index of entity metadata.
+        df_org (pd.DataFrame): organisation_entity -> organisation_name lookup.
+
+    Returns:
+        pd.DataFrame: Matches in the output column layout.
+    """
+    keys = pd.concat([
+        df_matches[["dataset", "entity_a"]].rename(columns={"entity_a": "entity"}),
+        df_matches[["dataset", "entity_b"]].rename(columns={"entity_b": "entity"}),
+    ])
+    df_entities = entity_index.entities(keys)
 
     # Merge metadata for entity_a
     df_matches = df_matches.merge(
@@ -151,62 +181,76 @@ def main(output_dir):
         "organisation_entity": "entity_b_organisation"
     }).drop(columns=["entity"])
 
-    # Reorder final column layout
+    # Add readable names for both organisations
+    for side in ("a", "b"):
+        df_matches = df_matches.merge(
+            df_org.rename(columns={"organisation_name": f"entity_{side}_organisation_name"}),
+            how="left",
+            left_on=f"entity_{side}_organisation",
+            right_on="organisation_entity"
+        ).drop(columns=["organisation_entity"])
+
+    # Final column layout (organisation names after each organisation)
     ordered_cols = [
         "dataset", "operation", "message",
-        "entity_a", "entity_a_name", "entity_a_organisation", "entity_a_entry_date", "entity_a_end_date", "entity_a_geometry",
-        "entity_b", "entity_b_name", "entity_b_organisation", "entity_b_entry_date", "entity_b_end_date", "entity_b_geometry"
+        "entity_a", "entity_a_name", "entity_a_organisation", "entity_a_organisation_name",
+        "entity_a_entry_date", "entity_a_end_date", "entity_a_geometry",
+        "entity_b", "entity_b_name", "entity_b_organisation", "entity_b_organisation_name",
+        "entity_b_entry_date", "entity_b_end_date", "entity_b_geometry"
     ]
-    df_matches = df_matches[ordered_cols]
-
-    # Load organisation lookup table
-    org_url = "https://datasette.planning.data.gov.uk/digital-land/organisation.csv?_stream=on"
-    df_org = pd.read_csv(org_url)[["entity", "name"]].rename(columns={
-        "entity": "organisation_entity",
-        "name": "organisation_name"
-    })
+    return df_matches[ordered_cols]
 
-    # Add readable name for entity_a_organisation
-    df_matches = df_matches.merge(
-        df_org,
-        how="left",
-        left_on="entity_a_organisation",
-        right_on="organisation_entity"
-    ).rename(columns={"organisation_name": "entity_a_organisation_name"}).drop(columns=["organisation_entity"])
+def main(output_dir):
+    """
+    Main function for processing duplicate geometry checks.
 
-    # Insert entity_a_organisation_name after entity_a_organisation
-    a_cols = df_matches.columns.tolist()
-    a_index = a_cols.index("entity_a_organisation") + 1
-    a_cols.insert(a_index, a_cols.pop(a_cols.index("entity_a_organisation_name")))
-    df_matches = df_matches[a_cols]
+    - Downloads expectations with 'duplicate_geometry_check' operation.
+    - Streams match records from the parsed details, enriching them with entity
+      and organisation metadata and writing them out in chunks.
+    - Outputs both detailed and summary CSVs to the specified output directory.
 
-    # Add readable name for entity_b_organisation
-    df_matches = df_matches.merge(
-        df_org,
-        how="left",
-        left_on="entity_b_organisation",
-        right_on="organisation_entity"
-    ).rename(columns={"organisation_name": "entity_b_organisation_name"}).drop(columns=["organisation_entity"])
+    Args:
+        output_dir (str): Directory to save the CSVs to.
+    """
 
-    # Insert entity_b_organisation_name after entity_b_organisation
-    b_cols = df_matches.columns.tolist()
-    b_index = b_cols.index("entity_b_organisation") + 1
-    b_cols.insert(b_index, b_cols.pop(b_cols.index("entity_b_organisation_name")))
-    df_matches = df_matches[b_cols]
+    # Load expectation records where operation is 'duplicate_geometry_check' (filtered by Datasette)
+    url = "https://datasette.planning.data.gov.uk/digital-land/expectation.csv?_stream=on"
+    df = read_datasette_csv(url, params={"operation": "duplicate_geometry_check"})
+    df = df[df["operation"] == "duplicate_geometry_check"]
+
+    # Lookup tables for enrichment (entity metadata is refreshed incrementally, without geometry)
+    entity_index = EntityIndex()
+    for dataset in ENTITY_DATASETS:
+        entity_index.refresh(dataset)
+    df_org = load_table("organisation", columns=["entity", "name"]).rename(columns={
+        "entity": "organisation_entity",
+        "name": "organisation_name"
+    })
 
-    # Save detailed match output
+    # Save detailed match output, one chunk at a time
     os.makedirs(output_dir, exist_ok=True)
     matches_csv = os.path.join(output_dir, "duplicate_entity_expectation.csv")
-    df_matches.to_csv(matches_csv, index=False)
-
-    # Re-parse stats and generate summary view
-    df["details_parsed"] = df["details"].apply(parse_details)
-    stats_df = pd.concat([df[["dataset", "severity"]], df["details_parsed"].apply(extract_stats)], axis=1)
-    stats_df = stats_df.sort_values(by="complete_match_count", ascending=False).reset_index(drop=True)
+    stats = []
+    header = True
+    for chunk in iter_chunks(iter_matches(df, stats)):
+        enriched = enrich_matches(chunk, entity_index, df_org)
+        with span("write", rows=len(enriched)):
+            enriched.to_csv(matches_csv, index=False, header=header, mode="w" if header else "a")
+        header = False
+    if header:
+        # No matches: write the header only
+        enrich_matches(pd.DataFrame(columns=MATCH_COLUMNS), entity_index, df_org).to_csv(matches_csv, index=False)
+
+    # Summary view from the stats gathered while parsing
+    stats_df = pd.DataFrame(stats, columns=[
+        "dataset", "severity", "actual", "expected", "complete_match_count", "single_match_count"
+    ], dtype=object)
+    stats_df = stats_df.sort_values(by="complete_match_count", ascending=False, kind="stable").reset_index(drop=True)
 
     # Save summary CSV
     summary_csv = os.path.join(output_dir, "duplicate_entity_expectation_summary.csv")
-    stats_df.drop(columns=["complete_matches", "single_matches"]).to_csv(summary_csv, index=False)
+    with span("write", rows=len(stats_df)):
+        stats_df.to_csv(summary_csv, index=False)
 
 # Entry point
 if __name__ == "__main__":
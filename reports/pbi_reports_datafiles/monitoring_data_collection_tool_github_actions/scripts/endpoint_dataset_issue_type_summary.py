@@ -1,28 +1,49 @@
-import pandas as pd
 import os
 import argparse
+from _snapshot import load_table
+from _metrics import span
+
+# Upstream tables read by this script (used by run.py to schedule scripts)
+READS = [
+    "snapshot/endpoint_dataset_issue_type_summary",
+]
 
 def full_datasette_table(tables, output_dir):
     """
-    Downloads full tables from Datasette in CSV format using streaming.
+    Exports full tables to CSV from their Parquet snapshots (or from Datasette if no snapshot is available).
 
     Args:
-        tables (dict): A dictionary where keys are table names and values are their Datasette URLs.
+        tables (dict): A dictionary where keys are output names and values are snapshot table names.
         output_dir (str): The directory to save the exported CSV files.
     """
     os.makedirs(output_dir, exist_ok=True)  # Ensure output directory exists
 
-    for name, url in tables.items():
-        full_url = f"{url}.csv?_stream=on"  # Enable full streaming of rows
+    for name, table in tables.items():
         try:
-            df = pd.read_csv(full_url)  # Load full dataset
+            df = load_table(table)  # Load full dataset
             csv_name = f"{name}.csv"
             save_path = os.path.join(output_dir, csv_name)
-            df.to_csv(save_path, index=False)  # Save to CSV without index
+            with span("write", rows=len(df)):
+                df.to_csv(save_path, index=False)  # Save to CSV without index
             print(f"Saved: {save_path}")
         except Exception as e:
             print(f"[ERROR] Failed to fetch {name}: {e}")
 
+def main(output_dir):
+    """
+    Exports the issue type summary table.
+
+    Args:
+        output_dir (str): Directory to save the CSV to.
+    """
+    # Dictionary of output names and their snapshot tables
+    tables = {
+        "endpoint-dataset-issue-type-summary": "endpoint_dataset_issue_type_summary"
+    }
+
+    # Run export
+    full_datasette_table(tables, output_dir)
+
 def parse_args():
     """
     Parses command-line arguments for specifying the output directory.
@@ -42,12 +63,4 @@ def parse_args():
 if __name__ == "__main__":
     # Parse command-line arguments
     args = parse_args()
-
-    # Dictionary of table names and their Datasette URLs
-    tables = {
-        "endpoint-dataset-issue-type-summary":
-            "https://datasette.planning.data.gov.uk/performance/endpoint_dataset_issue_type_summary"
-    }
-
-    # Run export
-    full_datasette_table(tables, args.output_dir)
+    main(args.output_dir)
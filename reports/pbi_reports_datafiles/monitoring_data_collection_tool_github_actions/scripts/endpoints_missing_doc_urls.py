@@ -1,12 +1,19 @@
-import requests
 import pandas as pd
 import os
 import argparse
-
-# Constants
-DATASSETTE_URL = "https://datasette.planning.data.gov.uk/digital-land.json"
-
-# Base SQL query to retrieve endpoint metadata
+from _datasette import get_datasette_join_paged
+from _metrics import span
+
+# Upstream tables read by this script (used by run.py to schedule scripts)
+READS = [
+    "digital-land/endpoint",
+    "digital-land/source",
+    "digital-land/source_pipeline",
+    "digital-land/organisation",
+]
+
+# Base SQL query to retrieve endpoint metadata, one row per source_pipeline row.
+# `{page}` is one page of source_pipeline rows (see `get_datasette_join_paged`)
 BASE_SQL = """
 SELECT 
     o.name,
@@ -18,12 +25,10 @@ SELECT
     s.end_date,
     e.endpoint
 FROM 
-    endpoint e
-    INNER JOIN source s ON e.endpoint = s.endpoint
-    INNER JOIN source_pipeline sp ON s.source = sp.source
+    {page} sp
+    INNER JOIN source s ON s.source = sp.source
+    INNER JOIN endpoint e ON e.endpoint = s.endpoint
     INNER JOIN organisation o ON o.organisation = s.organisation
-ORDER BY s.entry_date DESC
-LIMIT 1000 OFFSET {offset}
 """
 
 def parse_args():
@@ -41,35 +46,20 @@ def parse_args():
 
 def fetch_endpoint_data():
     """
-    Fetches all endpoint metadata using paginated SQL from Datasette API.
+    Fetches all endpoint metadata from the Datasette API, paging on source_pipeline rowid.
 
     Returns:
-        pd.DataFrame: Combined result of all pages as a DataFrame.
+        pd.DataFrame: Combined result of all pages, newest entry first.
     """
-    all_rows, offset = [], 0
-    columns = []
-
-    while True:
-        paginated_sql = BASE_SQL.format(offset=offset)
-        response = requests.get(DATASSETTE_URL, params={"sql": paginated_sql, "_size": 1000})
-
-        if response.status_code != 200:
-            print("Failed to fetch data from Datasette.")
-            break
-
-        json_data = response.json()
-        rows = json_data.get("rows", [])
-
-        if not rows:
-            break
-
-        if offset == 0:
-            columns = json_data.get("columns", [])
+    try:
+        df = get_datasette_join_paged("digital-land", BASE_SQL, table="source_pipeline")
+    except Exception as e:
+        print(f"Failed to fetch data from Datasette: {e}")
+        return pd.DataFrame()
 
-        all_rows.extend(rows)
-        offset += 1000
-
-    return pd.DataFrame(all_rows, columns=columns) if all_rows else pd.DataFrame()
+    if df.empty:
+        return df
+    return df.sort_values("entry_date", ascending=False, kind="stable").reset_index(drop=True)
 
 def analyze_missing_docs(df):
     """
@@ -125,14 +115,17 @@ def save_results(df, output_dir):
     os.makedirs(output_dir, exist_ok=True)
     #filtered = df.query("documentation_missing and is_active")
     output_path = os.path.join(output_dir, "all-endpoints-and-documentation-urls.csv")
-    df.to_csv(output_path, index=False)
+    with span("write", rows=len(df)):
+        df.to_csv(output_path, index=False)
     print(f"CSV saved: {output_path}")
 
-def main():
+def main(output_dir):
     """
     Main workflow to fetch, analyze, and save data.
+
+    Args:
+        output_dir (str): Output directory path.
     """
-    args = parse_args()
     df = fetch_endpoint_data()
 
     if df.empty:
@@ -140,7 +133,8 @@ def main():
         return
 
     df = analyze_missing_docs(df)
-    save_results(df, args.output_dir)
+    save_results(df, output_dir)
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    main(args.output_dir)
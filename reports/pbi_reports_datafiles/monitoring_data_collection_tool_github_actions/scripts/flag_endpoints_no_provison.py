@@ -1,41 +1,102 @@
-import pandas as pd
 import argparse
 import os
+from _snapshot import load_table
+from _pushdown import pushdown_query
+from _metrics import span
+
+# Upstream tables read by this script (used by run.py to schedule scripts)
+READS = [
+    "digital-land/endpoint",
+    "digital-land/source",
+    "digital-land/organisation",
+    "digital-land/resource_endpoint",
+    "digital-land/resource_dataset",
+    "digital-land/provision",
+]
+
+OUTPUT_COLUMNS = ["endpoint", "source", "collection", "endpoint_url", "organisation", "dataset"]
+
+# Live endpoints with no provision for their (dataset, organisation), in the same
+# row order as `missing_provisions_locally()`. Empty strings count as missing
+# values, the latest resource per endpoint and dataset per resource are the last
+# rows in table order, and `IS` matches missing values the way pandas merges do.
+# `{page}` is the live endpoint rows of one page (see `get_datasette_join_paged`).
+MISSING_PROVISIONS_SQL = """
+    WITH live_org AS (
+        SELECT name AS organisation, reference AS organisation_ref
+        FROM organisation
+        WHERE COALESCE(end_date, '') = ''
+    ),
+    latest_resource AS (
+        SELECT endpoint, resource FROM resource_endpoint
+        WHERE rowid IN (SELECT MAX(rowid) FROM resource_endpoint GROUP BY endpoint)
+    ),
+    latest_dataset AS (
+        SELECT resource, dataset FROM resource_dataset
+        WHERE rowid IN (SELECT MAX(rowid) FROM resource_dataset GROUP BY resource)
+    ),
+    provisioned AS (
+        SELECT p.dataset, o.organisation
+        FROM provision p
+        LEFT JOIN live_org o
+            ON o.organisation_ref = substr(p.organisation, instr(p.organisation, ':') + 1)
+    ),
+    endpoint_rows AS (
+        SELECT
+            e.endpoint,
+            s.source,
+            s.collection,
+            e.endpoint_url,
+            o.organisation,
+            d.dataset
+        FROM {page} e
+        LEFT JOIN source s ON s.endpoint = e.endpoint
+        LEFT JOIN live_org o
+            ON o.organisation_ref = substr(s.organisation, instr(s.organisation, ':') + 1)
+        LEFT JOIN latest_resource r ON r.endpoint = e.endpoint
+        LEFT JOIN latest_dataset d ON d.resource = r.resource
+    )
+    SELECT * FROM endpoint_rows er
+    WHERE NOT EXISTS (
+        SELECT 1 FROM provisioned p
+        WHERE p.dataset IS er.dataset AND p.organisation IS er.organisation
+    )
+"""
 
-def endpoint_provisions_check(output_dir, include_pdf):
+def missing_provisions_locally():
+    """
+    Finds live endpoints with no provision for their (dataset, organisation) from the full tables.
+
+    Returns:
+        pd.DataFrame: Endpoint rows with OUTPUT_COLUMNS.
+    """
     # Fetch and filter Endpoint table
-    endpoint_url = "https://datasette.planning.data.gov.uk/digital-land/endpoint.csv?_stream=on"
-    df0 = pd.read_csv(endpoint_url)
+    df0 = load_table("endpoint", columns=["endpoint", "end_date", "endpoint_url"])
     df0 = df0[df0['end_date'].isna()]  # Keep only active endpoints
     df_endpoint = df0[["endpoint", "end_date", "endpoint_url"]].copy()
 
     # Fetch and process Source table
-    source_url = "https://datasette.planning.data.gov.uk/digital-land/source.csv?_stream=on"
-    df1 = pd.read_csv(source_url)
+    df1 = load_table("source", columns=["endpoint", "source", "collection", "organisation"])
     df1["organisation_ref"] = df1["organisation"].str.replace(r"^.*?:", "", regex=True).astype(str)
     df_source = df1[["endpoint", "source", "collection","organisation_ref"]].copy()
 
     # Fetch and filter Organisation table
-    org_url = "https://datasette.planning.data.gov.uk/digital-land/organisation.csv?_stream=on"
-    df2 = pd.read_csv(org_url)
+    df2 = load_table("organisation", columns=["name", "reference", "end_date"])
     df2 = df2[df2['end_date'].isna()]
     df2["reference"] = df2["reference"].astype(str)
     df_org = df2[["name", "reference"]].copy()
     df_org.rename(columns={"name": "organisation", "reference": "organisation_ref"}, inplace=True)
 
     # Fetch and deduplicate Resource_endpoint table
-    resource_endpoint_url = "https://datasette.planning.data.gov.uk/digital-land/resource_endpoint.csv?_stream=on"
-    df3 = pd.read_csv(resource_endpoint_url)
+    df3 = load_table("resource_endpoint", columns=["endpoint", "resource"])
     df_resource_endpoint = df3[["endpoint", "resource"]].drop_duplicates(subset="endpoint", keep="last")
 
     # Fetch and deduplicate Resource_dataset table
-    resource_dataset_url = "https://datasette.planning.data.gov.uk/digital-land/resource_dataset.csv?_stream=on"
-    df4 = pd.read_csv(resource_dataset_url)
+    df4 = load_table("resource_dataset", columns=["dataset", "resource"])
     df_resource_dataset = df4[["dataset", "resource"]].drop_duplicates(subset="resource", keep="last")
 
     # Fetch and process Provisions table
-    provisions_url = "https://datasette.planning.data.gov.uk/digital-land/provision.csv?_stream=on"
-    df5 = pd.read_csv(provisions_url)
+    df5 = load_table("provision", columns=["dataset", "organisation"])
     df5["organisation"] = df5["organisation"].str.replace(r"^.*?:", "", regex=True).astype(str)
     df_provisions = df5[["dataset", "organisation"]].copy()
     df_provisions.rename(columns={"organisation": "organisation_ref"}, inplace=True)
@@ -61,7 +122,19 @@ def endpoint_provisions_check(output_dir, include_pdf):
     df_full = df_final.merge(df_provisions, on=["dataset", "organisation"], how="left", indicator=True)
 
     # Keep only rows not in provision
-    df_missing = df_full[df_full["_merge"] == "left_only"].drop(columns=["_merge", "end_date"])
+    return df_full[df_full["_merge"] == "left_only"].drop(columns=["_merge", "end_date"])
+
+def endpoint_provisions_check(output_dir, include_pdf):
+    # Anti-join on Datasette, downloading the six tables only if that fails
+    df_missing = pushdown_query(
+        "digital-land",
+        MISSING_PROVISIONS_SQL,
+        local=missing_provisions_locally,
+        table="endpoint",
+        where="COALESCE(end_date, '') = ''",
+        columns=OUTPUT_COLUMNS,
+        name="flag_endpoints_no_provision",
+    )
 
     # Separate PDF rows
     pdf_mask = df_missing["endpoint_url"].fillna("").str.lower().str.endswith(".pdf")
@@ -70,7 +143,8 @@ def endpoint_provisions_check(output_dir, include_pdf):
 
     # Save PDFs separately
     pdf_path = os.path.join(output_dir, "flag_endpoints_pdf_only.csv")
-    df_pdfs.to_csv(pdf_path, index=False)
+    with span("write", rows=len(df_pdfs)):
+        df_pdfs.to_csv(pdf_path, index=False)
 
     # Save main CSV (either with or without PDFs)
     if include_pdf:
@@ -79,7 +153,17 @@ def endpoint_provisions_check(output_dir, include_pdf):
         final_output = df_non_pdfs
 
     csv_path = os.path.join(output_dir, "flag_endpoints_no_provision.csv")
-    final_output.to_csv(csv_path, index=False)
+    with span("write", rows=len(final_output)):
+        final_output.to_csv(csv_path, index=False)
+
+def main(output_dir):
+    """
+    Flags endpoints with no provision, including .pdf endpoint URLs in the main output.
+
+    Args:
+        output_dir (str): Directory to save the CSVs to.
+    """
+    endpoint_provisions_check(output_dir, include_pdf=True)
 
 def parse_args():
     """
@@ -102,4 +186,4 @@ def parse_args():
 
 if __name__ == "__main__":
     args = parse_args()
-    endpoint_provisions_check(args.output_dir, include_pdf=True)
\ No newline at end of file
+    main(args.output_dir)
\ No newline at end of file
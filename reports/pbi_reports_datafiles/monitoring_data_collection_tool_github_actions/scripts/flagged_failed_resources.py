@@ -8,81 +8,146 @@ Usage:
 """
 
 import os
+import json
 import argparse
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 import pandas as pd
 import requests
-from io import StringIO
-
-def is_pdf_url(url):
-    """Check if URL points to a PDF by sending a HEAD request and inspecting Content-Type."""
-    try:
-        response = requests.head(url, allow_redirects=True, timeout=5)
-        content_type = response.headers.get("Content-Type", "").lower()
-        return "application/pdf" in content_type
-    except:
-        return False
-
-def fetch_text_content(url):
-    """Fetch and return lowercased plain text content of a URL (used for WFS error detection)."""
-    try:
-        r = requests.get(url, timeout=8)
-        if r.status_code == 200:
-            return r.text.lower()
-        return ""
-    except:
-        return ""
-
-def classify_issue(row):
+from requests.adapters import HTTPAdapter
+from _datasette import read_datasette_csv
+from _snapshot import load_table
+from _metrics import span, record_http
+
+# Upstream tables read by this script (used by run.py to schedule scripts)
+READS = [
+    "digital-land/converted_resource",
+    "digital-land/resource",
+    "snapshot/endpoint",
+    "snapshot/resource_endpoint",
+    "snapshot/source",
+]
+
+# URL probing: each endpoint URL is fetched once, a few at a time per host
+PROBE_WORKERS = 32
+PROBE_PER_HOST = 4
+PROBE_BYTES = 16 * 1024
+PROBE_TIMEOUT = (5, 8)
+
+EXT_MAP = {
+    ".pdf": "pdf", ".doc": "doc", ".docx": "docx",
+    ".xls": "xls", ".xlsx": "xlsx", ".ppt": "ppt", ".pptx": "pptx"
+}
+
+def classify_url(url):
     """
-    Classify each row by examining the endpoint URL and exception content.
-    Returns a tuple (group, details) with the error category and advice.
+    Classify a URL from its text alone (file extensions and slugs), without requesting it.
+    Returns a tuple (group, details), or None if the URL has to be probed.
     """
-    url = str(row.get("endpoint_url") or "").strip()
-    exc = str(row.get("exception") or "").lower()
-
-    ext_map = {
-        ".pdf": "pdf", ".doc": "doc", ".docx": "docx",
-        ".xls": "xls", ".xlsx": "xlsx", ".ppt": "ppt", ".pptx": "pptx"
-    }
-
     if ".zip" in url.lower():
         return ("zipped file", "file needs to be unzipped first")
 
-    for ext, label in ext_map.items():
+    for ext, label in EXT_MAP.items():
         if ext in url.lower():
             if label == "xls":
                 return ("XLS files", "Possible issues with opening xls file")
             return ("active document links", f"{label} file in URL")
 
-    for label in ext_map.values():
+    for label in EXT_MAP.values():
         if f"-{label}" in url.lower():
             if label == "xls":
                 return ("XLS files", "Possible issues with opening xls file")
             return ("active document links", f"{label} inferred from slug")
 
-    if is_pdf_url(url):
+    return None
+
+def probe_url(session, url, host_limits):
+    """
+    GET a URL once, keeping the status, Content-Type and the first PROBE_BYTES of the body.
+    Returns a dict, or None if the request failed.
+    """
+    with host_limits[urlsplit(url).netloc]:
+        try:
+            with session.get(url, stream=True, timeout=PROBE_TIMEOUT) as r:
+                body = b""
+                for chunk in r.iter_content(4096):
+                    body += chunk
+                    if len(body) >= PROBE_BYTES:
+                        break
+                record_http(bytes_downloaded=len(body))
+                return {
+                    "status": r.status_code,
+                    "content_type": r.headers.get("Content-Type", "").lower(),
+                    "text": body[:PROBE_BYTES].decode(r.encoding or "utf-8", errors="replace"),
+                }
+        except Exception:
+            return None
+
+def probe_urls(urls, workers=PROBE_WORKERS, per_host=PROBE_PER_HOST):
+    """
+    Probe each distinct URL once, concurrently, with at most `per_host` requests open per host.
+    Returns a dict of url -> probe result (see `probe_url`).
+    """
+    urls = list(dict.fromkeys(urls))
+    host_limits = defaultdict(lambda: threading.BoundedSemaphore(per_host))
+    for url in urls:
+        host_limits[urlsplit(url).netloc]  # create every semaphore before the threads start
+
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_maxsize=per_host))
+    session.mount("https://", HTTPAdapter(pool_maxsize=per_host))
+    with session, ThreadPoolExecutor(max_workers=workers) as executor, span("probe", rows=len(urls)):
+        results = executor.map(lambda url: probe_url(session, url, host_limits), urls)
+        return dict(zip(urls, results))
+
+def classify_probe(url, probe):
+    """
+    Classify a URL from its probe response: PDFs by Content-Type, auth errors
+    from JSON or text bodies, and WFS service exceptions.
+    Returns a tuple (group, details).
+    """
+    if probe is None:
+        return (None, "")
+
+    if "application/pdf" in probe["content_type"]:
         return ("active document links", "confirmed via Content-Type check")
 
     try:
-        r = requests.get(url, timeout=8)
-        if r.headers.get("Content-Type", "").lower().startswith("application/json"):
-            json_body = r.json()
-            error = json_body.get("error", {})
+        if probe["content_type"].startswith("application/json"):
+            error = json.loads(probe["text"]).get("error", {})
             if str(error.get("code", "")).strip() == "499" or "token" in error.get("message", "").lower():
                 return ("auth error", "Token or authentication required (JSON error response)")
-        elif "token required" in r.text.lower():
+        elif "token required" in probe["text"].lower():
             return ("auth error", "Token or authentication required (text body)")
-    except:
+    except Exception:
         pass
 
     if "getfeature" in url.lower() or "wfs" in url.lower():
-        text = fetch_text_content(url)
+        text = probe["text"].lower() if probe["status"] == 200 else ""
         if "serviceexception" in text and "feature" in text:
             return ("wfs error", "Likely invalid typeName - check WFS GetCapabilities")
 
     return (None, "")
 
+def classify_issues(urls):
+    """
+    Classify each endpoint URL, probing only the URLs that cannot be classified from their text.
+    Returns a list of (group, details) tuples, in the order of `urls`.
+    """
+    urls = [str(url or "").strip() for url in urls]
+    static = [classify_url(url) for url in urls]
+    probes = probe_urls([url for url, result in zip(urls, static) if result is None and url])
+    return [
+        result if result is not None else classify_probe(url, probes.get(url))
+        for url, result in zip(urls, static)
+    ]
+
 def main(output_dir):
+    """
+    Classify failed resources and save flagged_failed_resources.csv to `output_dir`.
+    """
     # Load failed resources
     csv_url = (
         "https://datasette.planning.data.gov.uk/digital-land.csv?"
@@ -91,12 +156,12 @@ def main(output_dir):
         "where+status%3D'failed'+and+(r.end_date+is+null+or+r.end_date%3D'')+"
         "order+by+r.start_date+desc+limit+1000"
     )
-    df_failed = pd.read_csv(StringIO(requests.get(csv_url).text))
+    df_failed = read_datasette_csv(csv_url)
 
     # Supporting metadata
-    df_endpoint = pd.read_csv("https://datasette.planning.data.gov.uk/digital-land/endpoint.csv?_stream=on")[["endpoint", "endpoint_url"]]
-    df_resource_endpoint = pd.read_csv("https://datasette.planning.data.gov.uk/digital-land/resource_endpoint.csv?_stream=on")[["endpoint", "resource"]]
-    df_source_raw = pd.read_csv("https://datasette.planning.data.gov.uk/digital-land/source.csv?_stream=on")
+    df_endpoint = load_table("endpoint", columns=["endpoint", "endpoint_url"])
+    df_resource_endpoint = load_table("resource_endpoint", columns=["endpoint", "resource"])
+    df_source_raw = load_table("source", columns=["endpoint", "source", "collection", "organisation"])
     df_source_raw["organisation_ref"] = df_source_raw["organisation"].str.replace(r"^.*?:", "", regex=True).astype(str)
     df_source = df_source_raw[["endpoint", "source", "collection", "organisation_ref"]]
 
@@ -108,7 +173,9 @@ def main(output_dir):
     df = df.merge(df_source, on="endpoint", how="left")
 
     # Classify
-    df[["group", "details"]] = df.apply(lambda row: pd.Series(classify_issue(row)), axis=1)
+    df[["group", "details"]] = pd.DataFrame(
+        classify_issues(df["endpoint_url"]), index=df.index, columns=["group", "details"]
+    )
 
     # Manual patches
     force_pdf_urls = [
@@ -127,7 +194,8 @@ def main(output_dir):
     df_out = df[[
         "resource", "source", "collection", "endpoint_url", "group", "details", "recommend_retirement"
     ]]
-    df_out.to_csv(output_path, index=False)
+    with span("write", rows=len(df_out)):
+        df_out.to_csv(output_path, index=False)
     print(f"Saved {len(df_out)} rows to {output_path}")
 
 if __name__ == "__main__":
@@ -5,14 +5,23 @@ performance summary for each dataset per organisation.
 """
 
 import json
-import logging
 import numpy as np
 import pandas as pd
-import requests
-from requests import adapters
-from urllib3 import Retry
 import argparse
 import os
+from _datasette import get_datasette_query, get_datasette_join_paged
+from _metrics import span
+
+# Upstream tables read by this script (used by run.py to schedule scripts)
+READS = [
+    "digital-land/provision",
+    "digital-land/cohort",
+    "digital-land/organisation",
+    "performance/endpoint_dataset_resource_summary",
+    "performance/reporting_latest_endpoints",
+    "performance/endpoint_dataset_summary",
+    "performance/endpoint_dataset_issue_type_summary",
+]
 
 def parse_args():
     """
@@ -30,49 +39,6 @@ def parse_args():
     )
     return parser.parse_args()
 
-def get_datasette_http():
-    """
-    Creates and returns a requests.Session object with retry logic built in.
-    Used for robust querying of Datasette endpoints.
-    """
-    retry_strategy = Retry(total=3, status_forcelist=[400], backoff_factor=0)
-
-    adapter = adapters.HTTPAdapter(max_retries=retry_strategy)
-
-    http = requests.Session()
-    http.mount("https://", adapter)
-    http.mount("http://", adapter)
-
-    return http
-
-
-def get_datasette_query(db, sql, filter=None, url="https://datasette.planning.data.gov.uk"):
-    """
-    Executes an SQL query against a Datasette database and returns the result as a DataFrame.
-
-    Args:
-        db (str): The database name (e.g. 'digital-land')
-        sql (str): SQL query string
-        filter (dict, optional): Additional query parameters
-        url (str): Base Datasette URL
-
-    Returns:
-        pd.DataFrame | None: Query result as a DataFrame or None on failure
-    """
-    url = f"{url}/{db}.json"
-    params = {"sql": sql, "_shape": "array", "_size": "max"}
-    if filter:
-        params.update(filter)
-    try:
-        http = get_datasette_http()
-        resp = http.get(url, params=params)
-        resp.raise_for_status()
-        df = pd.DataFrame.from_dict(resp.json())
-        return df
-    except Exception as e:
-        logging.warning(e)
-        return None
-
 def get_provisions(selected_cohorts, all_cohorts):
     """
     Queries the Datasette 'provision' table for expected datasets for selected cohorts.
@@ -162,20 +128,24 @@ COHORTS = [
 ]
 
 
-def get_column_field_summary(dataset_clause, offset):
+def get_column_field_summary(dataset_clause):
     """
     Retrieves endpoint dataset resource summaries for datasets matching the clause.
 
+    Pages on the rowid of endpoint_dataset_resource_summary, so every row is fetched however
+    many there are.
+
     Args:
         dataset_clause (str): SQL filter for datasets (e.g. "edrs.pipeline = 'tree'")
-        offset (int): Row offset for pagination
 
     Returns:
         pd.DataFrame: Results from `endpoint_dataset_resource_summary` joined with endpoint metadata.
     """
     sql = f"""
-    SELECT edrs.*, rle.licence
-    FROM endpoint_dataset_resource_summary AS edrs
+    SELECT
+        edrs.*,
+        rle.licence
+    FROM {{page}} AS edrs
     LEFT JOIN (
         SELECT endpoint, licence, dataset
         FROM reporting_latest_endpoints
@@ -187,30 +157,29 @@ def get_column_field_summary(dataset_clause, offset):
     WHERE edrs.resource != ''
     and eds.endpoint_end_date=''
     and ({dataset_clause})
-    limit 1000 offset {offset}
     """
-    column_field_df = get_datasette_query("performance", sql)
+    column_field_df = get_datasette_join_paged(
+        "performance", sql, table="endpoint_dataset_resource_summary"
+    )
 
     return column_field_df
 
 
-def get_issue_summary(dataset_clause, offset):
+def get_issue_summary(dataset_clause):
     """
     Retrieves summarised issue counts per dataset and endpoint.
 
     Args:
         dataset_clause (str): SQL WHERE clause to filter datasets.
-        offset (int): Pagination offset for result set.
 
     Returns:
         pd.DataFrame: Issue summary from Datasette.
     """
     sql = f"""
-    select  * from endpoint_dataset_issue_type_summary edrs
+    select edrs.* from {{page}} edrs
     where ({dataset_clause})
-    limit 1000 offset {offset}
     """
-    issue_summary_df = get_datasette_query("performance", sql)
+    issue_summary_df = get_datasette_join_paged("performance", sql, table="endpoint_dataset_issue_type_summary")
     return issue_summary_df
 
 
@@ -246,19 +215,8 @@ def get_odp_conformance_summary(dataset_types, cohorts):
     provision_df = get_provisions(cohorts, COHORTS)
 
     # Download column field summary table
-    # Use pagination in case rows returned > 1000
-    pagination_incomplete = True
-    offset = 0
-    column_field_df_list = []
-    while pagination_incomplete:
-        column_field_df = get_column_field_summary(dataset_clause, offset)
-        column_field_df_list.append(column_field_df)
-        pagination_incomplete = len(column_field_df) == 1000
-        offset += 1000
-    if len(column_field_df_list) == 0:
-        return {"params": params, "rows": [], "headers": []}
-    column_field_df = pd.concat(column_field_df_list)
-      
+    column_field_df = get_column_field_summary(dataset_clause)
+
     column_field_df = pd.merge(
         column_field_df, provision_df, on=["organisation", "cohort"], how="left"
     )
@@ -268,15 +226,7 @@ def get_odp_conformance_summary(dataset_types, cohorts):
     column_field_df["cohort_start_date"] = column_field_df["cohort_start_date"].fillna("")
 
     # Download issue summary table
-    pagination_incomplete = True
-    offset = 0
-    issue_df_list = []
-    while pagination_incomplete:
-        issue_df = get_issue_summary(dataset_clause, offset)
-        issue_df_list.append(issue_df)
-        pagination_incomplete = len(issue_df) == 1000
-        offset += 1000
-    issue_df = pd.concat(issue_df_list)
+    issue_df = get_issue_summary(dataset_clause)
 
     dataset_field_df = get_dataset_field()
 
@@ -293,81 +243,34 @@ def get_odp_conformance_summary(dataset_types, cohorts):
         & (~dataset_field_df["field"].isin(["entity", "organisation", "prefix"]))
     ]
 
-    # Filter out fields not in spec
-    column_field_df["mapping_field"] = column_field_df.replace({'"', ""}).apply(
-        lambda row: [
-            field
-            for field in (
-                row["mapping_field"].split(";") if row["mapping_field"] else ""
-            )
-            if field
-            in dataset_field_df[dataset_field_df["dataset"] == row["dataset"]][
-                "field"
-            ].values
-        ],
-        axis=1,
+    # Index of (dataset, field) pairs in the specification, and number of spec fields per dataset
+    spec_fields = dataset_field_df[["dataset", "field"]].drop_duplicates()
+    spec_field_index = pd.MultiIndex.from_frame(spec_fields)
+    spec_field_counts = dataset_field_df.groupby("dataset").size()
+
+    # Count supplied fields that are in the spec for each row's dataset
+    column_field_df["field_matched"] = count_spec_fields(column_field_df, "mapping_field", spec_fields)
+    column_field_df["field_supplied"] = column_field_df["field_matched"] + count_spec_fields(
+        column_field_df, "non_mapping_field", spec_fields
     )
-    column_field_df["non_mapping_field"] = column_field_df.replace({'"', ""}).apply(
-        lambda row: [
-            field
-            for field in (
-                row["non_mapping_field"].split(";") if row["non_mapping_field"] else ""
-            )
-            if field
-            in dataset_field_df[dataset_field_df["dataset"] == row["dataset"]][
-                "field"
-            ].values
-        ],
-        axis=1,
+    column_field_df["field"] = (
+        column_field_df["dataset"].map(spec_field_counts).fillna(0).astype(int)
     )
 
     # Map entity errors to reference field
     issue_df["field"] = issue_df["field"].replace("entity", "reference")
     # Filter out issues for fields not in dataset field (specification)
-    issue_df["field"] = issue_df.apply(
-        lambda row: (
-            row["field"]
-            if row["field"]
-            in dataset_field_df[dataset_field_df["dataset"] == row["dataset"]][
-                "field"
-            ].values
-            else None
-        ),
-        axis=1,
-    )
-
-    # Create field matched and field supplied scores
-    column_field_df["field_matched"] = column_field_df.apply(
-        lambda row: len(row["mapping_field"]) if row["mapping_field"] else 0, axis=1
-    )
-    column_field_df["field_supplied"] = column_field_df.apply(
-        lambda row: row["field_matched"]
-        + (len(row["non_mapping_field"]) if row["non_mapping_field"] else 0),
-        axis=1,
-    )
-    column_field_df["field"] = column_field_df.apply(
-        lambda row: len(
-            dataset_field_df[dataset_field_df["dataset"] == row["dataset"]]
-        ),
-        axis=1,
-    )
-
-    # Check for fields which have error issues
-    results_issues = [
-        issue_df[
-            (issue_df["resource"] == r["resource"]) & (issue_df["severity"] == "error")
-        ]
-        for index, r in column_field_df.iterrows()
-    ]
-    results_issues_df = pd.concat(results_issues)
-
-    # Create fields with errors column
-    column_field_df["field_errors"] = column_field_df.apply(
-        lambda row: len(
-            results_issues_df[row["resource"] == results_issues_df["resource"]]
-        ),
-        axis=1,
-    )
+    issue_in_spec = pd.MultiIndex.from_frame(issue_df[["dataset", "field"]]).isin(spec_field_index)
+    issue_df["field"] = issue_df["field"].astype(object).where(issue_in_spec, None)
+
+    # Count error issues per resource. Each column field row counts every error issue
+    # for its resource once per column field row sharing that resource.
+    error_counts = issue_df.loc[issue_df["severity"] == "error", "resource"].value_counts()
+    resource_rows = column_field_df["resource"].value_counts()
+    column_field_df["field_errors"] = (
+        column_field_df["resource"].map(error_counts).fillna(0)
+        * column_field_df["resource"].map(resource_rows).fillna(0)
+    ).astype(int)
 
     # Create endpoint ID column to track multiple endpoints per organisation-dataset
     column_field_df["endpoint_no."] = (
@@ -570,6 +473,29 @@ def get_odp_conformance_summary(dataset_types, cohorts):
         "percent_100_field_match": percent_100_field_match,
     }, final_count[csv_out_cols]
 
+def count_spec_fields(column_field_df, column, spec_fields):
+    """
+    Counts the ';'-separated fields in a column that are in the specification for the row's dataset.
+
+    Args:
+        column_field_df (pd.DataFrame): Rows with a 'dataset' column and the field list column.
+        column (str): Column holding ';'-separated field names (e.g. 'mapping_field').
+        spec_fields (pd.DataFrame): Unique (dataset, field) pairs from the specification.
+
+    Returns:
+        pd.Series: Count per row, aligned to `column_field_df`'s index.
+    """
+    exploded = (
+        column_field_df[["dataset", column]]
+        .rename(columns={column: "field"})
+        .rename_axis("_row")
+        .reset_index()
+    )
+    exploded["field"] = exploded["field"].fillna("").astype(str).str.split(";")
+    exploded = exploded.explode("field")
+    matched = exploded.merge(spec_fields, on=["dataset", "field"], how="inner")
+    return matched.groupby("_row").size().reindex(column_field_df.index, fill_value=0)
+
 def make_pretty(text):
     """
     Formats text or numerical values for presentation in the UI or report tables.
@@ -626,10 +552,13 @@ def get_dataset_field():
                 rows.append({"dataset": dataset, "field": field})
     return pd.DataFrame(rows)
 
-if __name__ == "__main__":
-    # Parse CLI args
-    args = parse_args()
-    output_dir = args.output_dir 
+def main(output_dir):
+    """
+    Generates the ODP conformance summary and saves odp-conformance.csv.
+
+    Args:
+        output_dir (str): Directory to save the CSV to.
+    """
     output_path = os.path.join(output_dir, "odp-conformance.csv")
 
     # Run summary function and filter invalid cohort rows
@@ -637,6 +566,12 @@ if __name__ == "__main__":
     df = df[df['cohort'].notna() & (df['cohort'].str.strip() != "")]
 
     # Save final output
-    df.to_csv(output_path, index=False)
+    with span("write", rows=len(df)):
+        df.to_csv(output_path, index=False)
     print(f"Saved ODP conformance summary to {output_path}")
 
+if __name__ == "__main__":
+    # Parse CLI args
+    args = parse_args()
+    main(args.output_dir)
+
@@ -11,10 +11,17 @@ The script:
 
 import os
 import pandas as pd
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util import Retry
 import argparse
+from _datasette import get_datasette_query
+from _metrics import span
+
+# Upstream tables read by this script (used by run.py to schedule scripts)
+READS = [
+    "digital-land/provision",
+    "digital-land/cohort",
+    "digital-land/organisation",
+    "performance/reporting_latest_endpoints",
+]
 
 # Dataset to Pipeline Map
 ALL_PIPELINES = {
@@ -28,44 +35,21 @@ ALL_PIPELINES = {
     ],
 }
 
-# Datasette Query Helpers
-def get_datasette_http():
-    """
-    Returns a requests session with retry logic to handle larger Datasette queries.
-
-    Returns:
-        requests.Session: Session with retry strategy enabled.
-    """
-    retry_strategy = Retry(total=3, status_forcelist=[400], backoff_factor=0.2)
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    http = requests.Session()
-    http.mount("https://", adapter)
-    return http
-
-
-def get_datasette_query(db: str, sql: str, url="https://datasette.planning.data.gov.uk") -> pd.DataFrame:
-    """
-    Executes SQL against a Datasette database and returns the result as a DataFrame.
-
-    Args:
-        db (str): The name of the Datasette database (e.g., 'digital-land').
-        sql (str): SQL query string to run.
-        url (str): Base URL of the Datasette instance.
-
-    Returns:
-        pd.DataFrame: The result set, or empty DataFrame on error.
-    """
-    full_url = f"{url}/{db}.json"
-    params = {"sql": sql, "_shape": "array", "_size": "max"}
-
-    try:
-        http = get_datasette_http()
-        response = http.get(full_url, params=params)
-        response.raise_for_status()
-        return pd.DataFrame.from_dict(response.json())
-    except Exception as e:
-        print(f"Datasette query failed: {e}")
-        return pd.DataFrame()
+# Endpoint columns copied into the output (blank when no endpoint was added)
+ENDPOINT_COLUMNS = [
+    "endpoint",
+    "endpoint_url",
+    "licence",
+    "status",
+    "days_since_200",
+    "exception",
+    "resource",
+    "latest_log_entry_date",
+    "endpoint_entry_date",
+    "endpoint_end_date",
+    "resource_start_date",
+    "resource_end_date",
+]
 
 # Data Retrieval Functions
 def get_provisions():
@@ -137,75 +121,51 @@ def generate_odp_summary_csv(output_dir: str) -> str:
     """
     provisions = get_provisions()
     endpoints = get_endpoints()
-    output_rows = []
-
-    for _, row in provisions.iterrows():
-        organisation = row["organisation"]
-        cohort = row["cohort"]
-        name = row["name"]
-        cohort_start_date = row["cohort_start_date"]
-
-        for collection, pipelines in ALL_PIPELINES.items():
-            for pipeline in pipelines:
-                match = endpoints[
-                    (endpoints["organisation"] == organisation) &
-                    (endpoints["pipeline"] == pipeline)
-                ]
-
-                if not match.empty:
-                    # Endpoint(s) exist — add one row per match
-                    for _, ep in match.iterrows():
-                        output_rows.append({
-                            "organisation": organisation,
-                            "cohort": cohort,
-                            "name": name,
-                            "collection": collection,
-                            "pipeline": pipeline,
-                            "endpoint": ep["endpoint"],
-                            "endpoint_url": ep["endpoint_url"],
-                            "licence": ep["licence"],
-                            "status": ep["status"],
-                            "days_since_200": ep["days_since_200"],
-                            "exception": ep["exception"],
-                            "resource": ep["resource"],
-                            "latest_log_entry_date": ep["latest_log_entry_date"],
-                            "endpoint_entry_date": ep["endpoint_entry_date"],
-                            "endpoint_end_date": ep["endpoint_end_date"],
-                            "resource_start_date": ep["resource_start_date"],
-                            "resource_end_date": ep["resource_end_date"],
-                            "cohort_start_date": cohort_start_date,
-                        })
-                else:
-                    # No endpoint — mark as missing
-                    output_rows.append({
-                        "organisation": organisation,
-                        "cohort": cohort,
-                        "name": name,
-                        "collection": collection,
-                        "pipeline": pipeline,
-                        "endpoint": "No endpoint added",
-                        "endpoint_url": "",
-                        "licence": "",
-                        "status": "",
-                        "days_since_200": "",
-                        "exception": "",
-                        "resource": "",
-                        "latest_log_entry_date": "",
-                        "endpoint_entry_date": "",
-                        "endpoint_end_date": "",
-                        "resource_start_date": "",
-                        "resource_end_date": "",
-                        "cohort_start_date": cohort_start_date,
-                    })
-
-    # Convert output to DataFrame and save as CSV
-    df_final = pd.DataFrame(output_rows)
+
+    # Every provision crossed with every expected (collection, pipeline)
+    pipelines = pd.DataFrame(
+        [
+            {"collection": collection, "pipeline": pipeline}
+            for collection, collection_pipelines in ALL_PIPELINES.items()
+            for pipeline in collection_pipelines
+        ]
+    )
+    expected = provisions[["organisation", "cohort", "name", "cohort_start_date"]].merge(
+        pipelines, how="cross"
+    )
+
+    # One row per matching endpoint; object dtype keeps values as they were (no int -> float upcast)
+    matches = endpoints[["organisation", "pipeline"] + ENDPOINT_COLUMNS].astype(object)
+    df_final = expected.merge(matches, on=["organisation", "pipeline"], how="left", indicator=True)
+
+    # No endpoint — mark as missing
+    missing = df_final["_merge"] == "left_only"
+    df_final.loc[missing, ENDPOINT_COLUMNS] = ""
+    df_final.loc[missing, "endpoint"] = "No endpoint added"
+
+    df_final = df_final[
+        ["organisation", "cohort", "name", "collection", "pipeline"]
+        + ENDPOINT_COLUMNS
+        + ["cohort_start_date"]
+    ]
+
+    # Save as CSV
     os.makedirs(output_dir, exist_ok=True)
     output_path = os.path.join(output_dir, "odp-status.csv")
-    df_final.to_csv(output_path, index=False)
+    with span("write", rows=len(df_final)):
+        df_final.to_csv(output_path, index=False)
     print(f"CSV generated at {output_path} with {len(df_final)} rows")
     return output_path
 
+def main(output_dir):
+    """
+    Generates the ODP status CSV.
+
+    Args:
+        output_dir (str): Directory to save the CSV output.
+    """
+    generate_odp_summary_csv(output_dir)
+
 # CLI Parser
 def parse_args():
     """
@@ -227,7 +187,6 @@ def parse_args():
 if __name__ == "__main__":
     # Parse CLI arguments
     args = parse_args()
-    output_directory = args.output_dir
 
     # Generate and save ODP endpoint summary
-    generate_odp_summary_csv(output_directory)
+    main(args.output_dir)
@@ -1,58 +1,90 @@
-import requests
 import pandas as pd
-import urllib.parse
 import os
 import argparse
-
-def sql_queried_datasette_tables(urls: dict, sqls: list, save_dir: str):
+from _datasette import get_datasette_json
+from _incremental import PartitionedStore, update_store, window_start
+from _metrics import span
+
+# Upstream tables read by this script (used by run.py to schedule scripts)
+READS = [
+    "digital-land/log",
+]
+
+# SQL to group request status codes by week ({since} limits it to rows from the watermark onwards)
+LOGS_BY_WEEK_SQL = """
+    SELECT
+        COUNT(endpoint) AS endpoint_count,
+        SUBSTR(entry_date, 1, 10) AS entrydate,
+        DATE(entry_date, 'weekday 0', '-6 days') AS week_start,
+        CASE 
+            WHEN status = 200 THEN '200'
+            ELSE 'FAIL'
+        END AS status_group
+    FROM log
+    WHERE
+        entry_date >= DATE('now', '-6 months')
+        AND SUBSTR(entry_date, 1, 10) <= DATE(entry_date, 'weekday 0', '-6 days')
+        {since}
+    GROUP BY
+        entrydate,
+        week_start,
+        status_group
+    ORDER BY
+        entry_date DESC
+"""
+
+def fetch_logs_by_week(since=None):
     """
-    Fetches data from a dictionary of Datasette URLs using optional SQL queries
-    and saves each result as a CSV file in the specified directory.
+    Fetches the weekly request status counts from Datasette.
 
     Args:
-        urls (dict): Mapping of table names to Datasette base URLs.
-        sqls (list of str): SQL queries corresponding to each URL.
-        save_dir (str): Directory path where the resulting CSV files will be saved.
+        since (str, optional): Only count log entries from this date (YYYY-MM-DD) onwards.
+
+    Returns:
+        pd.DataFrame: One row per entry date and status group.
+    """
+    condition = f"AND entry_date >= '{since}'" if since else ""
+    data = get_datasette_json("digital-land", LOGS_BY_WEEK_SQL.format(since=condition), {"_shape": "array"})
+    print(f"Rows returned: {len(data)}")
+    df = pd.DataFrame(data)
 
-    Raises:
-        ValueError: If the lengths of the URLs and SQL lists do not match.
+    # rename column to match expected
+    df.rename(columns={'endpoint_count': 'total_requests'}, inplace=True)
+    return df
+
+def export_logs_by_week(save_dir, full=False):
     """
-    if len(urls) != len(sqls):
-        raise ValueError("The number of URLs and SQL queries must match.")
+    Updates the stored weekly log counts and saves the six-month export as CSV.
+
+    Only log entries from the newest stored day onwards are queried, unless the
+    store is empty or `full` is set.
 
-    # Ensure the output directory exists
+    Args:
+        save_dir (str): Directory path where logs-by-week.csv will be saved.
+        full (bool): Rebuild the whole six months instead of updating the store.
+    """
     os.makedirs(save_dir, exist_ok=True)
+    try:
+        store = PartitionedStore("logs-by-week", "entrydate")
+        df = update_store(store, fetch_logs_by_week, window_start("digital-land", "-6 months"), full=full)
 
-    # Iterate over each (name, URL) and associated SQL
-    for (name, url), sql in zip(urls.items(), sqls):
-        try:
-            # Define the output CSV filename
-            csv_name = f"{name}.csv"
-
-            # Encode SQL query and construct JSON API URL
-            encoded_sql = urllib.parse.quote(sql)
-            full_url = f"{url}.json?sql={encoded_sql}&_shape=array"
-            
-            print(f"Fetching: {name} from SQL URL:\n{full_url}")
-
-            # Fetch JSON data and load into DataFrame
-            response = requests.get(full_url)
-            response.raise_for_status()
-            data = response.json()
-            print(f"Rows returned: {len(data)}")
-            df = pd.DataFrame(data)
-
-            # rename column to match expected
-            df.rename(columns={'endpoint_count': 'total_requests'}, inplace=True)
-
-            # Save DataFrame to CSV in the specified directory
-            save_path = os.path.join(save_dir, csv_name)
+        save_path = os.path.join(save_dir, "logs-by-week.csv")
+        with span("write", rows=len(df)):
             df.to_csv(save_path, index=False)
-            print(f"Saved: {save_path}")
+        print(f"Saved: {save_path}")
 
-        except Exception as e:
-            # Log failure and continue
-            print(f"Failed to fetch from {url}: {e}")
+    except Exception as e:
+        # Log failure, leaving the store as it was
+        print(f"Failed to export logs-by-week: {e}")
+
+def main(output_dir):
+    """
+    Updates the store and saves logs-by-week.csv, as run by run.py.
+
+    Args:
+        output_dir (str): Directory path where logs-by-week.csv will be saved.
+    """
+    export_logs_by_week(output_dir)
 
 def parse_args():
     """
@@ -68,41 +100,16 @@ def parse_args():
         required=True,
         help="Directory to save exported CSVs"
     )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Refetch the whole six months instead of only rows newer than the stored data"
+    )
     return parser.parse_args()
 
 if __name__ == "__main__":
     # Parse arguments from CLI
     args = parse_args()
 
-    # Define URLs and SQL queries to export
-    urls = {
-        "logs-by-week": "https://datasette.planning.data.gov.uk/digital-land"
-    }
-
-    sqls = [
-        # SQL to group request status codes by week
-        """
-        SELECT
-            COUNT(endpoint) AS endpoint_count,
-            SUBSTR(entry_date, 1, 10) AS entrydate,
-            DATE(entry_date, 'weekday 0', '-6 days') AS week_start,
-            CASE 
-                WHEN status = 200 THEN '200'
-                ELSE 'FAIL'
-            END AS status_group
-        FROM log
-        WHERE
-            entry_date >= DATE('now', '-6 months')
-            AND SUBSTR(entry_date, 1, 10) <= DATE(entry_date, 'weekday 0', '-6 days')
-        GROUP BY
-            entrydate,
-            week_start,
-            status_group
-        ORDER BY
-            entry_date DESC;
-
-        """
-    ]
-
     # Execute the export
-    sql_queried_datasette_tables(urls, sqls, args.output_dir)
+    export_logs_by_week(args.output_dir, full=args.full)
@@ -1,58 +1,81 @@
-import requests
 import pandas as pd
-import urllib.parse
 import os
 import argparse
-
-def sql_queried_datasette_tables(urls: dict, sqls: list, save_dir: str):
+from _datasette import get_datasette_json
+from _incremental import PartitionedStore, update_store, window_start
+from _metrics import span
+
+# Upstream tables read by this script (used by run.py to schedule scripts)
+READS = [
+    "digital-land/operational_issue",
+]
+
+# SQL to count operational issues by day over the last 6 months ({since} limits it to rows from the watermark onwards)
+OPERATIONAL_ISSUES_SQL = """
+    SELECT
+        [entry-date],
+        COUNT(rowid) AS issue_count
+    FROM
+        operational_issue
+    WHERE
+        [entry-date] >= DATE('now', '-6 months')
+        {since}
+    GROUP BY
+        [entry-date]
+"""
+
+def fetch_operational_issues(since=None):
     """
-    Fetches data from a dictionary of Datasette URLs using optional SQL queries
-    and saves each result as a CSV file in the specified directory.
+    Fetches the operational issue counts per entry date from Datasette.
 
     Args:
-        urls (dict): Mapping of table names to Datasette base URLs.
-        sqls (list of str): SQL queries corresponding to each URL.
-        save_dir (str): Directory path where the resulting CSV files will be saved.
+        since (str, optional): Only count issues with an entry date from this value onwards.
+
+    Returns:
+        pd.DataFrame: One row per entry date.
+    """
+    condition = f"AND [entry-date] >= '{since}'" if since else ""
+    data = get_datasette_json("digital-land", OPERATIONAL_ISSUES_SQL.format(since=condition), {"_shape": "array"})
+    print(f"Rows returned: {len(data)}")
+    df = pd.DataFrame(data)
 
-    Raises:
-        ValueError: If the lengths of the URLs and SQL lists do not match.
+    # rename columns to match expected
+    df.rename(columns={'entry-date': 'entry_date'}, inplace=True)
+    return df
+
+def export_operational_issues(save_dir, full=False):
     """
-    if len(urls) != len(sqls):
-        raise ValueError("The number of URLs and SQL queries must match.")
+    Updates the stored operational issue counts and saves the six-month export as CSV.
+
+    Only issues from the newest stored entry date onwards are queried, unless the
+    store is empty or `full` is set.
 
-    # Ensure the output directory exists
+    Args:
+        save_dir (str): Directory path where operational_issues.csv will be saved.
+        full (bool): Rebuild the whole six months instead of updating the store.
+    """
     os.makedirs(save_dir, exist_ok=True)
+    try:
+        store = PartitionedStore("operational_issues", "entry_date")
+        df = update_store(store, fetch_operational_issues, window_start("digital-land", "-6 months"), full=full)
 
-    # Iterate over each (name, URL) and associated SQL
-    for (name, url), sql in zip(urls.items(), sqls):
-        try:
-            # Define the output CSV filename
-            csv_name = f"{name}.csv"
-
-            # Encode SQL query and construct JSON API URL
-            encoded_sql = urllib.parse.quote(sql)
-            full_url = f"{url}.json?sql={encoded_sql}&_shape=array"
-            
-            print(f"Fetching: {name} from SQL URL:\n{full_url}")
-
-            # Fetch JSON data and load into DataFrame
-            response = requests.get(full_url)
-            response.raise_for_status()
-            data = response.json()
-            print(f"Rows returned: {len(data)}")
-            df = pd.DataFrame(data)
-
-            # rename columns to match expected
-            df.rename(columns={'entry-date': 'entry_date'}, inplace=True)
-
-            # Save DataFrame to CSV in the specified directory
-            save_path = os.path.join(save_dir, csv_name)
+        save_path = os.path.join(save_dir, "operational_issues.csv")
+        with span("write", rows=len(df)):
             df.to_csv(save_path, index=False)
-            print(f"Saved: {save_path}")
+        print(f"Saved: {save_path}")
 
-        except Exception as e:
-            # Log failure and continue
-            print(f"Failed to fetch from {url}: {e}")
+    except Exception as e:
+        # Log failure, leaving the store as it was
+        print(f"Failed to export operational_issues: {e}")
+
+def main(output_dir):
+    """
+    Updates the store and saves operational_issues.csv, as run by run.py.
+
+    Args:
+        output_dir (str): Directory path where operational_issues.csv will be saved.
+    """
+    export_operational_issues(output_dir)
 
 def parse_args():
     """
@@ -68,31 +91,16 @@ def parse_args():
         required=True,
         help="Directory to save exported CSVs"
     )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Refetch the whole six months instead of only rows newer than the stored data"
+    )
     return parser.parse_args()
 
 if __name__ == "__main__":
     # Parse arguments from CLI
     args = parse_args()
 
-    # Define URLs and SQL queries to export
-    urls = {
-        "operational_issues": "https://datasette.planning.data.gov.uk/digital-land"
-    }
-
-    sqls = [
-        # SQL to count operational issues by week over the last 6 months
-        """
-        SELECT
-            [entry-date],
-            COUNT(rowid) AS issue_count
-        FROM
-            operational_issue
-        WHERE
-            [entry-date] >= DATE('now', '-6 months')
-        GROUP BY
-            [entry-date];
-        """
-    ]
-
     # Execute the export
-    sql_queried_datasette_tables(urls, sqls, args.output_dir)
+    export_operational_issues(args.output_dir, full=args.full)
@@ -2,14 +2,109 @@ import pandas as pd
 from datetime import datetime, timedelta
 import argparse
 import os
+from _snapshot import load_table
+from _pushdown import pushdown_query
+from _metrics import span
+
+# Upstream tables read by this script (used by run.py to schedule scripts)
+READS = [
+    "digital-land/reporting_historic_endpoints",
+]
+
+OUTPUT_COLUMNS = [
+    "endpoint",
+    "first_resource_start_date",
+    "last_resource_start_date",
+    "resource_count",
+    "organisation_name",
+    "dataset",
+    "collection",
+    "pipeline",
+    "endpoint_entry_date",
+    "single_day_resources",
+    "daily_for_7_days",
+    ">20_instances_in_30_day_period",
+    "stale_resource",
+]
+
+META_COLS = ["organisation_name", "dataset", "collection", "pipeline", "endpoint_entry_date"]
+
+def summary_sql(today):
+    """
+    Builds the SQL computing the runaway resources summary on Datasette.
 
-def main(output_dir):
-    # Load Data
-    base_url = "https://datasette.planning.data.gov.uk/digital-land"
-    table = "reporting_historic_endpoints"
-    full_url = f"{base_url}/{table}.csv?_stream=on"
+    Mirrors `summarise_locally()`: empty strings count as missing values (as they
+    do in the CSV export) and metadata columns take the first non-missing value per
+    endpoint in table order. Counts are 0 rather than NULL when no resource matches.
+
+    Args:
+        today (date): Date the 7 and 30 day windows are counted back from.
+
+    Returns:
+        str: SELECT with one row per endpoint, keyed on "endpoint".
+    """
+    recent_7_days = today - timedelta(days=7)
+    recent_30_days = today - timedelta(days=30)
+    yesterday = today - timedelta(days=1)
+    first_rows = ",\n            ".join(
+        f"MIN(CASE WHEN NULLIF({col}, '') IS NOT NULL THEN rowid END) AS {col}_row" for col in META_COLS
+    )
+    meta_select = ",\n        ".join(f"{col}_first.{col}" for col in META_COLS)
+    meta_joins = "\n    ".join(
+        f"LEFT JOIN reporting_historic_endpoints {col}_first ON {col}_first.rowid = g.{col}_row" for col in META_COLS
+    )
+    return f"""
+    SELECT
+        g.endpoint,
+        date(g.first_start) AS first_resource_start_date,
+        date(g.last_start) AS last_resource_start_date,
+        g.resource_count,
+        {meta_select},
+        g.single_day_resources,
+        CASE WHEN g.days_in_last_7 = 7 THEN 'yes' ELSE 'no' END AS daily_for_7_days,
+        CASE WHEN g.count_30 > 20 THEN 'yes' ELSE 'no' END AS ">20_instances_in_30_day_period",
+        CASE WHEN date(g.last_end) < '{recent_30_days}' THEN 'yes' ELSE 'no' END AS stale_resource
+    FROM (
+        SELECT
+            endpoint,
+            COUNT(*) AS resource_count,
+            MIN(NULLIF(resource_start_date, '')) AS first_start,
+            MAX(NULLIF(resource_start_date, '')) AS last_start,
+            MAX(NULLIF(resource_end_date, '')) AS last_end,
+            COALESCE(SUM(datetime(resource_start_date) = datetime(resource_end_date)), 0) AS single_day_resources,
+            COUNT(DISTINCT CASE
+                WHEN date(resource_start_date) BETWEEN '{recent_7_days}' AND '{yesterday}'
+                THEN date(resource_start_date)
+            END) AS days_in_last_7,
+            COALESCE(SUM(date(resource_start_date) >= '{recent_30_days}'), 0) AS count_30,
+            {first_rows}
+        FROM reporting_historic_endpoints
+        WHERE COALESCE(endpoint_end_date, '') = ''
+          AND COALESCE(endpoint, '') != ''
+        GROUP BY endpoint
+        HAVING COUNT(*) > 1
+    ) g
+    {meta_joins}
+    """
+
+def summarise_locally(today):
+    """
+    Computes the runaway resources summary from the full reporting_historic_endpoints table.
+
+    Args:
+        today (date): Date the 7 and 30 day windows are counted back from.
 
-    df = pd.read_csv(full_url)
+    Returns:
+        pd.DataFrame: One row per live endpoint with more than one resource.
+    """
+    # Load Data (only the columns used below)
+    df = load_table(
+        "reporting_historic_endpoints",
+        columns=[
+            "endpoint", "endpoint_end_date", "resource_start_date", "resource_end_date",
+            "organisation_name", "dataset", "collection", "pipeline", "endpoint_entry_date",
+        ],
+    )
 
     # Filter and convert dates
     df = df[df["endpoint_end_date"].isna()].copy()
@@ -22,13 +117,11 @@ def main(output_dir):
         .size()
         .reset_index(name="resource_count")
         .query("resource_count > 1")
-        .sort_values("resource_count", ascending=False)
         .reset_index(drop=True)
     )
 
     # Add metadata columns
-    meta_cols = ["organisation_name", "dataset", "collection", "pipeline", "endpoint_entry_date"]
-    metadata = df.groupby("endpoint")[meta_cols].first().reset_index()
+    metadata = df.groupby("endpoint")[META_COLS].first().reset_index()
     summary_df = summary_df.merge(metadata, on="endpoint", how="left")
 
     # First and last start dates
@@ -45,7 +138,6 @@ def main(output_dir):
     summary_df.insert(9, "single_day_resources", summary_df["endpoint"].map(single_day_summary).fillna(0).astype(int))
 
     # Flagging logic
-    today = datetime.today().date()
     recent_7_days = today - timedelta(days=7)
     recent_30_days = today - timedelta(days=30)
 
@@ -73,11 +165,40 @@ def main(output_dir):
     summary_df["stale_resource"] = summary_df["endpoint"].apply(
         lambda ep: "yes" if pd.notnull(last_end_dates.get(ep)) and last_end_dates.get(ep) < stale_cutoff else "no"
     )
+    return summary_df
+
+def main(output_dir):
+    """
+    Summarises resources per endpoint and saves runaway_resources.csv.
+
+    Args:
+        output_dir (str): Directory to save the CSV to.
+    """
+    today = datetime.today().date()
+
+    # Aggregate on Datasette, downloading the whole table only if that fails
+    summary_df = pushdown_query(
+        "digital-land",
+        summary_sql(today),
+        local=lambda: summarise_locally(today),
+        key="endpoint",
+        columns=OUTPUT_COLUMNS,
+        name="runaway_resources",
+    )
+
+    # Counts as whole numbers whichever way the summary was computed
+    summary_df = summary_df.astype({"resource_count": int, "single_day_resources": int})
+
+    # Most resources first (ties by endpoint, whichever way the summary was computed)
+    summary_df = summary_df.sort_values(
+        ["resource_count", "endpoint"], ascending=[False, True], kind="stable"
+    ).reset_index(drop=True)
 
     # Output
     csv_name = "runaway_resources.csv"
     save_path = os.path.join(output_dir, csv_name)
-    summary_df.to_csv(save_path, index=False)  # Save to CSV without index
+    with span("write", rows=len(summary_df)):
+        summary_df.to_csv(save_path, index=False)  # Save to CSV without index
     print(f"Saved: {save_path}")
 
 def parse_args():
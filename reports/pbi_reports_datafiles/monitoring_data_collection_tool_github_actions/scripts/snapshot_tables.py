@@ -0,0 +1,91 @@
+"""
+Script to snapshot the Datasette tables shared by the monitoring scripts into Parquet.
+
+Each table in WRITES is downloaded once and written to the snapshot directory,
+so the other scripts can load typed columns from local Parquet files instead of
+each parsing the CSV exports. Tables only read by scripts that aggregate on
+Datasette (see `_pushdown.py`) are not snapshotted; those scripts download them
+only if their query fails. The run.py scheduler starts scripts that READ a
+"snapshot/<table>" after this script has finished.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from _snapshot import PARQUET_AVAILABLE, SNAPSHOT_DIR, write_snapshot
+
+# Upstream tables read by this script (used by run.py to schedule scripts)
+READS = [
+    "digital-land/organisation",
+    "digital-land/source",
+    "digital-land/endpoint",
+    "digital-land/resource_endpoint",
+    "performance/endpoint_dataset_issue_type_summary",
+]
+
+# Snapshot tables produced for other scripts
+WRITES = [
+    "snapshot/organisation",
+    "snapshot/source",
+    "snapshot/endpoint",
+    "snapshot/resource_endpoint",
+    "snapshot/endpoint_dataset_issue_type_summary",
+]
+
+# Names in _snapshot.SNAPSHOT_TABLES
+SNAPSHOT_NAMES = [table.split("/", 1)[1] for table in WRITES]
+
+def snapshot_all(workers=4):
+    """
+    Writes a Parquet snapshot of every table, downloading several at once.
+
+    A table that fails to download is reported and skipped; scripts reading it
+    fall back to Datasette.
+
+    Args:
+        workers (int): Number of tables downloaded at once.
+    """
+    if not PARQUET_AVAILABLE:
+        print("[WARNING] pyarrow is not installed; skipping snapshots (scripts will read from Datasette)")
+        return
+
+    def snapshot(name):
+        try:
+            print(f"[INFO] Snapshot {name}: {write_snapshot(name)} rows")
+        except Exception as e:
+            print(f"[ERROR] Failed to snapshot {name}: {e}")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(snapshot, SNAPSHOT_NAMES))
+    print(f"[SUCCESS] Snapshots written to {SNAPSHOT_DIR}")
+
+def main(output_dir):
+    """
+    Writes every snapshot. `output_dir` is unused (snapshots go to SNAPSHOT_DIR).
+
+    Args:
+        output_dir (str): Output directory passed by run.py.
+    """
+    snapshot_all()
+
+def parse_args():
+    """
+    Parses command-line arguments for the script.
+
+    The output directory is accepted for consistency with the other scripts
+    (run.py passes it to every script); snapshots are written to SNAPSHOT_DIR.
+
+    Returns:
+        argparse.Namespace: Contains the '--output-dir' argument.
+    """
+    parser = argparse.ArgumentParser(description="Snapshot shared Datasette tables to Parquet")
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        required=True,
+        help="Directory to save exported CSVs (unused, snapshots go to SNAPSHOT_DIR)"
+    )
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args.output_dir)
@@ -0,0 +1,245 @@
+"""
+Delta-only upload of the output CSVs to SharePoint (or a local stand-in).
+
+A manifest records the SHA-256 of every file last uploaded to each folder, so:
+
+- a file is only uploaded to the base folder when its content has changed
+- the dated archive copy is made with a server-side copy from the base folder,
+  so it needs no second upload (falling back to an upload if the copy fails)
+- files are handled in parallel, each worker with its own client context
+- files larger than CHUNK_THRESHOLD are sent in chunks through an upload session
+
+Targets implement `ensure_folder`, `upload` and `copy`. `SharePointTarget` talks
+to SharePoint; `LocalTarget` writes to a local directory with the same folder
+layout, for testing the upload without credentials.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Files above this size are uploaded in chunks
+CHUNK_THRESHOLD = 10 * 1024 * 1024
+CHUNK_SIZE = 5 * 1024 * 1024
+
+DEFAULT_WORKERS = 4
+
+
+def file_sha256(path):
+    """
+    Returns the SHA-256 of a file, reading it in blocks rather than all at once.
+
+    Parameters:
+        path (str): Path to the file.
+
+    Returns:
+        str: Hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class SharePointTarget:
+    """
+    Uploads to a SharePoint site. Each thread gets its own ClientContext, as a
+    context queues requests and cannot be shared between threads.
+
+    Parameters:
+        site_url (str): SharePoint site URL.
+        username (str): Account user name.
+        password (str): Account password.
+    """
+
+    def __init__(self, site_url, username, password):
+        self.site_url = site_url
+        self.username = username
+        self.password = password
+        self._local = threading.local()
+
+    def _ctx(self):
+        if not hasattr(self._local, "ctx"):
+            from office365.sharepoint.client_context import ClientContext
+            from office365.runtime.auth.user_credential import UserCredential
+            self._local.ctx = ClientContext(self.site_url).with_credentials(
+                UserCredential(self.username, self.password)
+            )
+        return self._local.ctx
+
+    def check_folder(self, folder_url):
+        """
+        Raises if the folder cannot be accessed.
+        """
+        ctx = self._ctx()
+        folder = ctx.web.get_folder_by_server_relative_url(folder_url)
+        ctx.load(folder)
+        ctx.execute_query()
+
+    def ensure_folder(self, folder_url):
+        """
+        Creates the folder if needed. Returns True if it was created.
+        """
+        try:
+            self._ctx().web.folders.add(folder_url).execute_query()
+            return True
+        except Exception:
+            return False
+
+    def upload(self, folder_url, local_path):
+        """
+        Uploads a file into a folder, in chunks if it is larger than CHUNK_THRESHOLD.
+        """
+        folder = self._ctx().web.get_folder_by_server_relative_url(folder_url)
+        with open(local_path, "rb") as f:
+            if os.path.getsize(local_path) > CHUNK_THRESHOLD:
+                folder.files.create_upload_session(f, CHUNK_SIZE).execute_query()
+            else:
+                folder.upload_file(os.path.basename(local_path), f.read()).execute_query()
+
+    def copy(self, source_url, folder_url):
+        """
+        Copies a file already on SharePoint into another folder, server-side.
+        """
+        source = self._ctx().web.get_file_by_server_relative_url(source_url)
+        source.copyto(f"{folder_url}/{source_url.rsplit('/', 1)[-1]}", True).execute_query()
+
+
+class LocalTarget:
+    """
+    Stand-in for SharePoint that mirrors server-relative folder URLs under a local directory.
+
+    Parameters:
+        root (str): Local directory playing the part of the site.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.uploads = 0
+        self.copies = 0
+        self._lock = threading.Lock()
+
+    def _path(self, url):
+        return os.path.join(self.root, *url.strip("/").split("/"))
+
+    def check_folder(self, folder_url):
+        os.makedirs(self._path(folder_url), exist_ok=True)
+
+    def ensure_folder(self, folder_url):
+        path = self._path(folder_url)
+        created = not os.path.isdir(path)
+        os.makedirs(path, exist_ok=True)
+        return created
+
+    def upload(self, folder_url, local_path):
+        shutil.copyfile(local_path, os.path.join(self._path(folder_url), os.path.basename(local_path)))
+        with self._lock:
+            self.uploads += 1
+
+    def copy(self, source_url, folder_url):
+        shutil.copyfile(self._path(source_url), os.path.join(self._path(folder_url), source_url.rsplit("/", 1)[-1]))
+        with self._lock:
+            self.copies += 1
+
+
+class UploadManifest:
+    """
+    Content hashes of the files last uploaded, keyed by server-relative file URL.
+
+    Parameters:
+        path (str): JSON file the manifest is kept in.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+
+    def is_current(self, file_url, digest):
+        with self._lock:
+            return self.entries.get(file_url, {}).get("sha256") == digest
+
+    def record(self, file_url, digest):
+        with self._lock:
+            self.entries[file_url] = {
+                "sha256": digest,
+                "uploaded_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            }
+
+    def keep_only(self, folder_urls):
+        """
+        Drops entries outside the given folders (e.g. earlier archive folders).
+        """
+        with self._lock:
+            self.entries = {
+                url: entry for url, entry in self.entries.items() if url.rsplit("/", 1)[0] in folder_urls
+            }
+
+    def save(self):
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path + ".part", "w", encoding="utf-8") as f:
+                json.dump(self.entries, f, indent=2, sort_keys=True)
+            os.replace(self.path + ".part", self.path)
+
+
+def upload_outputs(target, output_dir, base_url, archive_url, manifest_path, log=print, workers=DEFAULT_WORKERS):
+    """
+    Uploads changed CSVs to the base folder and makes sure each is in the archive folder.
+
+    Parameters:
+        target (SharePointTarget | LocalTarget): Where files are uploaded.
+        output_dir (str): Local directory containing the CSV files.
+        base_url (str): Server-relative URL of the base folder.
+        archive_url (str): Server-relative URL of the dated archive folder.
+        manifest_path (str): JSON manifest of uploaded content hashes.
+        log (callable): Logging function for progress messages.
+        workers (int): Number of files handled at once.
+
+    Returns:
+        dict: File name -> "uploaded", "unchanged" or "failed".
+    """
+    manifest = UploadManifest(manifest_path)
+    manifest.keep_only({base_url, archive_url})
+
+    def process(file):
+        local_path = os.path.join(output_dir, file)
+        base_file_url = f"{base_url}/{file}"
+        archive_file_url = f"{archive_url}/{file}"
+        try:
+            digest = file_sha256(local_path)
+            status = "unchanged"
+            if not manifest.is_current(base_file_url, digest):
+                target.upload(base_url, local_path)
+                manifest.record(base_file_url, digest)
+                status = "uploaded"
+
+            if not manifest.is_current(archive_file_url, digest):
+                try:
+                    target.copy(base_file_url, archive_url)
+                except Exception:
+                    target.upload(archive_url, local_path)
+                manifest.record(archive_file_url, digest)
+
+            log(f"{status.capitalize()}: {file}")
+            return status
+        except Exception as e:
+            log(f"Failed to upload '{file}': {e}")
+            return "failed"
+
+    files = sorted(file for file in os.listdir(output_dir) if file.endswith(".csv"))
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = dict(zip(files, executor.map(process, files)))
+    finally:
+        manifest.save()
+    return results
@@ -0,0 +1,234 @@
+"""
+Local SQLite warehouse of every run's outputs, for trend queries across runs.
+
+Each output CSV is loaded into a table named after the file (e.g. odp-status.csv
+-> odp_status) with an extra `run_date` column. A run date is a partition: loading
+the same output again for that date replaces it. Outputs with a natural key
+(NATURAL_KEYS) are deduplicated on it, and the key columns are indexed with
+run_date so per-organisation trends are fast:
+
+    SELECT run_date, COUNT(*)
+    FROM odp_status
+    WHERE organisation = 'local-authority:BUC' AND status = '200'
+    GROUP BY run_date
+
+Other outputs are loaded as they are: repeated rows in them (e.g. odp-issue's
+issue counts) are separate records, not duplicates.
+
+Usage:
+    python warehouse.py --load outputs [--run-date 2025-06-01]
+    python warehouse.py --backfill ..\\..\\weekly_odp_status_reports
+
+Backfill loads dated files named <output>_<YYYY-MM-DD>.csv.
+"""
+
+import os
+import re
+import sqlite3
+import datetime
+import argparse
+import pandas as pd
+
+WAREHOUSE_PATH = os.getenv(
+    "MONITORING_WAREHOUSE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "warehouse", "monitoring.sqlite"),
+)
+
+# Output file name (without .csv) -> columns identifying a row within one run. Only
+# outputs whose key is unique in the exports are listed (odp-status was checked
+# against the dated files in weekly_odp_status_reports; the others are grouped by
+# their key). odp-issue, odp-conformance and flagged_failed_resources have rows
+# that share every identifying column but are separate records, so they have none.
+NATURAL_KEYS = {
+    "odp-status": ["organisation", "cohort", "pipeline", "endpoint", "resource"],
+    "runaway_resources": ["endpoint"],
+    "logs-by-week": ["entrydate", "status_group"],
+    "operational_issues": ["entry_date"],
+}
+
+DATED_FILE_PATTERN = re.compile(r"^(?P<name>.+)_(?P<date>\d{4}-\d{2}-\d{2})\.csv$")
+
+
+def table_name(output_name):
+    """
+    Returns the warehouse table for an output, e.g. 'odp-status' -> 'odp_status'.
+
+    Parameters:
+        output_name (str): Output file name without the .csv extension.
+
+    Returns:
+        str: Table name.
+    """
+    return re.sub(r"\W", "_", output_name)
+
+
+def _quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def connect(path=WAREHOUSE_PATH):
+    """
+    Opens the warehouse, creating it and its load log if needed.
+
+    Parameters:
+        path (str): Location of the SQLite file.
+
+    Returns:
+        sqlite3.Connection: Open connection.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS load_log (
+            table_name TEXT,
+            run_date TEXT,
+            source_file TEXT,
+            row_count INTEGER,
+            loaded_at TEXT,
+            PRIMARY KEY (table_name, run_date)
+        )
+        """
+    )
+    return conn
+
+
+def _ensure_table(conn, table, columns, keys):
+    """
+    Creates the table and indexes if needed and adds any columns not seen before.
+    """
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {_quote(table)} (run_date TEXT)")
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({_quote(table)})")}
+    for column in columns:
+        if column not in existing:
+            conn.execute(f"ALTER TABLE {_quote(table)} ADD COLUMN {_quote(column)}")
+
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {_quote('ix_' + table + '_run_date')} ON {_quote(table)} (run_date)")
+    if keys:
+        key_columns = ", ".join(_quote(key) for key in keys)
+        conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {_quote('ix_' + table + '_key')} ON {_quote(table)} ({key_columns}, run_date)"
+        )
+
+
+def load_output(conn, csv_path, run_date, output_name=None):
+    """
+    Loads one output CSV as the partition for a run date, replacing any earlier load of it.
+
+    Parameters:
+        conn (sqlite3.Connection): Warehouse connection.
+        csv_path (str): Path to the CSV.
+        run_date (str): Partition date as YYYY-MM-DD.
+        output_name (str, optional): Output name; defaults to the file name without .csv.
+
+    Returns:
+        int: Number of rows loaded.
+    """
+    output_name = output_name or os.path.splitext(os.path.basename(csv_path))[0]
+    table = table_name(output_name)
+    try:
+        df = pd.read_csv(csv_path, low_memory=False)
+    except pd.errors.EmptyDataError:
+        df = pd.DataFrame()
+
+    keys = NATURAL_KEYS.get(output_name, [])
+    if keys and all(key in df.columns for key in keys):
+        df = df.drop_duplicates(subset=keys, keep="last")
+    else:
+        keys = []
+    df = df.astype(object).where(df.notna(), None)
+
+    columns = list(df.columns)
+    with conn:
+        _ensure_table(conn, table, columns, keys)
+        conn.execute(f"DELETE FROM {_quote(table)} WHERE run_date = ?", (run_date,))
+        if columns:
+            column_list = ", ".join(_quote(column) for column in ["run_date"] + columns)
+            placeholders = ", ".join("?" * (len(columns) + 1))
+            conn.executemany(
+                f"INSERT INTO {_quote(table)} ({column_list}) VALUES ({placeholders})",
+                ((run_date, *values) for values in df.itertuples(index=False, name=None)),
+            )
+        conn.execute(
+            "INSERT OR REPLACE INTO load_log VALUES (?, ?, ?, ?, ?)",
+            (table, run_date, os.path.abspath(csv_path), len(df), datetime.datetime.now().isoformat(timespec="seconds")),
+        )
+    return len(df)
+
+
+def load_run_outputs(output_dir, run_date=None, path=WAREHOUSE_PATH):
+    """
+    Loads every CSV in a run's output directory into the warehouse.
+
+    Parameters:
+        output_dir (str): Directory the scripts wrote their CSVs to.
+        run_date (str, optional): Partition date as YYYY-MM-DD; defaults to today.
+        path (str): Location of the SQLite file.
+
+    Returns:
+        dict: Table name -> rows loaded (files that failed to load are left out).
+    """
+    run_date = run_date or datetime.date.today().isoformat()
+    loaded = {}
+    conn = connect(path)
+    try:
+        for file in sorted(os.listdir(output_dir)):
+            if not file.endswith(".csv"):
+                continue
+            try:
+                loaded[table_name(file[:-len(".csv")])] = load_output(conn, os.path.join(output_dir, file), run_date)
+            except Exception as e:
+                print(f"[ERROR] Failed to load {file} into the warehouse: {e}")
+    finally:
+        conn.close()
+    return loaded
+
+
+def backfill(directory, path=WAREHOUSE_PATH):
+    """
+    Loads dated copies of outputs (<output>_<YYYY-MM-DD>.csv), e.g. the weekly ODP reports.
+
+    Parameters:
+        directory (str): Directory containing the dated CSVs.
+        path (str): Location of the SQLite file.
+
+    Returns:
+        int: Number of files loaded.
+    """
+    count = 0
+    conn = connect(path)
+    try:
+        for file in sorted(os.listdir(directory)):
+            match = DATED_FILE_PATTERN.match(file)
+            if not match:
+                continue
+            rows = load_output(conn, os.path.join(directory, file), match["date"], output_name=match["name"])
+            print(f"[INFO] {file}: {rows} rows")
+            count += 1
+    finally:
+        conn.close()
+    return count
+
+
+def parse_args():
+    """
+    Parses command-line arguments for loading outputs into the warehouse.
+
+    Returns:
+        argparse.Namespace: Contains '--load', '--run-date' and '--backfill'.
+    """
+    parser = argparse.ArgumentParser(description="Load monitoring outputs into the local SQLite warehouse")
+    parser.add_argument("--load", type=str, help="Output directory of a run to load")
+    parser.add_argument("--run-date", type=str, help="Run date (YYYY-MM-DD) for --load, default today")
+    parser.add_argument("--backfill", type=str, help="Directory of dated <output>_<YYYY-MM-DD>.csv files to load")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.load:
+        loaded = load_run_outputs(args.load, args.run_date)
+        print(f"[SUCCESS] Loaded {len(loaded)} outputs into {WAREHOUSE_PATH}")
+    if args.backfill:
+        print(f"[SUCCESS] Loaded {backfill(args.backfill)} dated files into {WAREHOUSE_PATH}")
@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import urllib.request
+from urllib.error import HTTPError, URLError
+from concurrent.futures import ThreadPoolExecutor
+
+# shared between runs (and between the run directories of a batch), next to the default data_dir
+CACHE_DIR = os.environ.get(
+    "ENDPOINT_CHECKER_CACHE",
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "..", "data", "endpoint_checker_cache"
+    ),
+)
+# seconds a download is used without asking the server whether it has changed
+CACHE_TTL = int(os.environ.get("ENDPOINT_CHECKER_CACHE_TTL", "600"))
+DOWNLOAD_WORKERS = 8
+CHUNK_SIZE = 1024 * 1024
+
+
+class DownloadCache:
+    """
+    On-disk cache of downloaded files, shared by every endpoint checker run.
+
+    Bodies are stored once under objects/ named by their sha256, and never changed
+    afterwards, so a run directory can hard link them. entries/ records, per URL,
+    the object, ETag, Last-Modified and when it was last checked:
+    - an entry checked within the last `ttl` seconds is used without a request
+    - an older entry is revalidated with If-None-Match / If-Modified-Since, so an
+      unchanged file costs a 304 rather than a download
+    - a 404 is remembered too (pipeline files that only exist in the config repo)
+    - if the server cannot be reached, the last copy is used with a warning
+    """
+
+    def __init__(self, directory=CACHE_DIR, ttl=CACHE_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        self.objects_dir = os.path.join(directory, "objects")
+        self.entries_dir = os.path.join(directory, "entries")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.entries_dir, exist_ok=True)
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _lock(self, url):
+        with self._locks_lock:
+            return self._locks.setdefault(url, threading.Lock())
+
+    def _entry_path(self, url):
+        return os.path.join(
+            self.entries_dir, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json"
+        )
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest)
+
+    def _read_entry(self, url):
+        try:
+            with open(self._entry_path(url)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("object") and not os.path.exists(self.object_path(entry["object"])):
+            return None
+        return entry
+
+    def _write_entry(self, url, entry):
+        path = self._entry_path(url)
+        with open(path + ".part", "w") as f:
+            json.dump(entry, f)
+        os.replace(path + ".part", path)
+
+    def _store(self, response):
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.objects_dir, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    f.write(chunk)
+            os.replace(tmp_path, self.object_path(digest.hexdigest()))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return digest.hexdigest()
+
+    def fetch(self, url):
+        """
+        Returns the cache entry for a URL, downloading only if it is new or has changed.
+        The entry has 'object' (None if the server answered 404), 'etag' and 'last_modified'.
+        Raises HTTPError / URLError if the server fails and nothing is cached.
+        """
+        with self._lock(url):
+            entry = self._read_entry(url)
+            if entry and time.time() - entry["checked_at"] < self.ttl:
+                return entry
+
+            headers = {}
+            if entry and entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry and entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+            try:
+                with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as response:
+                    entry = {
+                        "url": url,
+                        "object": self._store(response),
+                        "etag": response.headers.get("ETag"),
+                        "last_modified": response.headers.get("Last-Modified"),
+                    }
+            except HTTPError as e:
+                if e.code == 304 and entry:
+                    pass
+                elif e.code == 404:
+                    entry = {"url": url, "object": None, "etag": None, "last_modified": None}
+                elif entry:
+                    logging.warning(f"{url} returned {e.code}, using the cached copy")
+                else:
+                    raise
+            except URLError as e:
+                if not entry:
+                    raise
+                logging.warning(f"could not reach {url} ({e.reason}), using the cached copy")
+
+            entry["checked_at"] = time.time()
+            self._write_entry(url, entry)
+            return entry
+
+    def fetch_all(self, urls, workers=DOWNLOAD_WORKERS):
+        """
+        fetches several URLs at once, returning a dict of url -> entry. A URL that
+        could not be fetched maps to the HTTPError raised, so one missing file does
+        not stop the others
+        """
+
+        def fetch(url):
+            try:
+                return self.fetch(url)
+            except HTTPError as e:
+                return e
+
+        urls = list(dict.fromkeys(urls))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return dict(zip(urls, executor.map(fetch, urls)))
+
+    def place(self, entry, path, writable=False):
+        """
+        Puts a cached file at `path` for a run. Files the run only reads are hard
+        linked to the cache (copied if linking is not possible); files the run
+        edits (e.g. lookup.csv) get their own copy, so the cache is never changed.
+        """
+        source = self.object_path(entry["object"])
+        if os.path.lexists(path):
+            os.remove(path)
+        if not writable:
+            try:
+                os.link(source, path)
+                return
+            except OSError:
+                pass
+        shutil.copyfile(source, path)
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache():
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = DownloadCache()
+        return _default_cache
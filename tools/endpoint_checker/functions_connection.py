@@ -0,0 +1,139 @@
+import os
+import sqlite3
+import threading
+import functools
+
+# Look for it in common paths
+MOD_SPATIALITE_CANDIDATES = [
+    "mod_spatialite",  # default — system loader will try system paths
+    "/usr/lib/mod_spatialite.so",
+    "/usr/local/lib/mod_spatialite.so",
+    "/opt/homebrew/lib/mod_spatialite.dylib",
+    # other OS-specific paths...
+]
+
+# applied to every sqlite connection, read queries over large datasets benefit most from these
+PRAGMAS = {
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024,  # negative is in KiB, so 64MB
+    "temp_store": "MEMORY",
+}
+
+_local = threading.local()
+
+
+@functools.lru_cache(maxsize=None)
+def find_mod_spatialite():
+    """
+    returns the first candidate path that loads as the mod_spatialite extension. It is only
+    looked for once per process
+    """
+    for path in MOD_SPATIALITE_CANDIDATES:
+        conn = sqlite3.connect(":memory:")
+        try:
+            # Try loading it temporarily to test if it's valid
+            conn.enable_load_extension(True)
+            conn.load_extension(path)
+            return path
+        except Exception:
+            continue
+        finally:
+            conn.close()
+
+    raise OSError("Could not find mod_spatialite extension. Please install it.")
+
+
+def connect(database=None, load_extension=True, mod_spatialite_path=None, *args, read_only=False, immutable=False, **kwargs):
+    """
+    opens a new sqlite connection with PRAGMAS applied, optionally loading mod_spatialite.
+    Writable file databases are switched to WAL so readers don't block the writer. immutable
+    opens the file read only and tells sqlite it can't change, so no locks are taken; only use
+    it for files nothing writes to while they are open. Prefer get_connection, which reuses connections
+    """
+    if database and immutable:
+        conn = sqlite3.connect(f"file:{os.path.abspath(database)}?mode=ro&immutable=1", *args, uri=True, **kwargs)
+        read_only = True
+    elif database and read_only:
+        conn = sqlite3.connect(f"file:{os.path.abspath(database)}?mode=ro", *args, uri=True, **kwargs)
+    else:
+        conn = sqlite3.connect(database or ":memory:", *args, **kwargs)
+
+    for pragma, value in PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    if database and not read_only:
+        conn.execute("PRAGMA journal_mode = WAL")
+
+    if load_extension:
+        conn.enable_load_extension(True)
+
+        # Default path if not provided
+        if mod_spatialite_path is None:
+            mod_spatialite_path = find_mod_spatialite()
+
+        conn.load_extension(mod_spatialite_path)
+
+    return conn
+
+
+def connect_duckdb(database, spatial=True):
+    """
+    opens a DuckDB connection with a sqlite dataset attached (read only) as the default schema,
+    so the same sql can be run through DuckDB, with its spatial extension if spatial is True.
+    duckdb is optional and only imported here
+    """
+    try:
+        import duckdb
+    except ImportError:
+        raise ImportError("the duckdb backend needs duckdb, install it with: pip install duckdb")
+
+    conn = duckdb.connect()
+    conn.execute("INSTALL sqlite; LOAD sqlite;")
+    if spatial:
+        conn.execute("INSTALL spatial; LOAD spatial;")
+    conn.execute(f"ATTACH '{os.path.abspath(database)}' AS dataset (TYPE sqlite, READ_ONLY)")
+    conn.execute("USE dataset")
+    return conn
+
+
+def get_connection(database, spatial=False, backend="sqlite", read_only=True, immutable=False):
+    """
+    returns a connection to database from this thread's pool, opening (and configuring) it the
+    first time it is asked for. Connections are reused until close_connections is called, or
+    until the file is replaced (e.g. when a dataset is rebuilt), so they must not be closed by
+    the caller. backend is "sqlite" (with mod_spatialite if spatial) or "duckdb"
+    """
+    if backend not in ("sqlite", "duckdb"):
+        raise ValueError(f"unknown backend {backend}, expected sqlite or duckdb")
+
+    pool = getattr(_local, "connections", None)
+    if pool is None:
+        pool = _local.connections = {}
+
+    path = os.path.abspath(database)
+    pool_key = (path, spatial, backend, read_only, immutable)
+    stat = os.stat(path)
+    file_id = (stat.st_dev, stat.st_ino)
+
+    pooled = pool.get(pool_key)
+    if pooled is not None:
+        conn, pooled_file_id = pooled
+        if pooled_file_id == file_id:
+            return conn
+        conn.close()
+
+    if backend == "duckdb":
+        conn = connect_duckdb(path, spatial=spatial)
+    else:
+        conn = connect(path, load_extension=spatial, read_only=read_only, immutable=immutable)
+    pool[pool_key] = (conn, file_id)
+    return conn
+
+
+def close_connections():
+    """
+    closes this thread's pooled connections
+    """
+    pool = getattr(_local, "connections", None) or {}
+    for conn, file_id in pool.values():
+        conn.close()
+    pool.clear()
@@ -1,41 +1,8 @@
 import pandas as pd
-import sqlite3
-
-def find_mod_spatialite():
-    # Look for it in common paths
-    candidates = [
-        "mod_spatialite",  # default — system loader will try system paths
-        "/usr/lib/mod_spatialite.so",
-        "/usr/local/lib/mod_spatialite.so",
-        "/opt/homebrew/lib/mod_spatialite.dylib",
-        # other OS-specific paths...
-    ]
-    for path in candidates:
-        try:
-            # Try loading it temporarily to test if it's valid
-            conn = sqlite3.connect(":memory:")
-            conn.enable_load_extension(True)
-            conn.load_extension(path)
-            return path
-        except Exception:
-            continue
-
-    raise OSError("Could not find mod_spatialite extension. Please install it.")
-
-def connect(database=None, load_extension=True, mod_spatialite_path=None, *args, **kwargs):
-
-    conn = sqlite3.connect(database or ":memory:", *args, **kwargs)
-
-    if load_extension:
-        conn.enable_load_extension(True)
+import shapely
 
-        # Default path if not provided
-        if mod_spatialite_path is None:
-            mod_spatialite_path = find_mod_spatialite()
+from functions_connection import find_mod_spatialite, connect, get_connection
 
-        conn.load_extension(mod_spatialite_path)
-
-    return conn
 
 def query_sqlite(conn, query_string):        
     cursor = conn.execute(query_string)
@@ -54,89 +21,97 @@ def count_valid_values(conn, field_name):
     return len(df)
 
 
+def read_entities(path, geometry_field):
+    """
+    reads the entities of a dataset sqlite with their geometry (or point) parsed once into shapely
+    geometries. Entities whose WKT is empty, unreadable or invalid are dropped
+    """
+    conn = get_connection(path)
+    entities = query_sqlite(
+        conn,
+        f"""
+        SELECT entity, name, organisation_entity, reference, {geometry_field} AS geometry
+        FROM entity
+        WHERE {geometry_field} != ''
+        """,
+    )
+
+    shapes = shapely.from_wkt(entities["geometry"], on_invalid="ignore")
+    valid = ~shapely.is_missing(shapes) & shapely.is_valid(shapes)
+    entities = entities[valid].reset_index(drop=True)
+    entities["shape"] = shapes[valid]
+    return entities
+
+
+def match_entities(live, new, predicate):
+    """
+    pairs every new entity with the live entities of other organisations whose geometry matches the
+    predicate. The live geometries are indexed in an STRtree, so only pairs with overlapping bounding
+    boxes are tested
+    """
+    tree = shapely.STRtree(live["shape"].values)
+    new_index, live_index = tree.query(new["shape"].values, predicate=predicate)
+
+    live_matches = live.iloc[live_index].add_prefix("live_").reset_index(drop=True)
+    new_matches = new.iloc[new_index].add_prefix("new_").reset_index(drop=True)
+    matches = pd.concat([live_matches, new_matches], axis=1)
+
+    # as the sql join did, pairs with an unknown organisation are not compared. The values are
+    # compared as numbers, a column with a NULL is read as floats (600.0) while one without stays ints
+    live_organisation = pd.to_numeric(matches["live_organisation_entity"], errors="coerce")
+    new_organisation = pd.to_numeric(matches["new_organisation_entity"], errors="coerce")
+    different_organisations = (
+        live_organisation.notna()
+        & new_organisation.notna()
+        & (live_organisation != new_organisation)
+    )
+    return matches[different_organisations].reset_index(drop=True)
+
+
 def get_duplicates_between_orgs(dataset, live_path, new_path):
 
-    mod_spatialite_path = find_mod_spatialite()
-    live_conn = connect(live_path, mod_spatialite_path=mod_spatialite_path)  
-    new_conn = connect(new_path, mod_spatialite_path=mod_spatialite_path)
+    # if dataset is tree with points instead of geometry (multipolygons), use points and match equal points
+    new_conn = get_connection(new_path)
+    use_points = (dataset == "tree") & (count_valid_values(new_conn, "point") > count_valid_values(new_conn, "geometry"))
 
-    #get new endpoint entities and write to temp table in live dataset sqlite db
-    results_temp = query_sqlite(
-        new_conn, 
-        """
-        SELECT entity, name, organisation_entity, reference, geometry, point
-        FROM entity
-        """)
-    
-    results_temp.to_sql("entity_new", live_conn, index=False, if_exists='replace')
+    columns = [
+        "entity",
+        "name",
+        "reference",
+        "organisation_entity",
+        "geometry",
+    ]
+    result_columns = [f"live_{column}" for column in columns] + [f"new_{column}" for column in columns]
 
-    # if dataset is tree with points instead of geometry (multipolygons), use points and st_equals join
-    if (dataset == "tree") & (count_valid_values(new_conn, "point") > count_valid_values(new_conn, "geometry")):
+    if use_points:
 
         print("Dataset is tree with points instead of polygons, checking for geometry duplicates using points")
 
-        #checks current entities with existing dataset
-        sql_point = """
-            SELECT a.entity AS live_entity,
-                a.name AS live_name,
-                a.reference AS live_reference,
-                a.organisation_entity AS live_organisation_entity,
-                a.point live_geometry,
-                b.entity AS new_entity,
-                b.name AS new_name,
-                b.reference AS new_reference,
-                b.organisation_entity AS new_organisation_entity,
-                b.point AS new_geometry
-            FROM
-                (SELECT entity, name, organisation_entity, reference, point
-                FROM entity
-                WHERE ST_IsValid(GeomFromText(point))
-                ) a
-            JOIN
-                entity_new b 
-            ON a.organisation_entity <> b.organisation_entity
-                AND ST_EQUALS(GeomFromText(a.point), GeomFromText(b.point)) 
-            WHERE ST_IsValid(GeomFromText(b.point))
-            """
-        
-        results = query_sqlite(live_conn, sql_point)
+        live = read_entities(live_path, "point")
+        new = read_entities(new_path, "point")
+        # two points intersect only when they are equal
+        results = match_entities(live, new, "intersects")[result_columns]
 
     else:
-         
+
         print("checking for geometry duplicates using geometry field (multipolygon)")
-        sql_geom = """
-        WITH calc AS (
-        SELECT a.entity AS live_entity,
-            a.name AS live_name,
-            a.reference AS live_reference,
-            a.organisation_entity AS live_organisation_entity,
-            a.geometry live_geometry,
-            b.entity AS new_entity,
-            b.name AS new_name,
-            b.reference AS new_reference,
-            b.organisation_entity AS new_organisation_entity,
-            b.geometry AS new_geometry,
-            ST_Area(ST_Intersection(GeomFromText(a.geometry), GeomFromText(b.geometry))) as area_geom_intersection,
-            ST_Area(GeomFromText(a.geometry)) as area_geom_live,
-            ST_Area(GeomFromText(b.geometry)) as area_geom_new,
-            ST_Area(ST_Intersection(GeomFromText(a.geometry), GeomFromText(b.geometry))) / ST_Area(ST_Union(GeomFromText(a.geometry), GeomFromText(b.geometry))) as pct_overlap
-
-        FROM entity a
-        JOIN entity_new b 
-        ON a.organisation_entity <> b.organisation_entity
-            AND ST_Intersects(GeomFromText(a.geometry), GeomFromText(b.geometry))
-        WHERE ST_IsValid(GeomFromText(a.geometry))
-            AND ST_IsValid(GeomFromText(b.geometry))
-        )
 
-        SELECT *
-        FROM CALC
-        WHERE pct_overlap > 0.95
-        """
-        
-        results = query_sqlite(live_conn, sql_geom)
+        live = read_entities(live_path, "geometry")
+        new = read_entities(new_path, "geometry")
+        matches = match_entities(live, new, "intersects")
+
+        # areas are only calculated for the candidate pairs
+        live_shapes = matches["live_shape"].values
+        new_shapes = matches["new_shape"].values
+        results = matches[result_columns].copy()
+        results["area_geom_intersection"] = shapely.area(shapely.intersection(live_shapes, new_shapes))
+        results["area_geom_live"] = shapely.area(live_shapes)
+        results["area_geom_new"] = shapely.area(new_shapes)
+        results["pct_overlap"] = results["area_geom_intersection"] / shapely.area(
+            shapely.union(live_shapes, new_shapes)
+        )
+        results = results[results["pct_overlap"] > 0.95].reset_index(drop=True)
 
     print(f"{len(results)} geographical matches found between new and existing entities")
 
     return results
-    
@@ -64,9 +64,14 @@ lookup_file_path = './pipeline/lookup.csv'
 
 # print all lookups that aren't found will need to read through all files
 class UnassignedEntries(Phase):
+    """
+    collects the prefix, organisation and reference of rows without an entity in self.entries,
+    once per key, so they can be assigned without saving them to a file first
+    """
     def __init__(self,lookups={}):
         self.lookups = lookups
         self.entity_field = "entity"
+        self.entries = {}
     
     def lookup(self, **kwargs):
         return self.lookups.get(key(**kwargs), "")
@@ -78,29 +83,53 @@ class UnassignedEntries(Phase):
             prefix = row.get("prefix", "")
             reference = row.get("reference", "")
             organisation = row.get("organisation", "")
-            if prefix:
-                if not row.get(self.entity_field, ""):
-                    entity = (
-                        # by the resource and row number
-                        (
-                            self.entity_field == "entity"
-                            and self.lookup(prefix=prefix, entry_number=entry_number)
-                        )
-                        # TBD: fixup prefixes so this isn't needed ..
-                        # or by the organisation and the reference
-                        or self.lookup(
-                            prefix=prefix,
-                            organisation=organisation,
-                            reference=reference,
-                        )
+            if prefix and not row.get(self.entity_field, ""):
+                entity = (
+                    # by the resource and row number
+                    (
+                        self.entity_field == "entity"
+                        and self.lookup(prefix=prefix, entry_number=entry_number)
+                    )
+                    # TBD: fixup prefixes so this isn't needed ..
+                    # or by the organisation and the reference
+                    or self.lookup(
+                        prefix=prefix,
+                        organisation=organisation,
+                        reference=reference,
                     )
-            
-            if not entity:
-                block['row'] = {'prefix':prefix,'organisation':organisation,'reference':reference}
-                yield block
+                )
+                if not entity:
+                    self.entries.setdefault(
+                        (prefix, organisation, reference),
+                        {'prefix':prefix,'organisation':organisation,'reference':reference},
+                    )
+            yield block
+
+
+def lookup_key_fields(pipeline, resource):
+    """
+    the fields the prefix, organisation and reference of a row can come from, including the
+    fields they are defaulted or migrated from. Everything else (geometry in particular) can
+    be pruned before harmonising when only the lookup keys are needed
+    """
+    fields = {"entity", "prefix", "organisation", "reference"}
+    for field, default_field in pipeline.default_fields(resource=resource).items():
+        if field in fields:
+            fields.add(default_field)
+    for field, old_field in pipeline.migrations().items():
+        if field in fields:
+            fields.add(old_field)
+    return list(fields)
+
 
-            
-def save_resource_unidentified_lookups(input_path,dataset,organisations, pipeline_dir='./pipeline',specification_dir='./specification'):
+def find_unassigned_entries(input_path,dataset,organisations, pipeline_dir='./pipeline',specification_dir='./specification',organisation_path='./var/cache/organisation.csv',converted_path=None):
+    """
+    runs the pipeline as far as the entity prefix, on the lookup key fields only, and returns the
+    prefix, organisation and reference of every row without an entity. Only these fields are
+    harmonised, so it costs a fraction of the full pipeline run. If converted_path is given the
+    converted resource (for non-csv resources) is saved there, so the full run can read it
+    rather than converting the resource again
+    """
     #  define pipeline and specification
     pipeline = Pipeline(pipeline_dir, dataset)
     specification = Specification(specification_dir)
@@ -108,7 +137,6 @@ def save_resource_unidentified_lookups(input_path,dataset,organisations, pipelin
     # convert phase inputs
     resource = resource_from_path(input_path)
     dataset_resource_log = DatasetResourceLog(dataset=dataset, resource=resource)
-    custom_temp_dir='./var'
 
     # normalise phase inputs
     skip_patterns = pipeline.skip_patterns(resource)
@@ -139,17 +167,17 @@ def save_resource_unidentified_lookups(input_path,dataset,organisations, pipelin
     schema = specification.pipeline[pipeline.name]["schema"]
 
     # organisation phase
-    organisation = Organisation('../../data/endpoint_checker/var/cache/organisation.csv', Path(pipeline.path))
+    organisation = Organisation(organisation_path, Path(pipeline.path))
 
     # print lookups phase
-    flookups = pipeline.lookups()
+    unassigned_entries = UnassignedEntries(lookups=pipeline.lookups())
 
-    print('running pipeline')
+    print('finding unassigned entries')
     run_pipeline(
             ConvertPhase(
                 path=input_path,
                 dataset_resource_log=dataset_resource_log,
-                output_path=Path(custom_temp_dir, f'{resource}.csv'),
+                output_path=converted_path,
             ),
             NormalisePhase(skip_patterns=skip_patterns, null_path=null_path),
             ParsePhase(),
@@ -164,6 +192,8 @@ def save_resource_unidentified_lookups(input_path,dataset,organisations, pipelin
                 issues=issue_log,
                 patches=patches,
             ),
+            # only the lookup keys are needed, so don't harmonise the other fields
+            FieldPrunePhase(fields=lookup_key_fields(pipeline, resource)),
             HarmonisePhase(
                 field_datatype_map=specification.get_field_datatype_map(),
                 issues=issue_log,
@@ -187,34 +217,170 @@ def save_resource_unidentified_lookups(input_path,dataset,organisations, pipelin
                 specification=specification,
             ),
             EntityPrefixPhase(dataset=dataset),
-            UnassignedEntries(lookups=flookups),
-            SavePhase(path=Path('../../data/endpoint_checker/var/cache/unassigned-entries.csv'),fieldnames=['prefix','organisation','reference'])
+            unassigned_entries,
+    )
+    return list(unassigned_entries.entries.values())
+
+
+def save_resource_unidentified_lookups(input_path,dataset,organisations, pipeline_dir='./pipeline',specification_dir='./specification',cache_dir='../../data/endpoint_checker/var/cache'):
+    """
+    saves the unassigned entries of a resource to unassigned-entries.csv in cache_dir
+    """
+    unassigned_entries = find_unassigned_entries(
+        input_path,
+        dataset,
+        organisations,
+        pipeline_dir=pipeline_dir,
+        specification_dir=specification_dir,
+        organisation_path=os.path.join(cache_dir, 'organisation.csv'),
     )
+    save_unassigned_entries(unassigned_entries, os.path.join(cache_dir, 'unassigned-entries.csv'))
+
+
+def save_unassigned_entries(unassigned_entries, path):
+    with open(path, 'w') as f:
+        dictwriter = csv.DictWriter(f, fieldnames=['prefix','organisation','reference'])
+        dictwriter.writeheader()
+        dictwriter.writerows(unassigned_entries)
+
+class LookupStore:
+    """
+    lookup.csv loaded once and indexed, so lookups can be checked and added without reading
+    or rewriting the file each time.
+    - rows are kept as tuples in the file's column order
+    - index maps the lookup key of (prefix, organisation, reference) to the row
+    - max_entity holds the highest entity number for each prefix
+    new rows can be appended to the file as they are added (append) and the file rewritten
+    in entity order once at the end (save)
+    """
+    expected_fieldnames = ['prefix','resource','organisation','reference','entity']
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = []
+        self.index = {}
+        self.max_entity = {}
+        self._unsaved = 0
+
+        with open(path, newline='') as f:
+            reader = csv.reader(f)
+            self.fieldnames = next(reader, None) or list(self.expected_fieldnames)
+            for fieldname in self.fieldnames:
+                if fieldname not in self.expected_fieldnames:
+                    logging.warning(f'{fieldname}: unexpected fieldname in lookups.csv')
+            self._positions = {field: i for i, field in enumerate(self.fieldnames)}
+            for row in reader:
+                self._add_row(tuple(row))
+
+    def _value(self, row, field):
+        position = self._positions.get(field)
+        if position is None or position >= len(row):
+            return ''
+        return row[position]
+
+    def _add_row(self, row):
+        prefix = self._value(row, 'prefix')
+        reference = self._value(row, 'reference')
+        if reference:
+            self.index.setdefault(
+                key(
+                    prefix=prefix,
+                    organisation=self._value(row, 'organisation'),
+                    reference=reference,
+                ),
+                row,
+            )
+        entity = self._value(row, 'entity')
+        if entity:
+            self.max_entity[prefix] = max(self.max_entity.get(prefix, 0), int(entity))
+        self.rows.append(row)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, prefix, organisation, reference):
+        """
+        returns the entity for a prefix, organisation and reference, or "" if there isn't one
+        """
+        row = self.index.get(
+            key(prefix=prefix, organisation=organisation, reference=reference)
+        )
+        if row is None:
+            return ''
+        return self._value(row, 'entity')
+
+    def add(self, prefix, organisation, reference, resource=''):
+        """
+        returns the entity for the prefix, organisation and reference, assigning the next
+        entity number for the prefix if it doesn't have one yet
+        """
+        entity = self.get(prefix, organisation, reference)
+        if entity:
+            return int(entity)
+        # TO DO expand this so that if there are unnassigned entries with datasets not already in the list then it doesn't error
+        entity = self.max_entity[prefix] + 1
+        values = {
+            'prefix': prefix,
+            'resource': resource,
+            'organisation': organisation,
+            'reference': reference,
+            'entity': str(entity),
+        }
+        self._add_row(tuple(values.get(field, '') for field in self.fieldnames))
+        self._unsaved += 1
+        return entity
+
+    def add_entries(self, entries):
+        """
+        adds dictionaries with prefix, organisation and reference (e.g. unassigned entries),
+        setting the entity of each
+        """
+        for entry in entries:
+            entry['entity'] = self.add(
+                entry['prefix'], entry['organisation'], entry['reference'], entry.get('resource', '')
+            )
+
+    def append(self):
+        """
+        appends the rows added since the last append or save to the end of the file
+        """
+        if not self._unsaved:
+            return
+        with open(self.path, 'rb') as f:
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                ends_with_newline = f.read(1) == b'\n'
+            else:
+                ends_with_newline = True
+        with open(self.path, 'a', newline='') as f:
+            if not ends_with_newline:
+                f.write('\n')
+            csv.writer(f).writerows(self.rows[-self._unsaved:])
+        self._unsaved = 0
+
+    def save(self):
+        """
+        rewrites the file with every row, in entity number order
+        """
+        def entity_order(row):
+            entity = self._value(row, 'entity')
+            return (0, int(entity)) if entity else (1, 0)
+
+        self.rows.sort(key=entity_order)
+        with open(self.path + '.part', 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.fieldnames)
+            writer.writerows(self.rows)
+        os.replace(self.path + '.part', self.path)
+        self._unsaved = 0
+
 
 def standardise_lookups(lookups_path):
     """
     standardise and sort the current lookup.csv file. Specifically to ensure the correct columns are all there 
     and that it is ordered by entity number.
     """
-    expected_fieldnames = ['prefix','resource','organisation','reference','entity']
-    lookups = []
-    fieldnames = []
-    with open(lookups_path) as f:
-        dictreader = csv.DictReader(f)
-        fieldnames = dictreader.fieldnames
-        for row in dictreader:
-            lookups.append(row)
-            
-    for fieldname in fieldnames:
-        if fieldname not in expected_fieldnames:
-            logging.warning(f'{fieldname}: unexpected fieldname in lookups.csv')
-    
-    # reorder lookups
-    lookups = sorted(lookups,key=lambda d: d['entity'])
-    with open(lookups_path,'w') as f:
-        dictwriter = csv.DictWriter(f,fieldnames=fieldnames)
-        dictwriter.writeheader()
-        dictwriter.writerows(lookups)
+    LookupStore(lookups_path).save()
 
 def add_unnassigned_to_lookups(unassigned_entries,lookups_path,):
     """
@@ -222,33 +388,6 @@ def add_unnassigned_to_lookups(unassigned_entries,lookups_path,):
     This may not always be true and should be taken with a hint of salt or updated in the future. The specification is required to 
     give us dataset information 
     """
-    
-    fieldnames = []
-    dataset_max_entity_ref = {}
-    # get fieldnames from lookup.csv
-    # get maximum entity numbers by dataset
-    with open(lookups_path) as f:
-        dictreader = csv.DictReader(f)
-        fieldnames = dictreader.fieldnames
-        for row in dictreader:
-            if dataset_max_entity_ref.get(row['prefix'],""):
-                if dataset_max_entity_ref[row['prefix']] < int(row['entity']):
-                    dataset_max_entity_ref[row['prefix']] = int(row['entity'])
-            else:
-                dataset_max_entity_ref[row['prefix']] = int(row['entity'])
-    
-    # assign the entity
-    # TO DO expand this so that if there are unnassigned entries with datasets not already in the list then it doesn't error
-    for entry in unassigned_entries:
-        entry['entity'] = dataset_max_entity_ref[entry['prefix']]
-        dataset_max_entity_ref[entry['prefix']] = dataset_max_entity_ref[entry['prefix']] + 1
-    
-    #save the assignmeents
-    with open(lookups_path, 'a') as f:
-        writer = csv.DictWriter(f,fieldnames=fieldnames)
-        writer.writerows(unassigned_entries)
-    
-    
-    
-    
-    
\ No newline at end of file
+    lookups = LookupStore(lookups_path)
+    lookups.add_entries(unassigned_entries)
+    lookups.append()
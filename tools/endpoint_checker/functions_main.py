@@ -1,19 +1,26 @@
 import os
-import urllib
+import json
 import hashlib
 from urllib.error import HTTPError
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import csv
 from pathlib import Path
 import shutil
 import sys
 import logging
+import sqlite3
+from itertools import islice
+import pandas as pd
 
 from functions_lookup import (
-    save_resource_unidentified_lookups,
-    standardise_lookups,
-    add_unnassigned_to_lookups,
+    find_unassigned_entries,
+    save_unassigned_entries,
+    LookupStore,
 )
 from functions_column import add_extra_column_mappings, add_extra_concats
+from functions_cache import get_default_cache, DOWNLOAD_WORKERS
+from functions_connection import close_connections
+from functions_download import FILES_URL, RAW_GITHUB_URL
 
 from digital_land.register import hash_value, Item
 from digital_land.update import add_endpoint, add_source
@@ -26,6 +33,40 @@ from digital_land.commands import dataset_create
 from digital_land.package.dataset import DatasetPackage
 from digital_land.organisation import Organisation
 
+SPECIFICATION_CSVS = [
+    "attribution.csv",
+    "licence.csv",
+    "typology.csv",
+    "theme.csv",
+    "collection.csv",
+    "dataset.csv",
+    "dataset-field.csv",
+    "field.csv",
+    "datatype.csv",
+    "prefix.csv",
+    # deprecated ..
+    "pipeline.csv",
+    "dataset-schema.csv",
+    "schema.csv",
+    "schema-field.csv",
+    "provision-rule.csv",
+]
+
+PIPELINE_CSVS = [
+    "column.csv",
+    "concat.csv",
+    "convert.csv",
+    "default.csv",
+    "filter.csv",
+    "lookup.csv",
+    "patch.csv",
+    "skip.csv",
+    "transform.csv",
+    "combine.csv",
+]
+
+# rows inserted per executemany call when building a dataset package (see bulk_load_csvs)
+BULK_LOAD_BATCH_SIZE = 10000
 
 def create_source_csv(path):
     fieldnames = [
@@ -74,120 +115,112 @@ def del_dir_contents(dir):
             print("Failed to delete %s. Reason: %s" % (file_path, e))
 
 
-def get_workflow_data(data_dir, collection, dataset):
-    # ensure data_dir exists
+def get_workflow_data(data_dir, collection, dataset, cache=None):
+    """
+    Prepares data_dir for a run: empties the directories a run writes to and puts the
+    specification, pipeline and organisation files in place from the download cache
+    (see functions_cache.DownloadCache), fetching only files that are new or have
+    changed upstream. The files used, with their ETags, are recorded in workspace.json.
+    """
+    cache = cache or get_default_cache()
+    # pooled connections from earlier queries would keep the old dataset open (and
+    # undeletable on Windows), so they are closed before the directories are emptied
+    close_connections()
+    # ensure data_dir exists and start from empty run directories
     os.makedirs(data_dir, exist_ok=True)
-    # download specification
     specification_dir = os.path.join(data_dir, "specification")
-    os.makedirs(specification_dir, exist_ok=True)
-    source_url = "https://raw.githubusercontent.com/digital-land/"
-    specification_csvs = [
-        "attribution.csv",
-        "licence.csv",
-        "typology.csv",
-        "theme.csv",
-        "collection.csv",
-        "dataset.csv",
-        "dataset-field.csv",
-        "field.csv",
-        "datatype.csv",
-        "prefix.csv",
-        # deprecated ..
-        "pipeline.csv",
-        "dataset-schema.csv",
-        "schema.csv",
-        "schema-field.csv",
-        "provision-rule.csv"
-    ]
-    for specification_csv in specification_csvs:
-        urllib.request.urlretrieve(
-            f"{source_url}/specification/main/specification/{specification_csv}",
-            os.path.join(specification_dir, specification_csv),
-        )
-
-    # collection directory structure
     collection_dir = os.path.join(data_dir, "collection")
-    collection_log_dir = os.path.join(collection_dir, "log")
-    collection_resource_dir = os.path.join(collection_dir, "resource")
-    os.makedirs(collection_dir, exist_ok=True)
-    os.makedirs(collection_log_dir, exist_ok=True)
-    del_dir_contents(collection_log_dir)
-    os.makedirs(collection_resource_dir, exist_ok=True)
-    del_dir_contents(collection_resource_dir)
+    pipeline_dir = os.path.join(data_dir, "pipeline")
+    dataset_dir = os.path.join(data_dir, "dataset")
+    transformed_dir = os.path.join(data_dir, "transformed")
+    issue_dir = os.path.join(data_dir, "issue")
+    var_dir = os.path.join(data_dir, "var")
+    cache_dir = os.path.join(var_dir, "cache")
+    for run_dir in [
+        specification_dir,
+        os.path.join(collection_dir, "log"),
+        os.path.join(collection_dir, "resource"),
+        pipeline_dir,
+        dataset_dir,
+        transformed_dir,
+        issue_dir,
+        os.path.join(var_dir, "column-field"),
+        os.path.join(var_dir, "dataset-resource"),
+        os.path.join(var_dir, "converted"),
+        cache_dir,
+    ]:
+        os.makedirs(run_dir, exist_ok=True)
+        del_dir_contents(run_dir)
+    os.makedirs(os.path.join(transformed_dir, dataset))
+
     # create source and endpoint csvs
     create_source_csv(os.path.join(collection_dir, "source.csv"))
     create_endpoint_csv(os.path.join(collection_dir, "endpoint.csv"))
 
-    # pipeline directory structure & download
-    pipeline_dir = os.path.join(data_dir, "pipeline")
-    os.makedirs(pipeline_dir, exist_ok=True)
-    pipeline_csvs = [
-        "column.csv",
-        "concat.csv",
-        "convert.csv",
-        "default.csv",
-        "filter.csv",
-        "lookup.csv",
-        "patch.csv",
-        "skip.csv",
-        "transform.csv",
-        "combine.csv",
-    ]
-    for pipeline_csv in pipeline_csvs:
+    # download everything at once, falling back to the config repository for
+    # pipeline files the collection repository does not have
+    specification_urls = {
+        name: f"{RAW_GITHUB_URL}specification/main/specification/{name}"
+        for name in SPECIFICATION_CSVS
+    }
+    pipeline_urls = {
+        name: f"{RAW_GITHUB_URL}{collection}/main/pipeline/{name}" for name in PIPELINE_CSVS
+    }
+    organisation_url = f"{FILES_URL}/organisation-collection/dataset/organisation.csv"
+    entries = cache.fetch_all(
+        list(specification_urls.values()) + list(pipeline_urls.values()) + [organisation_url]
+    )
+
+    collection_affix = collection.replace("-collection", "")
+    fallback_urls = {
+        name: f"{RAW_GITHUB_URL}config/main/pipeline/{collection_affix}/{name}"
+        for name, url in pipeline_urls.items()
+        if isinstance(entries[url], HTTPError) or entries[url]["object"] is None
+    }
+    entries.update(cache.fetch_all(fallback_urls.values()))
+
+    workspace = {"collection": collection, "dataset": dataset, "files": {}}
+
+    def place(url, path, writable=False):
+        entry = entries[url]
+        if isinstance(entry, HTTPError):
+            raise entry
+        if entry["object"] is None:
+            raise HTTPError(url, 404, "Not Found", None, None)
+        cache.place(entry, path, writable=writable)
+        workspace["files"][os.path.relpath(path, data_dir)] = {
+            "url": url,
+            "etag": entry["etag"],
+            "sha256": entry["object"],
+        }
+
+    for name, url in specification_urls.items():
+        place(url, os.path.join(specification_dir, name))
+
+    # pipeline files are edited during a run (lookups, extra column mappings), so they are copied
+    for name, url in pipeline_urls.items():
         try:
-            urllib.request.urlretrieve(
-                f"{source_url}/{collection}/main/pipeline/{pipeline_csv}",
-                os.path.join(pipeline_dir, pipeline_csv),
-            )
+            place(url, os.path.join(pipeline_dir, name), writable=True)
         except HTTPError as e:
-            collection_affix = collection.replace("-collection", "")
+            if name not in fallback_urls:
+                raise
             try:
-                urllib.request.urlretrieve(
-                    f"{source_url}/config/main/pipeline/{collection_affix}/{pipeline_csv}",
-                    os.path.join(pipeline_dir, pipeline_csv),
-                )
+                place(fallback_urls[name], os.path.join(pipeline_dir, name), writable=True)
             except HTTPError as err:
                 print(f"Decentralised Collection Error: +{e}")
                 print(f"Centralised (Config) Repository Error: +{err}")
 
-    # add transformedd, dataset and issue directories
-    dataset_dir = os.path.join(data_dir, "dataset")
-    os.makedirs(dataset_dir, exist_ok=True)
-    del_dir_contents(dataset_dir)
-    transformed_dir = os.path.join(data_dir, "transformed")
-    os.makedirs(transformed_dir, exist_ok=True)
-    del_dir_contents(transformed_dir)
-    os.makedirs(os.path.join(transformed_dir, dataset))
-    issue_dir = os.path.join(data_dir, "issue")
-    os.makedirs(issue_dir, exist_ok=True)
+    place(organisation_url, os.path.join(cache_dir, "organisation.csv"))
 
-    # addd var directory wiith dataset_resource
-    var_dir = os.path.join(data_dir, "var")
-    os.makedirs(var_dir, exist_ok=True)
-    dataset_resource_dir = os.path.join(var_dir, "dataset-resource")
-    column_field_dir = os.path.join(var_dir, "column-field")
+    with open(os.path.join(data_dir, "workspace.json"), "w") as f:
+        json.dump(workspace, f, indent=2)
 
-    # add cache and download organisation.csv
-    cache_dir = os.path.join(var_dir, "cache")
-    os.makedirs(cache_dir, exist_ok=True)
-    urllib.request.urlretrieve(
-        "https://files.planning.data.gov.uk/organisation-collection/dataset/organisation.csv",
-        os.path.join(cache_dir, "organisation.csv"),
-    )
 
-
-def add_source_and_endpoint(
-    collection_name,
-    dataset,
-    organisation,
-    endpoint_url,
-    plugin,
-    collection_dir,
-    documentation_url,
+def make_source_and_endpoint(
+    collection_name, dataset, organisation, endpoint_url, plugin, documentation_url
 ):
     """
-    A function to add a source and an endpoint to a collection. Had to recreate function because
-    of limitations with the current functions and the location of the collection directory
+    forms the source and endpoint entries for an endpoint, returned as (source, endpoint) dictionaries
     """
     # create hashes
     endpoint_hash = hash_value(endpoint_url)
@@ -217,41 +250,170 @@ def add_source_and_endpoint(
     if plugin:
         endpoint["plugin"] = plugin
 
+    return source, endpoint
+
+
+def add_source_and_endpoint(
+    collection_name,
+    dataset,
+    organisation,
+    endpoint_url,
+    plugin,
+    collection_dir,
+    documentation_url,
+):
+    """
+    A function to add a source and an endpoint to a collection. Had to recreate function because
+    of limitations with the current functions and the location of the collection directory
+    """
+    add_sources_and_endpoints(
+        collection_name,
+        dataset,
+        [(organisation, endpoint_url, plugin)],
+        collection_dir,
+        documentation_url,
+    )
+
+
+def add_sources_and_endpoints(
+    collection_name, dataset, endpoints, collection_dir, documentation_url
+):
+    """
+    adds a source and an endpoint for each (organisation, endpoint_url, plugin) row,
+    loading and saving the collection once
+    """
     # create Collection object
     print(collection_dir)
     collection = Collection(directory=collection_dir)
     collection.load(collection_dir)
 
-    add_endpoint(endpoint, collection.endpoint)
-    add_source(source, collection.source)
+    for organisation, endpoint_url, plugin in endpoints:
+        source, endpoint = make_source_and_endpoint(
+            collection_name,
+            dataset,
+            organisation,
+            endpoint_url,
+            plugin,
+            documentation_url,
+        )
+        add_endpoint(endpoint, collection.endpoint)
+        add_source(source, collection.source)
 
     # finally save the new collection
     collection.save_csv(collection_dir)
 
 
 def assign_entries(
-    resource_path, dataset, organisation, pipeline_dir, specification_dir
+    resource_path, dataset, organisation, pipeline_dir, specification_dir, lookups=None
 ):
     """
-    assuming that the endpoint is new (strictly it doesn't have to be) then we neeed to assign new eentity numbers
+    assuming that the endpoint is new (strictly it doesn't have to be) then we neeed to assign new eentity numbers.
+    The entries without an entity are found with a cut down pipeline run (see find_unassigned_entries) and
+    assigned in memory. The converted resource is kept in var/converted for the full pipeline run.
+    When assigning for several resources pass one LookupStore as lookups: new lookups are then appended
+    to lookup.csv and the caller saves (sorts) it once at the end
     """
+    data_dir = os.path.dirname(os.path.normpath(pipeline_dir))
+    cache_dir = os.path.join(data_dir, "var", "cache")
+    converted_dir = os.path.join(data_dir, "var", "converted")
+    os.makedirs(converted_dir, exist_ok=True)
+
     lookup_path = os.path.join(pipeline_dir, "lookup.csv")
-    save_resource_unidentified_lookups(
+    unassigned_entries = find_unassigned_entries(
         resource_path,
         dataset,
         [organisation],
         pipeline_dir=pipeline_dir,
         specification_dir=specification_dir,
+        organisation_path=os.path.join(cache_dir, "organisation.csv"),
+        converted_path=os.path.join(converted_dir, f"{os.path.basename(resource_path)}.csv"),
     )
-    unassigned_entries = []
-    with open("../../data/endpoint_checker/var/cache/unassigned-entries.csv") as f:
-        dictreader = csv.DictReader(f)
-        for row in dictreader:
-            unassigned_entries.append(row)
-    standardise_lookups(lookup_path)
-    # if unassigned_entries is not None
-    if len(unassigned_entries) > 0:
-        add_unnassigned_to_lookups(unassigned_entries, lookup_path)
+    # kept for the notebook, which reports the entries assigned
+    save_unassigned_entries(
+        unassigned_entries, os.path.join(cache_dir, "unassigned-entries.csv")
+    )
+    if lookups is None:
+        store = LookupStore(lookup_path)
+        store.add_entries(unassigned_entries)
+        store.save()
+    else:
+        lookups.add_entries(unassigned_entries)
+        # keep the file up to date for the next resource's pipeline
+        lookups.append()
+
+
+def bulk_load_csvs(database_path, table_paths):
+    """
+    loads csv files into the tables of a newly created sqlite package in one transaction, with
+    executemany batches of BULK_LOAD_BATCH_SIZE rows. table_paths is a list of (table, paths). csv
+    columns are matched to the table's columns with - read as _, and missing values are loaded
+    as "" as the DatasetPackage loaders do. Like them, a fact already loaded is only replaced by
+    one with a newer entry date, rows of other tables are plain inserts. The tables' indexes are
+    dropped for the load and created again afterwards. Journalling and syncing are off, so this
+    is only for a package that is built from scratch: if the load fails the file has to be rebuilt
+    """
+    tables = list(dict.fromkeys(table for table, paths in table_paths))
+    conn = sqlite3.connect(database_path, isolation_level=None)
+    try:
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.execute("PRAGMA cache_size = -262144")  # 256MB
+        indexes = conn.execute(
+            f"""
+            SELECT name, sql FROM sqlite_master
+            WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ({','.join('?' * len(tables))})
+            """,
+            tables,
+        ).fetchall()
+
+        conn.execute("BEGIN")
+        for name, sql in indexes:
+            conn.execute(f'DROP INDEX "{name}"')
+
+        for table, paths in table_paths:
+            columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+            if not columns:
+                logging.warning(f"{table}: no such table in {database_path}, not loaded")
+                continue
+            sql = 'INSERT INTO "{}" ({}) VALUES ({})'.format(
+                table,
+                ",".join(f'"{column}"' for column in columns),
+                ",".join("?" * len(columns)),
+            )
+            if table == "fact":
+                # as DatasetPackage.load_facts, a fact seen again only takes the newer entry-date's values
+                sql += ' ON CONFLICT("fact") DO UPDATE SET {} WHERE excluded."entry_date" > "fact"."entry_date"'.format(
+                    ",".join(f'"{column}"=excluded."{column}"' for column in columns if column != "fact")
+                )
+            for path in paths:
+                if not os.path.exists(path):
+                    logging.warning(f"{path}: not found, not loaded into {table}")
+                    continue
+                with open(path, newline="") as f:
+                    reader = csv.reader(f)
+                    header = [name.replace("-", "_") for name in next(reader, [])]
+                    positions = [
+                        header.index(column) if column in header else None
+                        for column in columns
+                    ]
+                    rows = (
+                        tuple(
+                            row[position] if position is not None and position < len(row) else ""
+                            for position in positions
+                        )
+                        for row in reader
+                    )
+                    while True:
+                        batch = list(islice(rows, BULK_LOAD_BATCH_SIZE))
+                        if not batch:
+                            break
+                        conn.executemany(sql, batch)
+
+        for name, sql in indexes:
+            conn.execute(sql)
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
 
 
 def new_dataset_create(
@@ -264,11 +426,19 @@ def new_dataset_create(
     issue_dir,
     column_field_dir,
     dataset_resource_dir,
+    bulk=True,
 ):
+    """
+    builds the dataset package from the transformed resources. With bulk the facts, column-field,
+    dataset-resource and issue logs are loaded with bulk_load_csvs rather than a file (and a
+    statement per row) at a time through DatasetPackage; set bulk=False to use the DatasetPackage loaders
+    """
     if not output_path:
         print("missing output path", file=sys.stderr)
         sys.exit(2)
 
+    # nothing may still have the old dataset open while it is replaced
+    close_connections()
     organisation = Organisation(organisation_path, Path(pipeline.path))
     package = DatasetPackage(
         dataset,
@@ -277,11 +447,28 @@ def new_dataset_create(
         specification_dir=specification_dir,  # TBD: package should use this specification object
     )
     package.create()
-    for path in input_paths:
-        package.load_transformed(path)
-        path_obj = Path(path)
-        package.load_column_fields(Path(column_field_dir) / path_obj.name)
-        package.load_dataset_resource(Path(dataset_resource_dir) / path_obj.name)
+    if bulk:
+        bulk_load_csvs(
+            output_path,
+            [
+                ("fact", input_paths),
+                ("fact_resource", input_paths),
+                (
+                    "column_field",
+                    [Path(column_field_dir) / Path(path).name for path in input_paths],
+                ),
+                (
+                    "dataset_resource",
+                    [Path(dataset_resource_dir) / Path(path).name for path in input_paths],
+                ),
+            ],
+        )
+    else:
+        for path in input_paths:
+            package.load_transformed(path)
+            path_obj = Path(path)
+            package.load_column_fields(Path(column_field_dir) / path_obj.name)
+            package.load_dataset_resource(Path(dataset_resource_dir) / path_obj.name)
 
     package.load_entities()
 
@@ -291,14 +478,171 @@ def new_dataset_create(
 
     issue_paths = os.path.join(issue_dir, dataset)
     if os.path.exists(issue_paths):
-        for issue_path in os.listdir(issue_paths):
-            package.load_issues(os.path.join(issue_paths, issue_path))
+        issue_paths = [
+            os.path.join(issue_paths, issue_path) for issue_path in os.listdir(issue_paths)
+        ]
+        if bulk:
+            bulk_load_csvs(output_path, [("issue", issue_paths)])
+        else:
+            for issue_path in issue_paths:
+                package.load_issues(issue_path)
     else:
         logging.warning("No directory for this dataset in the provided issue_directory")
 
     package.add_counts()
 
 
+def run_resource_pipeline(
+    data_dir,
+    dataset,
+    resource,
+    organisations,
+    pipeline=None,
+    specification=None,
+    run_dir=None,
+):
+    """
+    runs the pipeline for one collected resource, writing its transformed csv into data_dir and its
+    issues, column-field and dataset-resource logs into run_dir (data_dir if not given), laid out as
+    in data_dir. The pipeline and specification are read from data_dir when not given, so it can
+    run in a separate process
+    """
+    if pipeline is None:
+        pipeline = Pipeline(os.path.join(data_dir, "pipeline"), dataset)
+    if specification is None:
+        specification = Specification(os.path.join(data_dir, "specification"))
+    run_dir = run_dir or data_dir
+
+    # create issue directory
+    os.makedirs(os.path.join(run_dir, "issue", dataset), exist_ok=True)
+    os.makedirs(os.path.join(run_dir, "var", "column-field", dataset), exist_ok=True)
+    os.makedirs(
+        os.path.join(run_dir, "var", "dataset-resource", dataset), exist_ok=True
+    )
+
+    # read the resource as converted by assign_entries rather than converting it again
+    input_path = os.path.join(data_dir, "var", "converted", f'{resource["resource"]}.csv')
+    if not os.path.exists(input_path):
+        input_path = os.path.join(data_dir, "collection", "resource", resource["resource"])
+
+    pipeline_run(
+        dataset=dataset,  # I think dataset and pipeline here are identical maybe remove one of them
+        pipeline=pipeline,
+        specification=specification,  # isthis a directory
+        input_path=input_path,
+        output_path=os.path.join(
+            data_dir, "transformed", dataset, f'{resource["resource"]}.csv'
+        ),
+        collection_dir=os.path.join(data_dir, "collection"),
+        issue_dir=os.path.join(run_dir, "issue", dataset),
+        column_field_dir=os.path.join(run_dir, "var", "column-field", dataset),
+        dataset_resource_dir=os.path.join(run_dir, "var", "dataset-resource", dataset),
+        converted_resource_dir=os.path.join(data_dir, "collection", "resource"),
+        organisation_path=os.path.join(data_dir, "var", "cache", "organisation.csv"),
+        save_harmonised=False,
+        endpoints=resource["endpoints"].split(";"),
+        organisations=organisations,
+        entry_date=resource["start-date"],
+        output_log_dir=os.path.join(run_dir, "log/"),
+    )
+
+
+def merge_run_outputs(run_dir, data_dir):
+    """
+    moves the logs written by run_resource_pipeline into run_dir to the same place in data_dir.
+    A csv that already exists there (a log shared by every resource) has the rows appended
+    """
+    for root, dirs, files in os.walk(run_dir):
+        for filename in files:
+            path = os.path.join(root, filename)
+            output_path = os.path.join(data_dir, os.path.relpath(path, run_dir))
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            if not os.path.exists(output_path):
+                os.replace(path, output_path)
+                continue
+            with open(path) as f, open(output_path, "a") as output:
+                if filename.endswith(".csv"):
+                    # skip the header
+                    next(f, None)
+                shutil.copyfileobj(f, output)
+
+
+def run_resource_pipelines(
+    data_dir,
+    dataset,
+    resources,
+    resource_organisations,
+    workers=None,
+    pipeline=None,
+    specification=None,
+):
+    """
+    runs the pipeline for every resource, in a pool of worker processes (workers defaults to one per
+    cpu, at most one per resource; with one worker or one resource they run in this process). Each run
+    writes its logs to its own directory under var/pipeline-run, which are merged into data_dir once
+    every run has finished, so a failed run leaves nothing behind. Returns a dict of resource -> the
+    exception raised, for the resources that failed
+    """
+    for log_dir in [
+        os.path.join(data_dir, "issue", dataset),
+        os.path.join(data_dir, "var", "column-field", dataset),
+        os.path.join(data_dir, "var", "dataset-resource", dataset),
+    ]:
+        os.makedirs(log_dir, exist_ok=True)
+    runs_dir = os.path.join(data_dir, "var", "pipeline-run")
+    os.makedirs(runs_dir, exist_ok=True)
+    del_dir_contents(runs_dir)
+    run_dirs = {
+        resource["resource"]: os.path.join(runs_dir, resource["resource"])
+        for resource in resources
+    }
+    if workers is None:
+        workers = min(os.cpu_count() or 1, len(resources))
+
+    errors = {}
+    if workers <= 1 or len(resources) <= 1:
+        for resource in resources:
+            try:
+                run_resource_pipeline(
+                    data_dir,
+                    dataset,
+                    resource,
+                    resource_organisations[resource["resource"]],
+                    pipeline,
+                    specification,
+                    run_dir=run_dirs[resource["resource"]],
+                )
+            except Exception as e:
+                errors[resource["resource"]] = e
+    else:
+        # each worker reads the pipeline and specification from data_dir
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    run_resource_pipeline,
+                    data_dir,
+                    dataset,
+                    resource,
+                    resource_organisations[resource["resource"]],
+                    run_dir=run_dirs[resource["resource"]],
+                ): resource["resource"]
+                for resource in resources
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    errors[futures[future]] = e
+
+    for resource in resources:
+        if resource["resource"] in errors:
+            print(f'pipeline failed for resource {resource["resource"]}: {errors[resource["resource"]]}')
+        else:
+            merge_run_outputs(run_dirs[resource["resource"]], data_dir)
+    shutil.rmtree(runs_dir)
+    return errors
+
+
 def run_endpoint_workflow(
     collection_name,
     dataset,
@@ -308,7 +652,11 @@ def run_endpoint_workflow(
     data_dir,
     additional_col_mappings,
     additional_concats,
+    pipeline_workers=None,
 ):
+    """
+    pipeline_workers sets how many resources are run through the pipeline at once (see run_resource_pipelines)
+    """
     # create the relevant structure and download the files
     get_workflow_data(data_dir, collection_name, dataset)
     collection_dir = os.path.join(data_dir, "collection")
@@ -345,6 +693,7 @@ def run_endpoint_workflow(
 
     # retrieve unnassigned entities and assign
     print('assigning unidentified lookups')
+    lookups = LookupStore(os.path.join(data_dir, "pipeline", "lookup.csv"))
     for resource in resources:
         resource_path = os.path.join(collection_dir, "resource", resource["resource"])
         assign_entries(
@@ -353,7 +702,9 @@ def run_endpoint_workflow(
             organisation=organisation,
             pipeline_dir=os.path.join(data_dir, "pipeline"),
             specification_dir=os.path.join(data_dir, "specification"),
+            lookups=lookups,
         )
+    lookups.save()
 
     # also add in any additional column mappings, it's useful for testing
     if additional_col_mappings is not None:
@@ -370,42 +721,17 @@ def run_endpoint_workflow(
     specification_dir = os.path.join(data_dir, "specification")
     specification = Specification(specification_dir)
 
-    for resource in resources:
-        # create issue directory
-        os.makedirs(os.path.join(data_dir, "issue", dataset), exist_ok=True)
-        os.makedirs(
-            os.path.join(data_dir, "var", "column-field", dataset), exist_ok=True
-        )
-        os.makedirs(
-            os.path.join(data_dir, "var", "dataset-resource", dataset), exist_ok=True
-        )
-
-        pipeline_run(
-            dataset=dataset,  # I think dataset and pipeline here are identical maybe remove one of them
-            pipeline=pipeline,
-            specification=specification,  # isthis a directory
-            input_path=os.path.join(
-                data_dir, "collection", "resource", resource["resource"]
-            ),
-            output_path=os.path.join(
-                data_dir, "transformed", dataset, f'{resource["resource"]}.csv'
-            ),
-            collection_dir=os.path.join(data_dir, "collection"),
-            issue_dir=os.path.join(data_dir, "issue", dataset),
-            column_field_dir=os.path.join(data_dir, "var", "column-field", dataset),
-            dataset_resource_dir=os.path.join(
-                data_dir, "var", "dataset-resource", dataset
-            ),
-            converted_resource_dir=os.path.join(data_dir, "collection", "resource"),
-            organisation_path=os.path.join(
-                data_dir, "var", "cache", "organisation.csv"
-            ),
-            save_harmonised=False,
-            endpoints=[resource["endpoints"]],
-            organisations=[organisation],
-            entry_date=resource["start-date"],
-            output_log_dir=os.path.join(data_dir, "log/")
-        )
+    errors = run_resource_pipelines(
+        data_dir,
+        dataset,
+        resources,
+        {resource["resource"]: [organisation] for resource in resources},
+        workers=pipeline_workers,
+        pipeline=pipeline,
+        specification=specification,
+    )
+    if errors:
+        raise next(iter(errors.values()))
 
     # build dataset
     dataset_input_paths = [
@@ -425,6 +751,166 @@ def run_endpoint_workflow(
     )
 
 
+def run_endpoint_workflow_batch(
+    collection_name,
+    dataset,
+    endpoints,
+    data_dir,
+    additional_col_mappings=None,
+    additional_concats=None,
+    collect_workers=DOWNLOAD_WORKERS,
+    pipeline_workers=None,
+):
+    """
+    checks many candidate endpoints in one pass, e.g. for a new cohort of organisations.
+    endpoints is a list of (organisation, endpoint_url, plugin) rows. The endpoints are
+    collected concurrently, the pipeline is run for each resource in a process pool and
+    one dataset package is built from every resource in data_dir/dataset/<dataset>.sqlite3.
+
+    Returns a DataFrame with one row per endpoint: its collection status, the resource
+    collected, the number of entities and issues it produced, and any pipeline error.
+    """
+    endpoints = [tuple(row) for row in endpoints]
+
+    # create the relevant structure and download the files
+    get_workflow_data(data_dir, collection_name, dataset)
+    collection_dir = os.path.join(data_dir, "collection")
+    add_sources_and_endpoints(
+        collection_name, dataset, endpoints, collection_dir, "testing123"
+    )
+
+    # run collector, several endpoints at once (each writes its own log and resource files)
+    collector = Collector(dataset, collection_dir=Path(collection_dir))
+    endpoint_hashes = {}
+    for organisation, endpoint_url, plugin in endpoints:
+        endpoint_hashes.setdefault(hash_value(endpoint_url), (endpoint_url, plugin or ""))
+    with ThreadPoolExecutor(max_workers=collect_workers) as executor:
+        list(
+            executor.map(
+                lambda item: collector.fetch(item[1][0], endpoint=item[0], plugin=item[1][1]),
+                endpoint_hashes.items(),
+            )
+        )
+
+    # collection step remove log and resource csvs so new ones are created after adding the source and endpoint
+    try:
+        os.remove(Path(collection_dir) / "log.csv")
+        os.remove(Path(collection_dir) / "resource.csv")
+    except OSError:
+        pass
+    collection = Collection(name=None, directory=collection_dir)
+    collection.load(directory=collection_dir)
+    collection.save_csv(directory=collection_dir)
+    resources = collection.resource.entries
+    logs = {log["endpoint"]: log for log in collection.log.entries}
+
+    # organisations of each resource, from the endpoints it was collected from
+    endpoint_organisations = {}
+    for organisation, endpoint_url, plugin in endpoints:
+        endpoint_organisations.setdefault(hash_value(endpoint_url), []).append(organisation)
+    resource_organisations = {
+        resource["resource"]: list(
+            dict.fromkeys(
+                organisation
+                for endpoint in resource["endpoints"].split(";")
+                for organisation in endpoint_organisations.get(endpoint, [])
+            )
+        )
+        for resource in resources
+    }
+
+    # retrieve unnassigned entities and assign, one resource at a time as they share lookup.csv
+    print("assigning unidentified lookups")
+    lookups = LookupStore(os.path.join(data_dir, "pipeline", "lookup.csv"))
+    for resource in resources:
+        for organisation in resource_organisations[resource["resource"]]:
+            assign_entries(
+                resource_path=os.path.join(collection_dir, "resource", resource["resource"]),
+                dataset=dataset,
+                organisation=organisation,
+                pipeline_dir=os.path.join(data_dir, "pipeline"),
+                specification_dir=os.path.join(data_dir, "specification"),
+                lookups=lookups,
+            )
+    lookups.save()
+
+    # also add in any additional column mappings, it's useful for testing
+    if additional_col_mappings is not None:
+        column_path = os.path.join(data_dir, "pipeline", "column.csv")
+        add_extra_column_mappings(column_path, additional_col_mappings)
+
+    if additional_concats is not None:
+        concat_path = os.path.join(data_dir, "pipeline", "concat.csv")
+        add_extra_concats(concat_path, additional_concats)
+
+    # run the pipeline for every resource at once
+    pipeline_errors = {
+        resource: str(error)
+        for resource, error in run_resource_pipelines(
+            data_dir,
+            dataset,
+            resources,
+            resource_organisations,
+            workers=pipeline_workers,
+        ).items()
+    }
+
+    # build one dataset from every resource that made it through the pipeline
+    transformed_paths = {
+        resource["resource"]: os.path.join(
+            data_dir, "transformed", dataset, f'{resource["resource"]}.csv'
+        )
+        for resource in resources
+    }
+    dataset_input_paths = [
+        path
+        for resource, path in transformed_paths.items()
+        if resource not in pipeline_errors and os.path.exists(path)
+    ]
+    if dataset_input_paths:
+        new_dataset_create(
+            input_paths=dataset_input_paths,
+            output_path=os.path.join(data_dir, "dataset", f"{dataset}.sqlite3"),
+            organisation_path=os.path.join(data_dir, "var", "cache", "organisation.csv"),
+            pipeline=Pipeline(os.path.join(data_dir, "pipeline"), dataset),
+            dataset=dataset,
+            specification_dir=os.path.join(data_dir, "specification"),
+            issue_dir=os.path.join(data_dir, "issue"),
+            column_field_dir=os.path.join(data_dir, "var", "column-field", dataset),
+            dataset_resource_dir=os.path.join(data_dir, "var", "dataset-resource", dataset),
+        )
+    else:
+        print("No resources collected view collection logs for more info")
+
+    # summarise each endpoint
+    summary = []
+    for organisation, endpoint_url, plugin in endpoints:
+        endpoint = hash_value(endpoint_url)
+        log = logs.get(endpoint, {})
+        resource = log.get("resource", "")
+        row = {
+            "organisation": organisation,
+            "endpoint-url": endpoint_url,
+            "plugin": plugin,
+            "endpoint": endpoint,
+            "status": log.get("status", ""),
+            "exception": log.get("exception", ""),
+            "resource": resource,
+            "entities": None,
+            "issues": None,
+            "pipeline-error": pipeline_errors.get(resource, ""),
+        }
+        if resource and transformed_paths.get(resource) in dataset_input_paths:
+            row["entities"] = pd.read_csv(
+                transformed_paths[resource], usecols=["entity"], dtype=str
+            )["entity"].nunique()
+            issue_path = os.path.join(data_dir, "issue", dataset, f"{resource}.csv")
+            if os.path.exists(issue_path):
+                row["issues"] = len(pd.read_csv(issue_path, dtype=str))
+        summary.append(row)
+    return pd.DataFrame(summary)
+
+
 def missing_columns(results, dataset, expected_columns):
     mapped_columns = set(results["field"])
     expected_columns_for_dataset = expected_columns.get(dataset, [])
@@ -1,28 +1,111 @@
-import sqlite3
 import pandas as pd
 
+from functions_connection import get_connection
+
+# rows fetched from the database at a time, so a full result is never held as a list of tuples
+CHUNK_SIZE = 50000
+
 class DatasetSqlite:
-    def __init__(self,sqlite_path):
+    def __init__(self,sqlite_path,backend="sqlite",immutable=False):
+        """
+        immutable keeps the dataset open read only without locking (see functions_connection.connect),
+        use it for datasets that aren't written to while they're queried, e.g. a downloaded live dataset
+        """
         self.sqlite_path = sqlite_path
+        self.backend = backend
+        self.immutable = immutable
+
+    def _execute(self, sql_query, params=None):
+        con = get_connection(self.sqlite_path, backend=self.backend, immutable=self.immutable)
+        # a cursor of its own, so results being read from another query on the pooled
+        # connection are not replaced (duckdb's con.execute reuses the connection's result)
+        cursor = con.cursor()
+        if params is None:
+            return cursor.execute(sql_query)
+        return cursor.execute(sql_query, params)
 
-    def run_query(self, sql_query: str):
+    def _query_chunks(self, sql_query, params, chunksize):
+        cursor = self._execute(sql_query, params)
+        cols = [column[0] for column in cursor.description]
+        rows = cursor.fetchmany(chunksize)
+        # always yield one frame, so an empty result still has its columns
+        yield pd.DataFrame.from_records(data=rows, columns=cols)
+        while rows:
+            rows = cursor.fetchmany(chunksize)
+            if rows:
+                yield pd.DataFrame.from_records(data=rows, columns=cols)
+
+    def run_query(self, sql_query: str, params=None, chunksize=None):
         """
         Receives a sql query and returns the results either in a pandas
         dataframe or just the first column as a set (this is useful to
         test presence or absence of items like tables, columns, etc).
 
-        Note: connection is openned and closed at each query, but for use
-        cases like the present one that would not offer big benefits and
-        would mean having to dev thread-lcoal connection pools. For more
-        info see: https://stackoverflow.com/a/14520670
+        params are bound to ? (or :name) placeholders in the query. With
+        chunksize an iterator of dataframes of up to chunksize rows is
+        returned instead, as with pandas.read_sql.
+
+        Note: the connection comes from the thread-local pool in
+        functions_connection, so it is opened (and configured) once per
+        dataset rather than at each query. Rows are fetched CHUNK_SIZE at
+        a time. For more info see: https://stackoverflow.com/a/14520670
         """
-        with sqlite3.connect(self.sqlite_path) as con:
-            cursor = con.execute(sql_query)
-            cols = [column[0] for column in cursor.description]
-            results = pd.DataFrame.from_records(data=cursor.fetchall(), columns=cols)
+        if chunksize:
+            return self._query_chunks(sql_query, params, chunksize)
+
+        chunks = list(self._query_chunks(sql_query, params, CHUNK_SIZE))
+        if len(chunks) == 1:
+            return chunks[0]
+        return pd.concat(chunks, ignore_index=True)
+
+    def run_query_arrow(self, sql_query: str, params=None, batch_size=CHUNK_SIZE):
+        """
+        Streams the results of a query as a pyarrow RecordBatchReader of batches of up to batch_size
+        rows, all with the reader's schema (an empty result still has one). With the duckdb backend the
+        batches come straight from DuckDB without going through python objects. With sqlite the column
+        types are inferred from the first batch: columns with mixed types or only nulls are strings, and
+        later values of another type are converted to strings in those. A later value that doesn't fit a
+        numeric column raises a ValueError, cast the column in the query to fix its type.
+        pyarrow is only needed for this method
+        """
+        import pyarrow as pa
+
+        cursor = self._execute(sql_query, params)
+        if self.backend == "duckdb":
+            return cursor.fetch_record_batch(batch_size)
+
+        cols = [column[0] for column in cursor.description]
+        rows = cursor.fetchmany(batch_size)
+        columns = list(zip(*rows)) if rows else [() for col in cols]
+        fields = []
+        for col, values in zip(cols, columns):
+            try:
+                array_type = pa.array(values).type
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                array_type = pa.string()
+            if pa.types.is_null(array_type):
+                array_type = pa.string()
+            fields.append(pa.field(col, array_type))
+        schema = pa.schema(fields)
+
+        def to_array(values, field):
+            try:
+                return pa.array(values, type=field.type)
+            except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+                if not pa.types.is_string(field.type):
+                    raise ValueError(
+                        f"column {field.name} has values that aren't {field.type}, cast it in the query: {e}"
+                    )
+                return pa.array([None if value is None else str(value) for value in values], type=pa.string())
+
+        def batches(rows):
+            while rows:
+                arrays = [to_array(values, field) for values, field in zip(zip(*rows), schema)]
+                yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+                rows = cursor.fetchmany(batch_size)
+
+        return pa.RecordBatchReader.from_batches(schema, batches(rows))
 
-        return results
-    
     def get_entities(self):
         sql = """
         select * from entity;